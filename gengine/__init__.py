@@ -118,5 +118,9 @@ def main(global_config, **settings):
     config.add_renderer('json', json_renderer)
     
     config.scan()
+
+    if asbool(settings.get("cache.warm.on_startup", False)):
+        from gengine.app.warming import warm_caches_in_background
+        warm_caches_in_background(settings)
     
     return HTTPSProxied(config.make_wsgi_app())
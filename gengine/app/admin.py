@@ -13,10 +13,12 @@ from flask_admin.model.form import InlineFormAdmin
 from pyramid.settings import asbool
 from wtforms import BooleanField
 from wtforms.form import Form
+from wtforms.validators import ValidationError
 
 from gengine.app.model import DBSession, Variable, Goal, AchievementCategory, Achievement, AchievementProperty, GoalProperty, AchievementAchievementProperty, AchievementReward,\
                            GoalGoalProperty, Reward, User, GoalEvaluationCache, Value, AchievementUser, TranslationVariable, Language, Translation, \
     AuthUser, AuthRole, AuthRolePermission, GoalTrigger, GoalTriggerStep, UserMessage
+from gengine.app.formular import validate_condition, FormularEvaluationException
 from gengine.app.permissions import yield_all_perms
 from gengine.base.settings import get_settings
 
@@ -167,9 +169,22 @@ class ModelViewGoalTrigger(ModelView):
     def __init__(self, session, **kwargs):
         super(ModelViewGoalTrigger, self).__init__(GoalTrigger, session, **kwargs)
 
+def condition_validator(form, field):
+    # conditions are validated when they are saved, not when goals are evaluated
+    if field.data:
+        try:
+            validate_condition(field.data)
+        except FormularEvaluationException as e:
+            raise ValidationError("Invalid condition: %s" % (e.message,))
+
 class ModelViewGoal(ModelView):
     column_list = ('condition','operator','goal','timespan','priority','achievement','updated_at')
     form_excluded_columns =('properties','triggers')
+    form_args = {
+        'condition': {
+            'validators': [condition_validator]
+        }
+    }
     #column_searchable_list = ('name',)
     column_filters = (Achievement.id,)
     fast_mass_delete = True
@@ -241,6 +256,7 @@ class ModelViewUser(ModelView):
 
 class ClearCacheForm(Form):
     clear_check = BooleanField(label="Delete all caches?")
+    warm_check = BooleanField(label="Warm caches (runs in the background)?")
 
 class MaintenanceView(BaseView):
     @expose('/',methods=('GET','POST',))
@@ -253,6 +269,12 @@ class MaintenanceView(BaseView):
             if self.clear_caches_form.clear_check.data:
                 clear_all_caches()
                 self._template_args['msgs'].append("All caches cleared!")    
+            if self.clear_caches_form.warm_check.data:
+                from gengine.app.warming import warm_caches_in_background
+                warm_caches_in_background()
+                self._template_args['msgs'].append("Warming of the caches started.")
+        from gengine.base.cache import get_cache_stats
+        self._template_args['cache_stats'] = sorted(get_cache_stats().items())
         return self.render(template="admin_maintenance.html")
 
 class ModelViewAuthUser(ModelView):
@@ -0,0 +1,31 @@
+"""scoped_leaderboards
+
+Revision ID: 4cc1a1ea4e3b
+Revises: 2012674516fc
+Create Date: 2017-03-20 10:12:31.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4cc1a1ea4e3b'
+down_revision = '2012674516fc'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # ALTER TYPE ... ADD VALUE cannot run inside a transaction block
+    op.execute("COMMIT")
+    op.execute("ALTER TYPE relevance_types ADD VALUE IF NOT EXISTS 'groups'")
+    op.create_index(op.f('ix_users_city'), 'users', ['city'], unique=False)
+    op.create_index(op.f('ix_users_groups_group_id'), 'users_groups', ['group_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_users_groups_group_id'), table_name='users_groups')
+    op.drop_index(op.f('ix_users_city'), table_name='users')
+    # postgres can't remove values from an enum type, achievements with relevance "groups" are moved to "own"
+    op.execute("UPDATE achievements SET relevance='own' WHERE relevance='groups'")
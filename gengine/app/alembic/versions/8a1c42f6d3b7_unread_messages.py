@@ -0,0 +1,31 @@
+"""unread_messages
+
+Revision ID: 8a1c42f6d3b7
+Revises: e0e9b2422e16
+Create Date: 2017-04-05 11:02:45.127734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a1c42f6d3b7'
+down_revision = 'e0e9b2422e16'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('users', sa.Column('unread_messages', sa.Integer(), nullable=False, server_default='0'))
+    op.execute("""
+        UPDATE users SET unread_messages = counts.c
+        FROM (SELECT user_id, count(*) AS c FROM user_messages WHERE NOT is_read GROUP BY user_id) AS counts
+        WHERE users.id = counts.user_id
+    """)
+    op.create_index('ix_user_messages_user_id_created_at_id', 'user_messages', ['user_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_messages_user_id_created_at_id', table_name='user_messages')
+    op.drop_column('users', 'unread_messages')
@@ -0,0 +1,25 @@
+"""message_rendered_text
+
+Revision ID: b3e57d1a9c20
+Revises: 8a1c42f6d3b7
+Create Date: 2017-04-06 09:37:12.640215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3e57d1a9c20'
+down_revision = '8a1c42f6d3b7'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # existing messages keep rendered_text NULL and are rendered when they are read
+    op.add_column('user_messages', sa.Column('rendered_text', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user_messages', 'rendered_text')
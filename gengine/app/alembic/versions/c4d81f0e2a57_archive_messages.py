@@ -0,0 +1,48 @@
+"""archive_messages
+
+Revision ID: c4d81f0e2a57
+Revises: b3e57d1a9c20
+Create Date: 2017-04-07 11:02:45.318404
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4d81f0e2a57'
+down_revision = 'b3e57d1a9c20'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('user_messages_archive',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('translation_id', sa.Integer(), nullable=True),
+    sa.Column('params', sa.JSON(), nullable=True),
+    sa.Column('rendered_text', sa.JSON(), nullable=True),
+    sa.Column('is_read', sa.Boolean(), nullable=False),
+    sa.Column('has_been_pushed', sa.Boolean(), nullable=False),
+    sa.Column('push_attempts', sa.Integer(), nullable=False),
+    sa.Column('push_retry_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_user_messages_archive'))
+    )
+    op.create_index(op.f('ix_user_messages_archive_user_id'), 'user_messages_archive', ['user_id'], unique=False)
+    op.create_index(op.f('ix_user_messages_archive_created_at'), 'user_messages_archive', ['created_at'], unique=False)
+
+    # almost all messages have been pushed, only the few unpushed ones are indexed
+    op.drop_index(op.f('ix_user_messages_has_been_pushed'), table_name='user_messages')
+    op.create_index('ix_user_messages_unpushed', 'user_messages', ['id'], unique=False,
+                    postgresql_where=sa.text('NOT has_been_pushed'))
+
+
+def downgrade():
+    op.drop_index('ix_user_messages_unpushed', table_name='user_messages')
+    op.create_index(op.f('ix_user_messages_has_been_pushed'), 'user_messages', ['has_been_pushed'], unique=False)
+
+    op.drop_index(op.f('ix_user_messages_archive_created_at'), table_name='user_messages_archive')
+    op.drop_index(op.f('ix_user_messages_archive_user_id'), table_name='user_messages_archive')
+    op.drop_table('user_messages_archive')
@@ -0,0 +1,26 @@
+"""pushed_devices
+
+Revision ID: d7a3c9e41f08
+Revises: c4d81f0e2a57
+Create Date: 2017-04-10 14:21:37.904112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3c9e41f08'
+down_revision = 'c4d81f0e2a57'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user_messages', sa.Column('pushed_devices', sa.JSON(), nullable=True))
+    op.add_column('user_messages_archive', sa.Column('pushed_devices', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user_messages_archive', 'pushed_devices')
+    op.drop_column('user_messages', 'pushed_devices')
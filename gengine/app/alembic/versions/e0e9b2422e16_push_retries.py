@@ -0,0 +1,26 @@
+"""push_retries
+
+Revision ID: e0e9b2422e16
+Revises: 4cc1a1ea4e3b
+Create Date: 2017-04-03 14:21:07.331954
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e0e9b2422e16'
+down_revision = '4cc1a1ea4e3b'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user_messages', sa.Column('push_attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('user_messages', sa.Column('push_retry_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user_messages', 'push_retry_at')
+    op.drop_column('user_messages', 'push_attempts')
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Backfill of the goal trigger executions.
+
+When a trigger step is created or edited, it must not be executed for the users who already meet its condition.
+Executions are inserted for these users with one INSERT ... SELECT per batch of users, the progress, the level and the
+percentage are computed by the database. The backfill runs in the transaction which saves the step, so the step is
+never active without its executions. The progress is logged.
+
+settings:
+    triggers.backfill.batch_size = 10000    users per statement
+"""
+import datetime
+import logging
+import time
+
+import sqlalchemy.types as ty
+from sqlalchemy.sql.expression import select, and_, exists, literal, cast, case, bindparam
+from sqlalchemy.sql.functions import func
+
+from gengine.base.settings import get_settings
+
+log = logging.getLogger(__name__)
+
+
+def get_backfill_query(trigger_step, goal, achievement, achievement_date):
+    """return the statement which inserts the executions of the users after_id < id <= until_id who meet the condition,
+    None if the step has no percentage condition"""
+    from gengine.app.model import Goal, t_users, t_values, t_achievements_users, t_goal_trigger_step_executions
+
+    if trigger_step["condition_type"] not in ("percentage", None) or trigger_step["condition_percentage"] is None:
+        return None
+
+    def in_batch(col):
+        return and_(col > bindparam("after_id"), col <= bindparam("until_id"))
+
+    progress = Goal.get_progress_query(goal, achievement, achievement_date, user_filter=in_batch(t_values.c.user_id)).alias("progress")
+    levels = select([t_achievements_users.c.user_id, func.max(t_achievements_users.c.level).label("level")])\
+        .where(and_(t_achievements_users.c.achievement_id == achievement["id"],
+                    t_achievements_users.c.achievement_date == achievement_date,
+                    in_batch(t_achievements_users.c.user_id)))\
+        .group_by(t_achievements_users.c.user_id)\
+        .alias("levels")
+
+    # like Goal.evaluate for the next level of the user (or the maxlevel)
+    maxlevel = achievement["maxlevel"]
+    level = func.least(func.coalesce(levels.c.level, 0) + 1, maxlevel)
+    goal_goals, previous_goals = {}, {}
+    for l in range(0, maxlevel + 1):
+        goal_goal = Goal.get_goal_target(goal, maxlevel, l)
+        previous_goal = Goal.get_goal_target(goal, maxlevel, l - 1) or 0
+        if goal_goal is None:
+            continue
+        goal_goals[l] = float(goal_goal)
+        previous_goals[l] = float(previous_goal) if previous_goal != goal_goal else 0.0
+    if not goal_goals:
+        return None
+
+    goal_goal = case(goal_goals, value=level)
+    previous_goal = case(previous_goals, value=level)
+    value = cast(func.coalesce(progress.c.value, 0), ty.Float)
+    if goal["operator"] == "geq":
+        value = func.least(value, goal_goal)
+    else:
+        value = func.greatest(value, goal_goal)
+    percentage = (value - previous_goal) / func.nullif(goal_goal - previous_goal, 0)
+    if goal["operator"] == "geq":
+        meets_condition = percentage >= trigger_step["condition_percentage"]
+    else:
+        meets_condition = percentage <= trigger_step["condition_percentage"]
+
+    already_executed = exists().where(and_(t_goal_trigger_step_executions.c.trigger_step_id == trigger_step["id"],
+                                           t_goal_trigger_step_executions.c.user_id == t_users.c.id,
+                                           t_goal_trigger_step_executions.c.execution_level == level,
+                                           t_goal_trigger_step_executions.c.achievement_date == achievement_date))
+
+    j = t_users.outerjoin(progress, progress.c.user_id == t_users.c.id)\
+               .outerjoin(levels, levels.c.user_id == t_users.c.id)
+    q = select([literal(trigger_step["id"], ty.Integer),
+                t_users.c.id,
+                level,
+                literal(achievement_date, ty.DateTime),
+                literal(datetime.datetime.utcnow(), ty.DateTime)], from_obj=j)\
+        .where(and_(in_batch(t_users.c.id), meets_condition, ~already_executed))
+
+    return t_goal_trigger_step_executions.insert().from_select(
+        ["trigger_step_id", "user_id", "execution_level", "achievement_date", "execution_date"], q)
+
+
+def backfill_trigger_step(trigger_step, connection, batch_size=None):
+    """insert the executions of the trigger step for the users who already meet its condition, return the number of
+    inserted executions.
+
+    trigger_step is a dict with id, goal_trigger_id, condition_type and condition_percentage, the statements run on
+    connection, i.e. in the transaction which saves the step."""
+    from gengine.app.model import Achievement, Goal, t_users, t_goal_triggers
+
+    if batch_size is None:
+        batch_size = int((get_settings() or {}).get("triggers.backfill.batch_size", 10000))
+    started = time.time()
+
+    goal_id = connection.execute(select([t_goal_triggers.c.goal_id]).where(t_goal_triggers.c.id == trigger_step["goal_trigger_id"])).scalar()
+    goal = Goal.get_goal(goal_id)
+    achievement = Achievement.get_achievement(goal["achievement_id"])
+    achievement_date = Achievement.get_datetime_for_evaluation_type(evaluation_timezone=achievement["evaluation_timezone"],
+                                                                    evaluation_type=achievement["evaluation"])
+    statement = get_backfill_query(trigger_step, goal, achievement, achievement_date)
+    if statement is None:
+        return 0
+    total = connection.execute(select([func.count(t_users.c.id)])).scalar()
+
+    batch = select([t_users.c.id]).where(t_users.c.id > bindparam("after_id")).order_by(t_users.c.id).limit(batch_size).alias()
+    after_id = -1
+    users = executions = 0
+    while True:
+        count, until_id = connection.execute(select([func.count(batch.c.id), func.max(batch.c.id)]), {"after_id": after_id}).fetchone()
+        if not count:
+            break
+        executions += connection.execute(statement, {"after_id": after_id, "until_id": until_id}).rowcount
+        users += count
+        after_id = until_id
+        log.info("backfill of trigger step %s: %s of %s users" % (trigger_step["id"], users, total))
+
+    log.info("backfill of trigger step %s: %s executions inserted in %.2f seconds" % (trigger_step["id"], executions, time.time() - started))
+    return executions
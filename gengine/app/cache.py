@@ -1,4 +1,4 @@
-from gengine.base.cache import create_cache
+from gengine.base.cache import create_cache, clear_local_caches
 
 caches = {}
 
@@ -42,3 +42,4 @@ def clear_all_caches():
     cache_translations.invalidate(hard=True)
     cache_goal_evaluation.invalidate(hard=True)
     #cache_goal_statements.invalidate(hard=True)
+    clear_local_caches()
@@ -1,4 +1,6 @@
+import logging
 import re
+import threading
 
 import functools
 import jsl
@@ -11,6 +13,14 @@ import operator
 
 from sqlalchemy.sql import and_, or_
 
+log = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    log.info("numpy not installed")
+
 class FormularEvaluationException(Exception):
     def __init__(self, message):
         self.message = message
@@ -91,7 +101,16 @@ class NumericStringParser(object):
                    "abs": abs,
                    "trunc": lambda a: int(a),
                    "round": round,
-                   "sgn": lambda a: abs(a) > epsilon and pp.cmp(a, 0) or 0}
+                   "sgn": lambda a: (a > epsilon) - (a < -epsilon)}
+        # the numpy versions, trunc, round and sgn return ints like the scalar versions
+        self.array_fn = {"sin": numpy.sin,
+                         "cos": numpy.cos,
+                         "tan": numpy.tan,
+                         "abs": numpy.abs,
+                         "trunc": lambda a: numpy.trunc(a).astype(int),
+                         "round": lambda a: numpy.round(a).astype(int),
+                         "sgn": lambda a: numpy.greater(a, epsilon).astype(int) - numpy.less(a, -epsilon).astype(int)
+                         } if numpy is not None else None
 
     def evaluateStack(self, s, key_value_map={}):
         op = s.pop()
@@ -114,6 +133,36 @@ class NumericStringParser(object):
         else:
             return float(op)
 
+    def compileStack(self, s, fn=None):
+        """like evaluateStack, but returns a function key_value_map -> value, so the stack is only walked once.
+
+        fn replaces the functions (e.g. by their numpy versions for arrays)"""
+        fn = fn if fn is not None else self.fn
+        op = s.pop()
+        if op == 'unary -':
+            f = self.compileStack(s, fn)
+            return lambda kv: -f(kv)
+        if op in "+-*/^":
+            f2 = self.compileStack(s, fn)
+            f1 = self.compileStack(s, fn)
+            opn = self.opn[op]
+            return lambda kv: opn(f1(kv), f2(kv))
+        elif op == "PI":
+            return lambda kv: math.pi
+        elif op == "E":
+            return lambda kv: math.e
+        elif op in self.extra_literals:
+            return lambda kv: kv[op]
+        elif op in fn:
+            f = self.compileStack(s, fn)
+            func = fn[op]
+            return lambda kv: func(f(kv))
+        elif op[0].isalpha():
+            return lambda kv: 0
+        else:
+            value = float(op)
+            return lambda kv: value
+
     def eval(self, num_string, key_value_map={}, parseAll=True):
         self.exprStack = []
         results = self.bnf.parseString(num_string, parseAll)
@@ -121,50 +170,161 @@ class NumericStringParser(object):
         return val
 
 
+_parse_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=64)
+def _get_parser(names):
+    return NumericStringParser(extra_literals=list(names))
+
+
+def _parse_stack(expression, names):
+    parser = _get_parser(names)
+    # the parser collects the expression stack in its state
+    with _parse_lock:
+        parser.exprStack = []
+        parser.bnf.parseString(expression, True)
+        return parser, parser.exprStack[:]
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_value_expression(expression, names=()):
+    """parse the expression once and return a function params -> value.
+
+    The grammar depends on the names of the parameters, so the compiled functions are cached by expression and names."""
+    parser, stack = _parse_stack(expression, names)
+    return parser.compileStack(stack)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_array_expression(expression, names=()):
+    """like compile_value_expression, but the returned function works on numpy arrays"""
+    parser, stack = _parse_stack(expression, names)
+    return parser.compileStack(stack, fn=parser.array_fn)
+
+
 def evaluate_value_expression(expression, params={}):
     if expression is None:
         return None
     try:
-        nsp = NumericStringParser(extra_literals=params.keys())
-        return nsp.eval(expression,key_value_map=params)
+        return compile_value_expression(expression, tuple(params.keys()))(params)
     except:
         raise FormularEvaluationException(expression)
 
 
-def render_string(tpl, params):
-    """Substitute text in <> with corresponding variable value."""
-    regex = re.compile('\${(.+?)}')
-    def repl(m):
-        group = m.group(1)
-        value = evaluate_value_expression(group, params)
-        if int(value) == value:
-            value = int(value)
-        return str(value)
-    return regex.sub(repl, tpl)
+def _evaluate_elementwise(expression, params):
+    sequences = {k: list(v) for k, v in params.items() if not isinstance(v, (int, float))}
+    lengths = set(len(v) for v in sequences.values())
+    if len(lengths) > 1:
+        raise ValueError("the parameters have different lengths")
+    f = compile_value_expression(expression, tuple(params.keys()))
+    if not lengths:
+        return f(params)
+    return [f(dict(params, **{k: v[i] for k, v in sequences.items()})) for i in range(lengths.pop())]
 
 
-def evaluate_string(inst, params=None):
+def evaluate_value_expression_array(expression, params={}):
+    """evaluate the expression for many parameter values at once, e.g. all levels ({"level": range(1, 11)})
+    or the levels of many users.
+
+    Sequences and arrays are broadcast against each other and a numpy array of the common shape is returned.
+    Integer parameters are kept as integer arrays, so that the elements have the types of the scalar evaluation
+    (``.tolist()`` returns the same values as :func:`evaluate_value_expression`).
+    Without numpy, the expression is evaluated per element and a list is returned (sequences must have equal lengths)."""
+    if expression is None:
+        return None
     try:
-        if inst is None:
-            return None
-        if params is not None:
-            formatted = render_string(inst, params)
-        else:
-            formatted = inst
+        if numpy is None:
+            return _evaluate_elementwise(expression, params)
+        arrays = {k: numpy.asarray(v) for k, v in params.items()}
+        shape = numpy.broadcast(*arrays.values()).shape if arrays else ()
+        with numpy.errstate(divide="raise", invalid="raise"):
+            value = compile_array_expression(expression, tuple(arrays.keys()))(arrays)
+        # constant expressions return scalars
+        return numpy.broadcast_to(value, shape).copy()
+    except:
+        raise FormularEvaluationException(expression)
+
+
+_render_regex = re.compile('\${(.+?)}')
 
-        try:
-            if str(int(formatted)) == str(formatted):
-                return int(formatted)
-        except:
-            pass
 
+def _format_value(value):
+    if int(value) == value:
+        value = int(value)
+    return str(value)
+
+
+def _compile_slot(expression, names):
+    try:
+        f = compile_value_expression(expression, names)
+    except:
+        raise FormularEvaluationException(expression)
+
+    def slot(params):
         try:
-            if str(int(float)) == str(float):
-                return float(formatted)
+            return f(params)
         except:
-            pass
+            raise FormularEvaluationException(expression)
+    return slot
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(tpl, names=()):
+    """split the template into its literal text and the compiled ${...} expressions.
+
+    returns a function params -> rendered text, cached by template and parameter names."""
+    # split returns the literal text at the even and the expressions at the odd positions
+    parts = _render_regex.split(tpl)
+    literals = parts[0::2]
+    slots = [_compile_slot(expression, names) for expression in parts[1::2]]
+    if not slots:
+        return lambda params: tpl
+
+    def render(params):
+        out = [literals[0]]
+        for slot, literal in zip(slots, literals[1:]):
+            out.append(_format_value(slot(params)))
+            out.append(literal)
+        return "".join(out)
+    return render
+
+
+def render_string(tpl, params):
+    """Substitute text in <> with corresponding variable value."""
+    return compile_template(tpl, tuple(params.keys()))(params)
+
+
+def _to_int(formatted):
+    # texts which are not integers are returned unchanged
+    try:
+        if str(int(formatted)) == str(formatted):
+            return int(formatted)
+    except:
+        pass
+    return formatted
+
 
-        return formatted
+@functools.lru_cache(maxsize=4096)
+def compile_string(inst, names=None):
+    """return a function params -> evaluate_string(inst, params), cached by text and parameter names.
+
+    names is None if the text is not rendered."""
+    if names is None:
+        value = _to_int(inst)
+        return lambda params: value
+    render = compile_template(inst, names)
+    if not set("".join(_render_regex.split(inst)[0::2])) <= set("-0123456789"):
+        # the literal text can't be part of an integer, the rendered text is never converted
+        return render
+    return lambda params: _to_int(render(params))
+
+
+def evaluate_string(inst, params=None):
+    try:
+        if inst is None:
+            return None
+        return compile_string(inst, tuple(params.keys()) if params is not None else None)(params)
     except:
         raise FormularEvaluationException(inst)
 
@@ -203,8 +363,35 @@ class TermDocument(jsl.Document):
     ], required=True)
 
 
+@functools.lru_cache(maxsize=1)
+def get_term_validator():
+    """the validator of the condition schema, built once per process"""
+    schema = TermDocument.get_schema()
+    return jsonschema.validators.validator_for(schema)(schema)
+
+
 def validate_term(condition_term):
-    return jsonschema.validate(condition_term, TermDocument.get_schema())
+    return get_term_validator().validate(condition_term)
+
+
+def validate_condition(inst):
+    """validate the condition (JSON text or dict) when it is saved, raise FormularEvaluationException with the reason"""
+    try:
+        if isinstance(inst, str):
+            inst = json.loads(inst)
+        validate_term(inst)
+    except ValueError as e:
+        raise FormularEvaluationException("invalid JSON: %s" % (e,))
+    except jsonschema.ValidationError as e:
+        raise FormularEvaluationException(e.message)
+    # the schema does not require the types, which are needed for the evaluation
+    terms = [inst["term"]]
+    while terms:
+        term = terms.pop()
+        if str(term.get("type", "")).lower() not in ("conjunction", "disjunction", "literal"):
+            raise FormularEvaluationException("the term %s has no valid type" % (json.dumps(term),))
+        terms.extend(term.get("terms", []))
+
 
 def _term_eval(term, column_variable, column_key):
 
@@ -224,22 +411,37 @@ def _term_eval(term, column_variable, column_key):
             return column_variable==term["variable"]
 
 
-def evaluate_condition(inst, column_variable=None, column_key=None):
+def evaluate_condition(inst, column_variable=None, column_key=None, validate=True):
+    """build the SQLAlchemy expression of the condition.
+
+    The conditions of goals are validated when they are saved, validate=False skips the validation (see compile_condition)."""
     try:
         if isinstance(inst,str):
             inst = json.loads(inst)
-        from gengine.app.model import t_values, t_variables
-        if column_variable is None:
-            column_variable = t_variables.c.name.label("variable_name")
-        if column_key is None:
-            column_key = t_variables.c.name.label("variable_name")
-
-        jsonschema.validate(inst, TermDocument.get_schema())
+        if column_variable is None or column_key is None:
+            from gengine.app.model import t_variables
+            if column_variable is None:
+                column_variable = t_variables.c.name.label("variable_name")
+            if column_key is None:
+                column_key = t_variables.c.name.label("variable_name")
+
+        if validate:
+            validate_term(inst)
         return _term_eval(inst["term"], column_variable, column_key)
     except:
        raise FormularEvaluationException(json.dumps(inst))
 
 
+@functools.lru_cache(maxsize=1024)
+def compile_condition(inst):
+    """the condition of a goal on variables.name and values.key, without validation.
+
+    The expressions are cached by the condition text, so edited goals get a new entry."""
+    from gengine.app.model import t_values, t_variables
+    return evaluate_condition(inst, column_variable=t_variables.c.name.label("variable_name"),
+                              column_key=t_values.c.key, validate=False)
+
+
 demo_schema = {
     'term': {
         'variable': 'participate',
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Sorted-set leaderboards for goals.
+
+There is one leaderboard per (goal, achievement_date) and one per (goal, achievement_date, scope) for the city and group
+leaderboards. They are updated whenever a goal evaluation is stored and answer rank, top-N and neighbour lookups
+without sorting the goal_evaluation_cache on every request.
+Leaderboards are built lazily from the goal_evaluation_cache (see :meth:`gengine.app.model.Goal.rebuild_leaderboard`).
+
+Scopes are strings like "city:Paderborn" or "group:12" (see :func:`city_scope` and :func:`group_scope`).
+When the city or groups of a user change, :meth:`LeaderboardStore.update_scopes` moves the user between the scoped leaderboards.
+
+Backends:
+    - memory: a sorted list per leaderboard inside the process (single process deployments, tests)
+    - redis:  a sorted set per leaderboard, shared between all processes
+
+Entries are ordered by value (descending) and user_id (descending), positions start at 0.
+"""
+import bisect
+import logging
+import threading
+
+from gengine.base.settings import get_settings
+
+log = logging.getLogger(__name__)
+
+try:
+    import redis
+except ImportError as e:
+    log.info("redis not installed")
+
+
+def board_key(goal_id, achievement_date, scope=None):
+    if scope is None:
+        return "%s_%s" % (goal_id, achievement_date)
+    return "%s_%s_%s" % (goal_id, achievement_date, scope)
+
+
+def city_scope(city):
+    return "city:%s" % (city,)
+
+
+def group_scope(group_id):
+    return "group:%s" % (group_id,)
+
+
+def parse_scope(scope):
+    """return (kind, value) of the scope, e.g. ("group", "12")"""
+    kind, value = scope.split(":", 1)
+    return kind, value
+
+
+class LeaderboardStore(object):
+    """Interface of the leaderboard backends.
+
+    All lookups take an optional scope, None is the leaderboard of all users.
+    """
+
+    def exists(self, goal_id, achievement_date, scope=None):
+        """check whether the leaderboard has been built."""
+        raise NotImplementedError()
+
+    def rebuild(self, goal_id, achievement_date, entries, scope=None):
+        """replace the leaderboard by entries, an iterable of (user_id, value) tuples."""
+        raise NotImplementedError()
+
+    def set_value(self, goal_id, achievement_date, user_id, value, scopes=()):
+        """update the value of the user in the leaderboard and in the leaderboards of the user's scopes.
+
+        Leaderboards which have not been built yet are ignored."""
+        raise NotImplementedError()
+
+    def update_scopes(self, user_id, removed_scopes, added_scopes):
+        """move the user between the scoped leaderboards after the city or groups of the user changed."""
+        raise NotImplementedError()
+
+    def remove_user(self, user_id):
+        """remove the user from all leaderboards."""
+        raise NotImplementedError()
+
+    def size(self, goal_id, achievement_date, scope=None):
+        raise NotImplementedError()
+
+    def rank(self, goal_id, achievement_date, user_id, scope=None):
+        """return the position of the user or None if the user is not part of the leaderboard."""
+        raise NotImplementedError()
+
+    def get_range(self, goal_id, achievement_date, start, stop, scope=None):
+        """return [(position, user_id, value), ...] for the positions start <= position < stop"""
+        raise NotImplementedError()
+
+    def get_values(self, goal_id, achievement_date, user_ids, scope=None):
+        """return {user_id: value} for the given users (users without value are omitted)"""
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def top(self, goal_id, achievement_date, n, offset=0, scope=None):
+        return self.get_range(goal_id, achievement_date, offset, offset + n, scope=scope)
+
+    def around(self, goal_id, achievement_date, user_id, radius, scope=None):
+        """return the neighbours of the user, i.e. up to radius positions before and after the user."""
+        position = self.rank(goal_id, achievement_date, user_id, scope=scope)
+        if position is None:
+            return []
+        return self.get_range(goal_id, achievement_date, max(0, position - radius), position + radius + 1, scope=scope)
+
+
+class MemoryLeaderboardStore(LeaderboardStore):
+    """Keeps a sorted list of (-value, -user_id) per leaderboard; lookups are binary searches."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._boards = {}
+        self._scoped_boards = {}  # scope -> {(goal_id, achievement_date), ...}
+
+    def _sort_key(self, user_id, value):
+        return (-value, -int(user_id))
+
+    def exists(self, goal_id, achievement_date, scope=None):
+        return board_key(goal_id, achievement_date, scope) in self._boards
+
+    def rebuild(self, goal_id, achievement_date, entries, scope=None):
+        values = {int(user_id): value for user_id, value in entries}
+        keys = sorted(self._sort_key(user_id, value) for user_id, value in values.items())
+        with self._lock:
+            self._boards[board_key(goal_id, achievement_date, scope)] = (keys, values)
+            if scope is not None:
+                self._scoped_boards.setdefault(scope, set()).add((goal_id, achievement_date))
+
+    def _set(self, board, user_id, value):
+        keys, values = board
+        user_id = int(user_id)
+        if user_id in values:
+            old = self._sort_key(user_id, values[user_id])
+            del keys[bisect.bisect_left(keys, old)]
+        bisect.insort(keys, self._sort_key(user_id, value))
+        values[user_id] = value
+
+    def _remove(self, board, user_id):
+        keys, values = board
+        if user_id in values:
+            del keys[bisect.bisect_left(keys, self._sort_key(user_id, values.pop(user_id)))]
+
+    def set_value(self, goal_id, achievement_date, user_id, value, scopes=()):
+        with self._lock:
+            for scope in [None, ] + list(scopes):
+                board = self._boards.get(board_key(goal_id, achievement_date, scope))
+                if board is not None:
+                    self._set(board, user_id, value)
+
+    def update_scopes(self, user_id, removed_scopes, added_scopes):
+        user_id = int(user_id)
+        with self._lock:
+            for scope in removed_scopes:
+                for goal_id, achievement_date in self._scoped_boards.get(scope, ()):
+                    self._remove(self._boards[board_key(goal_id, achievement_date, scope)], user_id)
+            for scope in added_scopes:
+                for goal_id, achievement_date in list(self._scoped_boards.get(scope, ())):
+                    key = board_key(goal_id, achievement_date, scope)
+                    board = self._boards.get(board_key(goal_id, achievement_date))
+                    if board is None:
+                        # the value is unknown, the scoped leaderboard is rebuilt on the next read
+                        del self._boards[key]
+                        self._scoped_boards[scope].discard((goal_id, achievement_date))
+                    elif user_id in board[1]:
+                        self._set(self._boards[key], user_id, board[1][user_id])
+
+    def remove_user(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            for board in self._boards.values():
+                self._remove(board, user_id)
+
+    def size(self, goal_id, achievement_date, scope=None):
+        board = self._boards.get(board_key(goal_id, achievement_date, scope))
+        return len(board[0]) if board else 0
+
+    def rank(self, goal_id, achievement_date, user_id, scope=None):
+        user_id = int(user_id)
+        with self._lock:
+            board = self._boards.get(board_key(goal_id, achievement_date, scope))
+            if board is None or user_id not in board[1]:
+                return None
+            keys, values = board
+            return bisect.bisect_left(keys, self._sort_key(user_id, values[user_id]))
+
+    def get_range(self, goal_id, achievement_date, start, stop, scope=None):
+        with self._lock:
+            board = self._boards.get(board_key(goal_id, achievement_date, scope))
+            if board is None:
+                return []
+            start = max(0, start)
+            return [(start + i, -k[1], -k[0]) for i, k in enumerate(board[0][start:stop])]
+
+    def get_values(self, goal_id, achievement_date, user_ids, scope=None):
+        board = self._boards.get(board_key(goal_id, achievement_date, scope))
+        if board is None:
+            return {}
+        values = board[1]
+        return {int(u): values[int(u)] for u in user_ids if int(u) in values}
+
+    def clear(self):
+        with self._lock:
+            self._boards = {}
+            self._scoped_boards = {}
+
+
+class RedisLeaderboardStore(LeaderboardStore):
+    """Uses one redis sorted set per leaderboard.
+
+    Members are zero-padded user ids, so redis' lexicographical tie-breaking orders equal values by user_id.
+    The scoped leaderboards of a scope are registered in a hash, which maps them to their unscoped leaderboard.
+    """
+
+    def __init__(self, client, prefix="gengine_leaderboard"):
+        self.client = client
+        self.prefix = prefix
+        self.index_key = prefix + "_boards"
+
+    def _key(self, goal_id, achievement_date, scope=None):
+        return "%s:%s" % (self.prefix, board_key(goal_id, achievement_date, scope))
+
+    def _scope_index_key(self, scope):
+        return "%s_scope:%s" % (self.prefix, scope)
+
+    def _member(self, user_id):
+        return "%020d" % (int(user_id),)
+
+    def exists(self, goal_id, achievement_date, scope=None):
+        return bool(self.client.sismember(self.index_key, self._key(goal_id, achievement_date, scope)))
+
+    def rebuild(self, goal_id, achievement_date, entries, scope=None):
+        key = self._key(goal_id, achievement_date, scope)
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        args = []
+        for user_id, value in entries:
+            args += [value, self._member(user_id)]
+        if args:
+            # raw command, as the signature of zadd differs between the versions of redis-py
+            pipe.execute_command("ZADD", key, *args)
+        pipe.sadd(self.index_key, key)
+        if scope is not None:
+            pipe.hset(self._scope_index_key(scope), key, self._key(goal_id, achievement_date))
+        pipe.execute()
+
+    def set_value(self, goal_id, achievement_date, user_id, value, scopes=()):
+        keys = [self._key(goal_id, achievement_date, scope) for scope in [None, ] + list(scopes)]
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.sismember(self.index_key, key)
+        built = pipe.execute()
+        member = self._member(user_id)
+        for key, exists in zip(keys, built):
+            if exists:
+                pipe.execute_command("ZADD", key, value, member)
+        pipe.execute()
+
+    def update_scopes(self, user_id, removed_scopes, added_scopes):
+        member = self._member(user_id)
+        pipe = self.client.pipeline()
+        for scope in removed_scopes:
+            for key in self.client.hkeys(self._scope_index_key(scope)):
+                pipe.zrem(key, member)
+        for scope in added_scopes:
+            for key, unscoped_key in self.client.hgetall(self._scope_index_key(scope)).items():
+                value = self.client.zscore(unscoped_key, member)
+                if value is not None:
+                    pipe.execute_command("ZADD", key, value, member)
+                elif not self.client.sismember(self.index_key, unscoped_key):
+                    # the value is unknown, the scoped leaderboard is rebuilt on the next read
+                    pipe.srem(self.index_key, key)
+                    pipe.hdel(self._scope_index_key(scope), key)
+                    pipe.delete(key)
+        pipe.execute()
+
+    def remove_user(self, user_id):
+        member = self._member(user_id)
+        pipe = self.client.pipeline()
+        for key in self.client.smembers(self.index_key):
+            pipe.zrem(key, member)
+        pipe.execute()
+
+    def size(self, goal_id, achievement_date, scope=None):
+        return self.client.zcard(self._key(goal_id, achievement_date, scope))
+
+    def rank(self, goal_id, achievement_date, user_id, scope=None):
+        return self.client.zrevrank(self._key(goal_id, achievement_date, scope), self._member(user_id))
+
+    def get_range(self, goal_id, achievement_date, start, stop, scope=None):
+        start = max(0, start)
+        if stop <= start:
+            return []
+        items = self.client.zrevrange(self._key(goal_id, achievement_date, scope), start, stop - 1, withscores=True)
+        return [(start + i, int(member), value) for i, (member, value) in enumerate(items)]
+
+    def get_values(self, goal_id, achievement_date, user_ids, scope=None):
+        user_ids = [int(u) for u in user_ids]
+        pipe = self.client.pipeline()
+        key = self._key(goal_id, achievement_date, scope)
+        for user_id in user_ids:
+            pipe.zscore(key, self._member(user_id))
+        return {user_id: value for user_id, value in zip(user_ids, pipe.execute()) if value is not None}
+
+    def clear(self):
+        keys = list(self.client.smembers(self.index_key))
+        keys += list(self.client.keys(self._scope_index_key("*")))
+        if keys:
+            self.client.delete(*keys)
+        self.client.delete(self.index_key)
+
+
+_store = None
+_store_configured = False
+
+
+def setup_leaderboard_store(store):
+    """ This is used to override the leaderboard settings in the ini file. Needed for Testing. """
+    global _store, _store_configured
+    _store = store
+    _store_configured = True
+
+
+def get_leaderboard_store():
+    """return the configured store or None if the leaderboards are computed from the database.
+
+    settings:
+        leaderboard.backend = memory | redis
+        leaderboard.redis_url = redis://127.0.0.1:6379/0
+    """
+    global _store, _store_configured
+    if not _store_configured:
+        settings = get_settings() or {}
+        backend = settings.get("leaderboard.backend")
+        if backend == "memory":
+            _store = MemoryLeaderboardStore()
+        elif backend == "redis":
+            client = redis.StrictRedis.from_url(settings.get("leaderboard.redis_url", "redis://127.0.0.1:6379/0"))
+            _store = RedisLeaderboardStore(client, prefix=settings.get("leaderboard.redis_prefix", "gengine_leaderboard"))
+        _store_configured = True
+    return _store
@@ -6,6 +6,7 @@ import logging
 from datetime import timedelta
 
 import hashlib
+import uuid
 import pytz
 import sqlalchemy.types as ty
 from sqlalchemy.dialects.postgresql import JSON
@@ -20,6 +21,7 @@ from gengine.base.model import ABase, exists_by_expr, datetime_trunc, calc_dista
 from gengine.app.cache import cache_general, cache_goal_evaluation, cache_achievement_eval, cache_achievements_users_levels, \
     cache_achievements_by_user_for_today, cache_translations
 from sqlalchemy import (
+    inspect as sa_inspect,
     Table,
     ForeignKey,
     func,
@@ -32,15 +34,21 @@ from sqlalchemy import (
 from sqlalchemy.dialects.postgresql import TIMESTAMP
 from sqlalchemy.orm import (
     mapper,
+    object_session,
+    Session,
     relationship as sa_relationship,
     backref as sa_backref
 )
 from sqlalchemy.sql import bindparam
 
+from gengine.base.locks import cache_lock, locked_get_or_create
 from gengine.base.settings import get_settings
 from gengine.metadata import Base, DBSession
 
-from gengine.app.formular import evaluate_condition, evaluate_value_expression, evaluate_string
+from gengine.app.formular import compile_condition, evaluate_value_expression, evaluate_value_expression_array, \
+    evaluate_string, FormularEvaluationException
+from gengine.app.leaderboard import get_leaderboard_store, city_scope, group_scope, parse_scope
+from dogpile.cache.api import NO_VALUE
 
 log = logging.getLogger(__name__)
 
@@ -52,9 +60,11 @@ t_users = Table("users", Base.metadata,
     Column("timezone", ty.String(), nullable=False, default="UTC"),
     Column("country", ty.String(), nullable=True, default=None),
     Column("region", ty.String(), nullable=True, default=None),
-    Column("city", ty.String(), nullable=True, default=None),
+    Column("city", ty.String(), nullable=True, default=None, index=True),
     Column("additional_public_data", JSON(), nullable=True, default=None),
     Column('created_at', ty.DateTime, nullable = False, default=datetime.datetime.utcnow),
+    # maintained by the events of UserMessage and set_messages_read
+    Column("unread_messages", ty.Integer, nullable=False, default=0, server_default='0'),
 )
 
 t_auth_users = Table("auth_users", Base.metadata,
@@ -104,7 +114,7 @@ t_groups = Table("groups", Base.metadata,
 
 t_users_groups = Table("users_groups", Base.metadata,
     Column('user_id', ty.BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key = True, nullable=False),
-    Column('group_id', ty.BigInteger, ForeignKey("groups.id", ondelete="CASCADE"), primary_key = True, nullable=False)
+    Column('group_id', ty.BigInteger, ForeignKey("groups.id", ondelete="CASCADE"), primary_key = True, nullable=False, index=True)
 )
 
 t_achievementcategories = Table('achievementcategories', Base.metadata,
@@ -126,7 +136,7 @@ t_achievements = Table('achievements', Base.metadata,
     Column('priority', ty.Integer, index=True, default=0),
     Column('evaluation', ty.Enum("immediately","daily","weekly","monthly","yearly","end", name="evaluation_types"), default="immediately", nullable=False),
     Column('evaluation_timezone', ty.String(), default=None, nullable=True),
-    Column('relevance',ty.Enum("global","friends","city","own", name="relevance_types"), default="own"),
+    Column('relevance',ty.Enum("global","friends","city","groups","own", name="relevance_types"), default="own"),
     Column('view_permission',ty.Enum("everyone", "own", name="achievement_view_permission"), default="everyone"),
     Column('created_at', ty.DateTime, nullable = False, default=datetime.datetime.utcnow),
 )
@@ -297,9 +307,34 @@ t_user_messages = Table('user_messages', Base.metadata,
     Column('user_id', ty.BigInteger, ForeignKey("users.id", ondelete="CASCADE"), index = True, nullable=False),
     Column('translation_id', ty.Integer, ForeignKey("translationvariables.id", ondelete="RESTRICT"), nullable = True),
     Column('params', JSON(), nullable=True, default={}),
+    # the texts of all languages, rendered when the message is created (messages don't change)
+    Column('rendered_text', JSON(), nullable=True),
     Column('is_read', ty.Boolean, index=True, default=False, nullable=False),
-    Column('has_been_pushed', ty.Boolean, index=True, default=True, server_default='0', nullable=False),
+    Column('has_been_pushed', ty.Boolean, default=True, server_default='0', nullable=False),
+    Column('push_attempts', ty.Integer, nullable=False, default=0, server_default='0'),
+    Column('push_retry_at', ty.DateTime(), nullable=True),
+    # the push_ids which have received the message, if it failed for other devices (they are skipped by the retries)
+    Column('pushed_devices', JSON(), nullable=True),
     Column('created_at', ty.DateTime(), nullable=False, default=datetime.datetime.utcnow, index=True),
+    # the inbox is paginated by (created_at, id) per user
+    Index("ix_user_messages_user_id_created_at_id", "user_id", "created_at", "id"),
+    # only the few unpushed messages are indexed for the push workers
+    Index("ix_user_messages_unpushed", "id", postgresql_where=text("NOT has_been_pushed")),
+)
+
+# old read messages are moved here (see UserMessage.archive_messages)
+t_user_messages_archive = Table('user_messages_archive', Base.metadata,
+    Column('id', ty.BigInteger, primary_key = True),
+    Column('user_id', ty.BigInteger, index = True, nullable=False),
+    Column('translation_id', ty.Integer, nullable = True),
+    Column('params', JSON(), nullable=True),
+    Column('rendered_text', JSON(), nullable=True),
+    Column('is_read', ty.Boolean, nullable=False),
+    Column('has_been_pushed', ty.Boolean, nullable=False),
+    Column('push_attempts', ty.Integer, nullable=False),
+    Column('push_retry_at', ty.DateTime(), nullable=True),
+    Column('pushed_devices', JSON(), nullable=True),
+    Column('created_at', ty.DateTime(), nullable=False, index=True),
 )
 
 t_goal_triggers = Table('goal_triggers', Base.metadata,
@@ -331,6 +366,26 @@ t_goal_trigger_step_executions = Table('goal_trigger_executions', Base.metadata,
     Index("ix_goal_trigger_executions_combined", "trigger_step_id","user_id","execution_level")
 )
 
+def get_generation_tokens(region, keys):
+    """return {key: token} of the generation counters with one get_multi, missing counters are created with one set_multi"""
+    keys = list(keys)
+    tokens = dict(zip(keys, region.get_multi(keys))) if keys else {}
+    missing = {}
+    for key, token in tokens.items():
+        if token is NO_VALUE:
+            # counters may have been evicted, a fresh token makes sure no outdated entry is reused
+            tokens[key] = missing[key] = uuid.uuid4().hex
+    if missing:
+        region.set_multi(missing)
+    return tokens
+
+def renew_generation_tokens(region, keys):
+    """replace the generation counters, all cache entries which include them in their keys are outdated"""
+    keys = list(keys)
+    if keys:
+        region.set_multi({key: uuid.uuid4().hex for key in keys})
+
+
 class AuthUser(ABase):
 
     @hybrid_property
@@ -464,6 +519,72 @@ class User(ABase):
             DBSession.execute(t_users.select().where(t_users.c.id.in_(user_ids))).fetchall()
         }
 
+    @classmethod
+    @cache_general.cache_on_arguments()
+    def get_friend_ids(cls, user_id):
+        """return the ids of the user's friends.
+
+        Together with :meth:`get_reverse_friend_ids` this is the cached adjacency of the friends graph,
+        it is kept up to date by :meth:`set_infos` and :meth:`delete_user`."""
+        return {x["to_id"] for x in DBSession.execute(select([t_users_users.c.to_id]).where(t_users_users.c.from_id==user_id)).fetchall()}
+
+    @classmethod
+    @cache_general.cache_on_arguments()
+    def get_reverse_friend_ids(cls, user_id):
+        """return the ids of all users which have this user as friend."""
+        return {x["from_id"] for x in DBSession.execute(select([t_users_users.c.from_id]).where(t_users_users.c.to_id==user_id)).fetchall()}
+
+    @classmethod
+    @cache_general.cache_on_arguments()
+    def get_leaderboard_scopes(cls, user_id):
+        """return the scopes of the city and group leaderboards the user is part of, groups are ordered by id.
+
+        see :mod:`gengine.app.leaderboard`"""
+        return cls.query_leaderboard_scopes(user_id)
+
+    @classmethod
+    def query_leaderboard_scopes(cls, user_id):
+        """uncached version of :meth:`get_leaderboard_scopes`"""
+        scopes = []
+        city = DBSession.execute(select([t_users.c.city]).where(t_users.c.id==user_id)).scalar()
+        if city:
+            scopes.append(city_scope(city))
+        scopes += [group_scope(x["group_id"]) for x in DBSession.execute(select([t_users_groups.c.group_id])
+                                                                           .where(t_users_groups.c.user_id==user_id)
+                                                                           .order_by(t_users_groups.c.group_id)).fetchall()]
+        return scopes
+
+    @classmethod
+    def get_scope_member_ids(cls, scope):
+        """return the ids of all users in the scope (the city or group)"""
+        kind, value = parse_scope(scope)
+        if kind == "city":
+            q = select([t_users.c.id.label("user_id")]).where(t_users.c.city==value)
+        else:
+            q = select([t_users_groups.c.user_id]).where(t_users_groups.c.group_id==int(value))
+        return {x["user_id"] for x in DBSession.execute(q).fetchall()}
+
+    @classmethod
+    def update_leaderboard_scopes(cls, user_id, scopes_before):
+        """move the user between the scoped leaderboards, if the city or groups have changed.
+
+        The scopes are read in the transaction, the caches and the leaderboard store are updated after the commit."""
+        scopes_after = set(User.query_leaderboard_scopes(user_id))
+        removed_scopes = set(scopes_before) - scopes_after
+        added_scopes = scopes_after - set(scopes_before)
+        if len(removed_scopes)>0 or len(added_scopes)>0:
+            if get_leaderboard_store() is not None:
+                queue_leaderboard_write("update_scopes", user_id, removed_scopes, added_scopes)
+            queue_scope_invalidation(user_id, removed_scopes|added_scopes)
+
+    @classmethod
+    def invalidate_friend_caches(cls, forward_user_ids=(), reverse_user_ids=()):
+        """invalidate the friend caches now (for the rest of the transaction) and again after the commit or rollback,
+        as other processes may have cached the rows of before the commit meanwhile"""
+        items = {("friends", uid) for uid in forward_user_ids} | {("reverse_friends", uid) for uid in reverse_user_ids}
+        invalidate_friend_caches(items)
+        DBSession().info.setdefault("friend_invalidations", set()).update(items)
+
     @classmethod
     def get_cache_expiration_time_for_today(cls,user):
         """return the seconds until the day of the user ends (timezone of the user).
@@ -481,6 +602,8 @@ class User(ABase):
         """set the user's metadata like friends,location and timezone"""
 
 
+        scopes_before = User.get_leaderboard_scopes(user_id)
+
         new_friends_set = set(friends)
         existing_users_set = {x["id"] for x in DBSession.execute(select([t_users.c.id]).where(t_users.c.id.in_([user_id,]+friends))).fetchall()}
         existing_friends = {x["to_id"] for x in DBSession.execute(select([t_users_users.c.to_id]).where(t_users_users.c.from_id==user_id)).fetchall()}
@@ -534,6 +657,10 @@ class User(ABase):
         if len(friends_to_append)>0:
             update_connection().execute(t_users_users.insert(),[{"from_id":user_id,"to_id":f} for f in friends_to_append])
 
+        #update the cached friends graph
+        if len(friends_to_delete)>0 or len(friends_to_append)>0:
+            User.invalidate_friend_caches(forward_user_ids={user_id,}, reverse_user_ids=friends_to_delete|friends_to_append)
+
         #GROUPS
 
         #insert missing groups in group table
@@ -549,9 +676,16 @@ class User(ABase):
         if len(groups_to_append)>0:
             update_connection().execute(t_users_groups.insert(),[{"user_id":user_id,"group_id":f} for f in groups_to_append])
 
+        #the city and group leaderboards are maintained incrementally
+        User.update_leaderboard_scopes(user_id, scopes_before)
+
     @classmethod
     def delete_user(cls,user_id):
         """delete a user including all dependencies."""
+        friend_ids = User.get_friend_ids(user_id)
+        reverse_friend_ids = User.get_reverse_friend_ids(user_id)
+        scopes = User.get_leaderboard_scopes(user_id)
+
         update_connection().execute(t_achievements_users.delete().where(t_achievements_users.c.user_id==user_id))
         update_connection().execute(t_goal_evaluation_cache.delete().where(t_goal_evaluation_cache.c.user_id==user_id))
         update_connection().execute(t_users_users.delete().where(t_users_users.c.to_id==user_id))
@@ -560,6 +694,13 @@ class User(ABase):
         update_connection().execute(t_values.delete().where(t_values.c.user_id==user_id))
         update_connection().execute(t_users.delete().where(t_users.c.id==user_id))
 
+        User.invalidate_friend_caches(forward_user_ids=reverse_friend_ids|{user_id,},
+                                      reverse_user_ids=friend_ids|{user_id,})
+        queue_scope_invalidation(user_id, scopes)
+
+        if get_leaderboard_store() is not None:
+            queue_leaderboard_write("remove_user", user_id)
+
     @classmethod
     def basic_output(cls, user):
         return {
@@ -782,28 +923,36 @@ class Achievement(ABase):
         This is needed as achievements may be limited to a specific time (e.g. only during holidays)
         """
 
+        generation = Achievement.get_list_generation()
+
         def generate_achievements_by_user_for_today():
             today = datetime.date.today()
-            by_loc = {x["id"] : x["distance"] for x in cls.get_achievements_by_location(coords(user))}
-            by_date = cls.get_achievements_by_date(today)
+            by_loc = {x["id"] : x["distance"] for x in cls.get_achievements_by_location(coords(user), generation)}
+            by_date = cls.get_achievements_by_date(today, generation)
             def update(arr,distance):
                 arr["distance"]=distance
                 return arr
 
             return [update(arr,by_loc[arr["id"]]) for arr in by_date if arr["id"] in by_loc]
 
-        key = str(user["id"])
+        key = "%s_%s" % (user["id"], generation)
         expiration_time = User.get_cache_expiration_time_for_today(user)
 
         return cache_achievements_by_user_for_today.get_or_create(key,generate_achievements_by_user_for_today, expiration_time=expiration_time)
 
+    @classmethod
+    def get_list_generation(cls):
+        """return the version of the achievement lists, which changes whenever an achievement or goal definition is edited"""
+        return get_generation_tokens(cache_achievements_by_user_for_today, ["generation_lists"])["generation_lists"]
+
     #We need to fetch all achievement data in one of these methods -> by_date is just queried once a date
 
     @classmethod
     @cache_general.cache_on_arguments()
-    def get_achievements_by_location(cls,latlng):
-        """return achievements which are valid in that location."""
-        #TODO: invalidate automatically when achievement in user's range is modified
+    def get_achievements_by_location(cls,latlng,generation=None):
+        """return achievements which are valid in that location.
+
+        generation (see :meth:`get_list_generation`) is only part of the cache key."""
         distance = calc_distance(latlng, (t_achievements.c.lat, t_achievements.c.lng)).label("distance")
         q = select([t_achievements.c.id,
                     distance])\
@@ -814,8 +963,10 @@ class Achievement(ABase):
 
     @classmethod
     @cache_general.cache_on_arguments()
-    def get_achievements_by_date(cls,date):
-        """return achievements which are valid at that date"""
+    def get_achievements_by_date(cls,date,generation=None):
+        """return achievements which are valid at that date
+
+        generation (see :meth:`get_list_generation`) is only part of the cache key."""
         q = t_achievements.select().where(and_(or_(t_achievements.c.valid_start==None,
                                                           t_achievements.c.valid_start<=date),
                                                or_(t_achievements.c.valid_end==None,
@@ -824,40 +975,71 @@ class Achievement(ABase):
 
         return [dict(x.items()) for x in DBSession.execute(q).fetchall() if len(Goal.get_goals(x['id']))>0]
 
-    #TODO:CACHE
     @classmethod
     def get_relevant_users_by_achievement_and_user(cls,achievement,user_id):
         """return all relevant other users for the leaderboard.
 
-        depends on the "relevance" attribute of the achivement, can be "friends" or "city" (city is still a todo)
+        depends on the "relevance" attribute of the achivement, can be "friends", "city", "groups" (the first group of the user) or "global"
         """
         # this is needed to compute the leaderboards
         users=[user_id,]
-        if achievement["relevance"]=="city":
-            #TODO
-            pass
+        if achievement["relevance"]=="city" or achievement["relevance"]=="groups":
+            scope = Achievement.get_leaderboard_scope(achievement, user_id)
+            if scope is not None:
+                users += list(User.get_scope_member_ids(scope))
         elif achievement["relevance"]=="friends":
-            users += [x["to_id"] for x in DBSession.execute(select([t_users_users.c.to_id,], t_users_users.c.from_id==user_id)).fetchall()]
+            users += list(User.get_friend_ids(user_id))
         elif achievement["relevance"] == "global":
             users += [x.id for x in DBSession.execute(select([t_users.c.id,])).fetchall()]
         return set(users)
 
-    #TODO:CACHE
     @classmethod
     def get_relevant_users_by_achievement_and_user_reverse(cls,achievement,user_id):
         """return all users which have this user as friends and are relevant for this achievement.
 
         the reversed version is needed to know in whose contact list the user is. when the user's value is updated, all the leaderboards of these users need to be regenerated"""
         users=[user_id,]
-        if achievement["relevance"]=="city":
-            #TODO
-            pass
+        if achievement["relevance"]=="city" or achievement["relevance"]=="groups":
+            for scope in Achievement.get_scopes_by_relevance(achievement, user_id):
+                users += list(User.get_scope_member_ids(scope))
         elif achievement["relevance"]=="friends":
-            users += [x["from_id"] for x in DBSession.execute(select([t_users_users.c.from_id,], t_users_users.c.to_id==user_id)).fetchall()]
+            users += list(User.get_reverse_friend_ids(user_id))
         elif achievement["relevance"] == "global":
             users += [x.id for x in DBSession.execute(select([t_users.c.id, ])).fetchall()]
         return set(users)
 
+    @classmethod
+    def get_scopes_by_relevance(cls, achievement, user_id, user_scopes=None):
+        """return the user's scopes which match the relevance of the achievement ("city" or "groups")
+
+        user_scopes may be passed if they are already known (see :meth:`User.get_leaderboard_scopes`)"""
+        kind = {"city": "city", "groups": "group"}.get(achievement["relevance"])
+        if kind is None:
+            return []
+        if user_scopes is None:
+            user_scopes = User.get_leaderboard_scopes(user_id)
+        return [scope for scope in user_scopes if parse_scope(scope)[0] == kind]
+
+    @classmethod
+    def get_leaderboard_scope(cls, achievement, user_id, user_scopes=None):
+        """return the scope of the user's leaderboard for city and groups relevance, for groups this is the group with the lowest id."""
+        scopes = Achievement.get_scopes_by_relevance(achievement, user_id, user_scopes)
+        return scopes[0] if len(scopes)>0 else None
+
+    @classmethod
+    def get_leaderboard_users_and_scope(cls, achievement, user_id, scope=None):
+        """return (user_ids, scope) which define the user's leaderboard for the achievement.
+
+        user_ids is None for global and scoped leaderboards (which are served from partitioned rank structures)."""
+        if achievement["relevance"] == "global":
+            return None, None
+        if achievement["relevance"] == "city" or achievement["relevance"] == "groups":
+            scope = scope or Achievement.get_leaderboard_scope(achievement, user_id)
+            if scope is not None:
+                return None, scope
+            return {user_id}, None
+        return Achievement.get_relevant_users_by_achievement_and_user(achievement, user_id), None
+
     @classmethod
     def get_level(cls, user_id, achievement_id, achievement_date):
         """get the current level of the user for this achievement."""
@@ -910,7 +1092,7 @@ class Achievement(ABase):
             out["levels"] = {
                 str(i) : {
                     "level" : i,
-                    "goals" : { str(g["id"]) : Goal.basic_goal_output(g,i) for g in goals},
+                    "goals" : { str(g["id"]) : Goal.basic_goal_output(g["id"],i) for g in goals},
                     "rewards" : {str(r["id"]) : {
                         "id" : r["id"],
                         "reward_id" : r["reward_id"],
@@ -928,16 +1110,23 @@ class Achievement(ABase):
         return out
 
     @classmethod
-    def evaluate(cls, user, achievement_id, achievement_date, execute_triggers=True):
+    def evaluate(cls, user, achievement_id, achievement_date, execute_triggers=True, batch=None, serve_stale=None, read_only=False):
         """evaluate the achievement including all its subgoals for the user.
 
            return the basic_output for the achievement plus information about the new achieved levels
+
+           batch is an optional :class:`EvaluationBatch`, which has prefetched the cache entries.
+           serve_stale=False waits for a concurrent evaluation instead of returning the previous one (see :func:`gengine.base.locks.cache_lock`),
+           new levels must not be lost after an increase.
+           read_only=True (used for warming) neither inserts levels nor executes triggers, if the user reaches a new level
+           nothing is cached and None is returned, the level is reached at the next evaluation.
         """
         def generate():
             achievement = Achievement.get_achievement(achievement_id)
 
             user_id = user["id"]
-            user_ids = Achievement.get_relevant_users_by_achievement_and_user(achievement, user_id)
+            # global and scoped leaderboards are not filtered by user, we don't need to load all users
+            user_ids, scope = Achievement.get_leaderboard_users_and_scope(achievement, user_id)
 
             user_has_level = Achievement.get_level_int(user_id, achievement["id"], achievement_date)
             user_wants_level = min((user_has_level or 0)+1, achievement["maxlevel"])
@@ -946,18 +1135,12 @@ class Achievement(ABase):
             all_goals_achieved = True
             goals = Goal.get_goals(achievement["id"])
             for goal in goals:
-                goal_eval = Goal.get_goal_eval_cache(goal["id"], achievement_date, user_id)
+                goal_eval = Goal.get_goal_eval_cache(goal["id"], achievement_date, user_id, batch=batch)
                 if not goal_eval:
-                    Goal.evaluate(goal, achievement, achievement_date, user, user_wants_level,None, execute_triggers=execute_triggers)
-                    goal_eval = Goal.get_goal_eval_cache(goal["id"], achievement_date, user_id)
+                    goal_eval = Goal.evaluate_with_lock(goal, achievement, achievement_date, user, user_wants_level, execute_triggers=execute_triggers and not read_only)
 
-                if achievement["relevance"]=="friends" or achievement["relevance"]=="city" or achievement["relevance"]=="global":
-                    goal_eval["leaderboard"] = Goal.get_leaderboard(goal, achievement_date, user_ids)
-                    own_filter = list(filter(lambda x: x["user"]["id"] == user_id, goal_eval["leaderboard"]))
-                    if len(own_filter)>0:
-                        goal_eval["leaderboard_position"] = own_filter[0]["position"]
-                    else:
-                        goal_eval["leaderboard_position"] = None
+                if achievement["relevance"] in ("friends", "city", "groups", "global"):
+                    goal_eval.update(Goal.get_embedded_leaderboard(goal, achievement_date, user_ids, user_id, scope=scope))
 
                 goal_evals[goal["id"]]=goal_eval
                 if not goal_eval["achieved"]:
@@ -968,6 +1151,8 @@ class Achievement(ABase):
             full_output = True # will be false, if the full basic_output is generated in a recursion step
 
             if all_goals_achieved and user_has_level < achievement["maxlevel"]:
+                if read_only:
+                    return None
                 #NEW LEVEL YEAH!
 
                 new_level_output = {
@@ -1035,16 +1220,189 @@ class Achievement(ABase):
 
             return output
 
-        #TODO ACHIEVEMENT
-        return cache_achievement_eval.get_or_create("%s_%s_%s" % (user["id"],achievement_id,achievement_date),generate)
+        if batch is not None and batch.contains(achievement_id, achievement_date):
+            return batch.get_or_create(achievement_id, achievement_date, generate, serve_stale=serve_stale)
+
+        achievement = Achievement.get_achievement(achievement_id)
+        generation = Achievement.get_evaluation_generation(achievement, achievement_date, user["id"])
+        if read_only:
+            key = Achievement.get_evaluate_cache_key(user["id"], achievement_id, achievement_date, generation)
+            output = cache_achievement_eval.get(key)
+            if output is NO_VALUE:
+                output = generate()
+                if output is not None:
+                    cache_achievement_eval.set_multi({key: output,
+                                                      Achievement.get_stale_evaluate_cache_key(user["id"], achievement_id, achievement_date): output})
+            return output
+
+        # only one process evaluates the achievement for the user, the others get the previous evaluation meanwhile
+        return locked_get_or_create(cache_achievement_eval,
+                                    Achievement.get_evaluate_cache_key(user["id"], achievement_id, achievement_date, generation),
+                                    generate,
+                                    stale_key=Achievement.get_stale_evaluate_cache_key(user["id"], achievement_id, achievement_date),
+                                    serve_stale=serve_stale)
+
+    @classmethod
+    def locked_output(cls, user, achievement, achievement_date):
+        """the output of an achievement which is locked by requirements or denials, its goals are not evaluated"""
+        user_has_level = Achievement.get_level_int(user["id"], achievement["id"], achievement_date)
+        output = Achievement.basic_output(achievement, Goal.get_goals(achievement["id"]), True, max_level_included=user_has_level+1)
+        output.update({
+            "level" : user_has_level,
+            "levels_achieved" : {
+                str(x["level"]) : x["updated_at"] for x in Achievement.get_level(user["id"], achievement["id"], achievement_date)
+            },
+            "maxlevel" : achievement["maxlevel"],
+            "new_levels" : {},
+            "goals" : {},
+            "achievement_date" : achievement_date,
+            "locked" : True,
+        })
+        return output
+
+    @classmethod
+    def get_evaluate_cache_key(cls, user_id, achievement_id, achievement_date, generation):
+        return "%s_%s_%s_%s" % (user_id, achievement_id, achievement_date, generation)
+
+    @classmethod
+    def get_stale_evaluate_cache_key(cls, user_id, achievement_id, achievement_date):
+        """the latest evaluation of any generation"""
+        return "latest_%s_%s_%s" % (user_id, achievement_id, achievement_date)
+
+    @classmethod
+    @cache_general.cache_on_arguments()
+    def get_achievement_dependencies(cls):
+        """return a map from achievement_id to {"requirements":[achievement_ids],"denials":[achievement_ids]}.
+
+        An achievement is only relevant for a user, if the user has reached all its requirements and none of its denials.
+        """
+        m = {}
+
+        def entry(achievement_id):
+            if not achievement_id in m:
+                m[achievement_id] = {"requirements": [], "denials": []}
+            return m[achievement_id]
+
+        for row in DBSession.execute(t_requirements.select()).fetchall():
+            entry(row["from_id"])["requirements"].append(row["to_id"])
+        for row in DBSession.execute(t_denials.select()).fetchall():
+            entry(row["from_id"])["denials"].append(row["to_id"])
+        return m
+
+    @classmethod
+    def sort_by_dependencies(cls, achievements, dependencies):
+        """return the achievements in topological order, i.e. requirements and denials are evaluated before the achievements which depend on them.
+
+        The original order is kept where possible. Achievements which are part of a cycle are appended in their original order.
+        """
+        ids = [a["id"] for a in achievements]
+        id_set = set(ids)
+        by_id = {a["id"]: a for a in achievements}
+
+        depends_on = {}
+        for achievement_id in ids:
+            deps = dependencies.get(achievement_id, {})
+            depends_on[achievement_id] = {x for x in deps.get("requirements", []) + deps.get("denials", [])
+                                          if x in id_set and x != achievement_id}
+
+        ordered = []
+        done = set()
+        progress = True
+        while progress:
+            progress = False
+            for achievement_id in ids:
+                if achievement_id not in done and depends_on[achievement_id] <= done:
+                    ordered.append(by_id[achievement_id])
+                    done.add(achievement_id)
+                    progress = True
+
+        ordered += [by_id[x] for x in ids if x not in done]
+        return ordered
+
+    @classmethod
+    def get_reached_achievement_ids(cls, user_id, achievement_ids):
+        """return the subset of achievement_ids in which the user has reached at least one level."""
+        if not achievement_ids:
+            return set()
+        q = select([t_achievements_users.c.achievement_id]).distinct()\
+            .where(and_(t_achievements_users.c.user_id == user_id,
+                        t_achievements_users.c.achievement_id.in_(achievement_ids)))
+        return {x["achievement_id"] for x in DBSession.execute(q).fetchall()}
+
+    @classmethod
+    def is_unlocked(cls, achievement_id, dependencies, reached_achievement_ids):
+        """check the requirements and denials of the achievement against the achievements reached by the user."""
+        deps = dependencies.get(achievement_id)
+        if not deps:
+            return True
+        if not set(deps["requirements"]) <= reached_achievement_ids:
+            return False
+        if set(deps["denials"]) & reached_achievement_ids:
+            return False
+        return True
+
+    @classmethod
+    def get_generation_keys(cls, achievement, achievement_date, user_id, friend_ids=None, user_scopes=None):
+        """return the keys of the generation counters the evaluation of the achievement for the user depends on.
+
+        Global leaderboards share one counter, city and group leaderboards one counter per scope plus a counter
+        for the scope's members. Otherwise there is one counter per user (the user and his friends for friends relevance).
+        """
+        prefix = "generation_%s_%s" % (achievement["id"], achievement_date)
+        definition_key = Achievement.get_definition_generation_key(achievement["id"])
+        if achievement["relevance"] == "global":
+            return [prefix + "_global", definition_key]
+        user_ids = {user_id}
+        if achievement["relevance"] == "friends":
+            user_ids |= (friend_ids if friend_ids is not None else User.get_friend_ids(user_id))
+        keys = ["%s_user_%s" % (prefix, uid) for uid in sorted(user_ids)]
+        scope = Achievement.get_leaderboard_scope(achievement, user_id, user_scopes)
+        if scope is not None:
+            keys += ["%s_scope_%s" % (prefix, scope), "generation_scope_%s" % (scope,)]
+        return keys + [definition_key]
+
+    @classmethod
+    def get_definition_generation_key(cls, achievement_id):
+        """the counter which is replaced when the definition of the achievement (or of its goals, rewards, properties, translations) is edited"""
+        return "generation_definition_%s" % (achievement_id,)
+
+    @classmethod
+    def get_evaluation_generation(cls, achievement, achievement_date, user_id):
+        """return the version of the user's evaluation cache entry, which changes whenever one of its generation counters is replaced."""
+        keys = Achievement.get_generation_keys(achievement, achievement_date, user_id)
+        return Achievement.get_evaluation_generations([keys])[0]
+
+    @classmethod
+    def get_evaluation_generations(cls, keys_lists):
+        """return the versions for several lists of generation keys with one get_multi (and one set_multi for missing counters)."""
+        tokens = get_generation_tokens(cache_achievement_eval, {key for keys in keys_lists for key in keys})
+
+        generations = []
+        for keys in keys_lists:
+            if len(keys) == 1:
+                generations.append(tokens[keys[0]])
+            else:
+                generations.append(hashlib.sha1("|".join(tokens[key] for key in keys).encode("utf-8")).hexdigest())
+        return generations
 
     @classmethod
     def invalidate_evaluate_cache(cls,user_id,achievement, achievement_date):
-        """invalidate the evaluation cache for all goals of this achievement for the user."""
+        """invalidate the evaluation cache of this achievement for the user and all users whose leaderboards contain the user.
 
-        #We neeed to invalidate for all relevant users because of the leaderboards
-        for uid in Achievement.get_relevant_users_by_achievement_and_user_reverse(achievement, user_id):
-            cache_achievement_eval.delete("%s_%s_%s" % (uid, achievement["id"], achievement_date))
+        Instead of deleting the entries of all these users, the generation counters of the user and his scopes (or of the global leaderboard) are replaced.
+        """
+        prefix = "generation_%s_%s" % (achievement["id"], achievement_date)
+        if achievement["relevance"] == "global":
+            keys = [prefix + "_global"]
+        else:
+            keys = ["%s_user_%s" % (prefix, user_id)]
+            keys += ["%s_scope_%s" % (prefix, scope) for scope in Achievement.get_scopes_by_relevance(achievement, user_id)]
+        renew_generation_tokens(cache_achievement_eval, keys)
+
+    @classmethod
+    def invalidate_scope_evaluate_caches(cls, scopes):
+        """invalidate the evaluation caches of all users in the scopes, e.g. after a user joined or left them."""
+        renew_generation_tokens(cache_achievement_eval, ["generation_scope_%s" % (scope,) for scope in scopes])
 
     @classmethod
     @cache_general.cache_on_arguments()
@@ -1149,6 +1507,81 @@ class Achievement(ABase):
         return t.astimezone(tzobj)
 
 
+class EvaluationBatch(object):
+    """collects the cache keys of a user's progress and fetches them with a constant number of cache round trips.
+
+    usage::
+
+        batch = EvaluationBatch(user, [(achievement, achievement_date), ...])
+        for achievement, achievement_date in ...:
+            Achievement.evaluate(user, achievement["id"], achievement_date, batch=batch)
+
+    Missing evaluations are created and stored one by one, while their lock is held (see :func:`gengine.base.locks.locked_get_or_create`).
+    """
+
+    def __init__(self, user, achievements_with_dates):
+        self.user = user
+        self.keys = {}
+        self.outputs = {}
+        self.goal_evals = {}
+        self.goal_generations = {}
+        self.prefetch(achievements_with_dates)
+
+    def prefetch(self, achievements_with_dates):
+        user_id = self.user["id"]
+        achievements_with_dates = list(achievements_with_dates)
+        if len(achievements_with_dates) == 0:
+            return
+
+        relevances = {a["relevance"] for a, d in achievements_with_dates}
+        friend_ids = User.get_friend_ids(user_id) if "friends" in relevances else set()
+        user_scopes = User.get_leaderboard_scopes(user_id) if relevances & {"city", "groups"} else []
+
+        generations = Achievement.get_evaluation_generations([
+            Achievement.get_generation_keys(a, d, user_id, friend_ids=friend_ids, user_scopes=user_scopes)
+            for a, d in achievements_with_dates
+        ])
+        for (a, d), generation in zip(achievements_with_dates, generations):
+            self.keys[(a["id"], d)] = Achievement.get_evaluate_cache_key(user_id, a["id"], d, generation)
+
+        keys = list(self.keys.values())
+        missed = set()
+        for key, value in zip(keys, cache_achievement_eval.get_multi(keys)):
+            if value is NO_VALUE:
+                missed.add(key)
+            else:
+                self.outputs[key] = value
+
+        # the goal evaluations are only needed for the achievements which have to be evaluated
+        goal_ids_with_dates = [(goal["id"], d)
+                               for a, d in achievements_with_dates if self.keys[(a["id"], d)] in missed
+                               for goal in Goal.get_goals(a["id"])]
+        self.goal_generations = Goal.get_definition_generations({goal_id for goal_id, d in goal_ids_with_dates})
+        goal_keys = [Goal.get_goal_eval_cache_key(goal_id, d, user_id, self.goal_generations[goal_id])
+                     for goal_id, d in goal_ids_with_dates]
+        if len(goal_keys) > 0:
+            for key, value in zip(goal_keys, cache_goal_evaluation.get_multi(goal_keys)):
+                self.goal_evals[key] = value if value is not NO_VALUE else None
+
+    def contains(self, achievement_id, achievement_date):
+        return (achievement_id, achievement_date) in self.keys
+
+    def get_or_create(self, achievement_id, achievement_date, creator, serve_stale=None):
+        key = self.keys[(achievement_id, achievement_date)]
+        if key not in self.outputs:
+            stale_key = Achievement.get_stale_evaluate_cache_key(self.user["id"], achievement_id, achievement_date)
+            self.outputs[key] = locked_get_or_create(cache_achievement_eval, key, creator, stale_key=stale_key, known_missing=True,
+                                                     serve_stale=serve_stale)
+        return self.outputs[key]
+
+    def has_goal_eval(self, key):
+        return key in self.goal_evals
+
+    def pop_goal_eval(self, key):
+        """prefetched goal evaluations are used only once, later reads (e.g. after the goal caches have been cleared) go to the cache"""
+        return self.goal_evals.pop(key)
+
+
 class AchievementProperty(ABase):
     """A AchievementProperty describes the :class:`Achievement`s of our system.
 
@@ -1214,6 +1647,11 @@ class Goal(ABase):
         else:
             return self.name + " (ID: %s)" % (self.id,)
 
+    @classmethod
+    @cache_general.cache_on_arguments()
+    def get_goal(cls,goal_id):
+        return DBSession.execute(t_goals.select().where(t_goals.c.id==goal_id)).fetchone()
+
     @classmethod
     @cache_general.cache_on_arguments()
     def get_goals(cls,achievement_id):
@@ -1237,109 +1675,113 @@ class Goal(ABase):
 
         """
 
-        user_id = user["id"]
+        # TODO: Cache the statement / Make it serializable for caching in redis
+        q = Goal.get_progress_query(goal, achievement, evaluation_date)
+
+        return DBSession.execute(q, {'user_id' : user["id"]})
+
+    @classmethod
+    def get_progress_query(cls, goal, achievement, evaluation_date, user_filter=None):
+        """the statement of :meth:`compute_progress`, which selects (user_id, value) of the users matching user_filter
+        (a condition on the values table, default: values.user_id = :user_id)"""
+
         timezone = achievement["evaluation_timezone"]
+        if user_filter is None:
+            user_filter = t_values.c.user_id==bindparam("user_id")
+
+        condition = compile_condition(goal["condition"])
+        group_by_dateformat = goal["group_by_dateformat"]
+        group_by_key = goal["group_by_key"]
+        timespan = goal["timespan"]
+        maxmin = goal["maxmin"]
+        evaluation_type = achievement["evaluation"]
+
+        #prepare
+        select_cols=[func.sum(t_values.c.value).label("value"),
+                     t_values.c.user_id]
+
+        j = t_values.join(t_variables)
+
+        #    # We need to access the user's timezone later
+        j = j.join(t_users)
+
+        datetime_col=None
+        if group_by_dateformat:
+            # here we need to convert to users' time zone, as we might need to group by e.g. USER's weekday
+            if timezone:
+                datetime_col = func.to_char(text("values.datetime AT TIME ZONE '%s'" % (timezone,)), group_by_dateformat).label("datetime")
+            else:
+                datetime_col = func.to_char(text("values.datetime AT TIME ZONE users.timezone"),
+                                            group_by_dateformat).label("datetime")
+            select_cols.append(datetime_col)
 
-        def generate_statement_cache():
-            condition = evaluate_condition(goal["condition"], column_variable = t_variables.c.name.label("variable_name"),
-                                                              column_key = t_values.c.key)
-            group_by_dateformat = goal["group_by_dateformat"]
-            group_by_key = goal["group_by_key"]
-            timespan = goal["timespan"]
-            maxmin = goal["maxmin"]
-            evaluation_type = achievement["evaluation"]
-
-            #prepare
-            select_cols=[func.sum(t_values.c.value).label("value"),
-                         t_values.c.user_id]
-
-            j = t_values.join(t_variables)
-
-            #    # We need to access the user's timezone later
-            j = j.join(t_users)
-
-            datetime_col=None
-            if group_by_dateformat:
-                # here we need to convert to users' time zone, as we might need to group by e.g. USER's weekday
-                if timezone:
-                    datetime_col = func.to_char(text("values.datetime AT TIME ZONE '%s'" % (timezone,)), group_by_dateformat).label("datetime")
-                else:
-                    datetime_col = func.to_char(text("values.datetime AT TIME ZONE users.timezone"),
-                                                group_by_dateformat).label("datetime")
-                select_cols.append(datetime_col)
-
-            if group_by_key:
-                select_cols.append(t_values.c.key)
-
-            #build query
-            q = select(select_cols,
-                       from_obj=j)\
-               .where(t_values.c.user_id==bindparam("user_id"))\
-               .group_by(t_values.c.user_id)
-
-            if condition is not None:
-                q = q.where(condition)
-
-            if timespan:
-                #here we can use the utc time
-                q = q.where(t_values.c.datetime>=datetime.datetime.utcnow()-datetime.timedelta(days=timespan))
-
-            if evaluation_type!="immediately":
-
-                achievement_date = Achievement.get_datetime_for_evaluation_type(timezone, evaluation_type, evaluation_date)
-                if evaluation_type=="daily":
-                    q = q.where(and_(
-                        t_values.c.datetime >= achievement_date,
-                        t_values.c.datetime < achievement_date + datetime.timedelta(days=1))
-                    )
-                elif evaluation_type=="weekly":
-                    q = q.where(and_(
-                        t_values.c.datetime >= achievement_date,
-                        t_values.c.datetime < achievement_date + datetime.timedelta(days=7))
-                    )
-                elif evaluation_type=="monthly":
-                    next_month = Achievement.get_datetime_for_evaluation_type(timezone, "monthly", achievement_date + datetime.timedelta(days=32))
-                    q = q.where(and_(
-                        t_values.c.datetime >= achievement_date,
-                        t_values.c.datetime < next_month)
-                    )
-                elif evaluation_type=="yearly":
-                    next_year = Achievement.get_datetime_for_evaluation_type(timezone, "yearly", achievement_date + datetime.timedelta(days=366))
-                    q = q.where(and_(
-                        t_values.c.datetime >= achievement_date,
-                        t_values.c.datetime < next_year)
-                    )
-                elif evaluation_type == "end":
-                    pass
-                    #Todo implement for end
-
-            if datetime_col is not None or group_by_key is not False:
-                if datetime_col is not None:
-                    q = q.group_by(datetime_col)
-
-                if group_by_key is not False:
-                    q = q.group_by(t_values.c.key)
-                query_with_groups = q.alias()
-
-                select_cols2 = [query_with_groups.c.user_id]
-
-                if maxmin=="min":
-                    select_cols2.append(func.min(query_with_groups.c.value).label("value"))
-                else:
-                    select_cols2.append(func.max(query_with_groups.c.value).label("value"))
+        if group_by_key:
+            select_cols.append(t_values.c.key)
+
+        #build query
+        q = select(select_cols,
+                   from_obj=j)\
+           .where(user_filter)\
+           .group_by(t_values.c.user_id)
 
-                combined_user_query = select(select_cols2,from_obj=query_with_groups)\
-                                      .group_by(query_with_groups.c.user_id)
+        if condition is not None:
+            q = q.where(condition)
 
-                return combined_user_query
+        if timespan:
+            #here we can use the utc time
+            q = q.where(t_values.c.datetime>=datetime.datetime.utcnow()-datetime.timedelta(days=timespan))
+
+        if evaluation_type!="immediately":
+
+            achievement_date = Achievement.get_datetime_for_evaluation_type(timezone, evaluation_type, evaluation_date)
+            if evaluation_type=="daily":
+                q = q.where(and_(
+                    t_values.c.datetime >= achievement_date,
+                    t_values.c.datetime < achievement_date + datetime.timedelta(days=1))
+                )
+            elif evaluation_type=="weekly":
+                q = q.where(and_(
+                    t_values.c.datetime >= achievement_date,
+                    t_values.c.datetime < achievement_date + datetime.timedelta(days=7))
+                )
+            elif evaluation_type=="monthly":
+                next_month = Achievement.get_datetime_for_evaluation_type(timezone, "monthly", achievement_date + datetime.timedelta(days=32))
+                q = q.where(and_(
+                    t_values.c.datetime >= achievement_date,
+                    t_values.c.datetime < next_month)
+                )
+            elif evaluation_type=="yearly":
+                next_year = Achievement.get_datetime_for_evaluation_type(timezone, "yearly", achievement_date + datetime.timedelta(days=366))
+                q = q.where(and_(
+                    t_values.c.datetime >= achievement_date,
+                    t_values.c.datetime < next_year)
+                )
+            elif evaluation_type == "end":
+                pass
+                #Todo implement for end
+
+        if datetime_col is not None or group_by_key is not False:
+            if datetime_col is not None:
+                q = q.group_by(datetime_col)
+
+            if group_by_key is not False:
+                q = q.group_by(t_values.c.key)
+            query_with_groups = q.alias()
+
+            select_cols2 = [query_with_groups.c.user_id]
+
+            if maxmin=="min":
+                select_cols2.append(func.min(query_with_groups.c.value).label("value"))
             else:
-                return q
+                select_cols2.append(func.max(query_with_groups.c.value).label("value"))
 
-        #q = cache_goal_statements.get_or_create(str(goal["id"]),generate_statement_cache)
-        # TODO: Cache the statement / Make it serializable for caching in redis
-        q = generate_statement_cache()
+            combined_user_query = select(select_cols2,from_obj=query_with_groups)\
+                                  .group_by(query_with_groups.c.user_id)
+
+            return combined_user_query
+        else:
+            return q
 
-        return DBSession.execute(q, {'user_id' : user_id})
 
     @classmethod
     def evaluate(cls, goal, achievement, achievement_date, user, level, goal_eval_cache_before=False, execute_triggers=True):
@@ -1362,10 +1804,7 @@ class Goal(ABase):
         if goal_eval_cache_before is None or goal_eval_cache_before.get("value",0.0)!=goal_evaluation.get(user_id,0.0):
 
             #Level is the next level, or the current level if I'm alread at max
-            params = {
-                "level" : level
-            }
-            goal_goal = evaluate_value_expression(goal["goal"], params)
+            goal_goal = Goal.get_goal_target(goal, achievement["maxlevel"], level)
             if goal_goal is not None and operator=="geq" and new>=goal_goal:
                 goal_achieved = True
                 new = min(new,goal_goal)
@@ -1374,7 +1813,7 @@ class Goal(ABase):
                 goal_achieved = True
                 new = max(new,goal_goal)
 
-            previous_goal = Goal.basic_goal_output(goal, level-1).get("goal_goal",0)
+            previous_goal = Goal.basic_goal_output(goal["id"], level-1).get("goal_goal",0)
             # Evaluate triggers
             if execute_triggers:
                 Goal.select_and_execute_triggers(
@@ -1395,6 +1834,17 @@ class Goal(ABase):
         else:
             return Goal.get_goal_eval_cache(goal["id"], achievement_date, user_id)
 
+    @classmethod
+    def evaluate_with_lock(cls, goal, achievement, achievement_date, user, level, execute_triggers=True):
+        """evaluate the goal unless it has been evaluated by another process while waiting for the lock, return the goal_eval"""
+        key = "%s_%s_%s" % (goal["id"], achievement_date, user["id"])
+        with cache_lock(cache_goal_evaluation, key):
+            goal_eval = Goal.get_goal_eval_cache(goal["id"], achievement_date, user["id"])
+            if not goal_eval:
+                Goal.evaluate(goal, achievement, achievement_date, user, level, None, execute_triggers=execute_triggers)
+                goal_eval = Goal.get_goal_eval_cache(goal["id"], achievement_date, user["id"])
+            return goal_eval
+
     @classmethod
     def select_and_execute_triggers(cls, goal, achievement_date, user_id, level, current_goal, value, previous_goal):
 
@@ -1431,11 +1881,11 @@ class Goal(ABase):
 
         exec_queue = {}
 
-        #When editing things here, check the insert_trigger_step_executions_after_step_upsert event listener too!!!!!!!
+        #When editing things here, check gengine.app.backfill.get_backfill_query too!!!!!!!
         if len(trigger_steps)>0:
             operator = goal["operator"]
 
-            goal_properties = Goal.get_properties(goal,level)
+            goal_properties = Goal.get_properties(goal["id"],level)
 
             for step in trigger_steps:
                 if step["condition_type"] == "percentage" and step["condition_percentage"]:
@@ -1464,9 +1914,32 @@ class Goal(ABase):
 
 
     @classmethod
-    def get_goal_eval_cache(cls,goal_id,achievement_date,user_id):
+    def get_definition_generations(cls, goal_ids):
+        """return {goal_id: version of the goal definition}, the versions are replaced when the goal (or its properties, translations) is edited"""
+        goal_ids = list(goal_ids)
+        tokens = get_generation_tokens(cache_goal_evaluation, [Goal.get_definition_generation_key(goal_id) for goal_id in goal_ids])
+        return {goal_id: tokens[Goal.get_definition_generation_key(goal_id)] for goal_id in goal_ids}
+
+    @classmethod
+    def get_definition_generation_key(cls, goal_id):
+        return "generation_goal_%s" % (goal_id,)
+
+    @classmethod
+    def get_goal_eval_cache_key(cls, goal_id, achievement_date, user_id, generation=None):
+        """the key of the evaluation cache entry includes the version of the goal definition"""
+        if generation is None:
+            generation = Goal.get_definition_generations([goal_id])[goal_id]
+        return "%s_%s_%s_%s" % (goal_id, achievement_date, user_id, generation)
+
+    @classmethod
+    def get_goal_eval_cache(cls,goal_id,achievement_date,user_id,batch=None):
         """lookup and return cache entry, else return None"""
-        v = cache_goal_evaluation.get("%s_%s_%s" % (goal_id,achievement_date,user_id))
+        key = Goal.get_goal_eval_cache_key(goal_id, achievement_date, user_id,
+                                           batch.goal_generations.get(goal_id) if batch is not None else None)
+        if batch is not None and batch.has_goal_eval(key):
+            v = batch.pop_goal_eval(key)
+        else:
+            v = cache_goal_evaluation.get(key)
         if v:
             return v
         else:
@@ -1499,37 +1972,32 @@ class Goal(ABase):
                                                 "achievement_date": achievement_date})
             update_connection().execute(q)
 
-        data = {
-            "id" : goal["id"],
-            "value" : value,
-            "achieved" : achieved,
-            "name_translation_id" : goal["name_translation_id"],
-            "goal" : goal["goal"],
-            "achievement_id" : goal["achievement_id"],
-            "priority" : goal["priority"]
-        }
-
         achievement_id = goal["achievement_id"]
         achievement = Achievement.get_achievement(achievement_id)
 
         level = min((Achievement.get_level_int(user_id, achievement["id"], achievement_date) or 0)+1,achievement["maxlevel"])
 
-        goal_output = Goal.basic_goal_output(data,level)
+        goal_output = Goal.basic_goal_output(goal["id"],level)
 
         goal_output.update({
             "achieved" : achieved,
             "value" : value,
         })
 
-        cache_goal_evaluation.set("%s_%s_%s" % (goal["id"],achievement_date,user_id),goal_output)
+        cache_goal_evaluation.set(Goal.get_goal_eval_cache_key(goal["id"], achievement_date, user_id), goal_output)
+
+        if get_leaderboard_store() is not None:
+            queue_leaderboard_write("set_value", goal["id"], achievement_date, user_id, value, scopes=User.get_leaderboard_scopes(user_id))
 
         return goal_output
 
     @classmethod
     def clear_goal_caches(cls, user_id, goal_ids_with_achievement_date):
         """clear the evaluation cache for the user and gaols"""
+        goal_ids_with_achievement_date = list(goal_ids_with_achievement_date)
+        generations = Goal.get_definition_generations({goal_id for goal_id, achievement_date in goal_ids_with_achievement_date})
         for goal_id, achievement_date in goal_ids_with_achievement_date:
-            cache_goal_evaluation.delete("%s_%s_%s" % (goal_id, achievement_date, user_id))
+            cache_goal_evaluation.delete(Goal.get_goal_eval_cache_key(goal_id, achievement_date, user_id, generations[goal_id]))
             s = update_connection()
             s.execute(t_goal_evaluation_cache.delete().where(
                 and_(t_goal_evaluation_cache.c.user_id == user_id,
@@ -1538,25 +2006,151 @@ class Goal(ABase):
             )
 
     @classmethod
-    def get_leaderboard(cls, goal, achievement_date, user_ids):
-        """get the leaderboard for the goal and userids"""
+    def get_leaderboard(cls, goal, achievement_date, user_ids, offset=0, limit=None, around_user=None, scope=None):
+        """get the leaderboard for the goal and userids
 
-        q = select([t_goal_evaluation_cache.c.user_id,
-                    t_goal_evaluation_cache.c.value])\
-                .where(and_(t_goal_evaluation_cache.c.user_id.in_(user_ids),
-                            t_goal_evaluation_cache.c.goal_id==goal["id"],
-                            t_goal_evaluation_cache.c.achievement_date==achievement_date,
-                            ))\
-                .order_by(t_goal_evaluation_cache.c.value.desc(),
-                          t_goal_evaluation_cache.c.user_id.desc())
-        items = DBSession.execute(q).fetchall()
-
-        users = User.get_users(user_ids)
-
-        requested_user_ids = set(int(s) for s in user_ids)
-        values_found_for_user_ids = set([int(x["user_id"]) for x in items])
-        missing_user_ids = requested_user_ids - values_found_for_user_ids
-        missing_users = User.get_users(missing_user_ids).values()
+        user_ids may be None for the global leaderboard of all users or the leaderboard of a scope (city or group, see :mod:`gengine.app.leaderboard`).
+        offset and limit select a page of the leaderboard, around_user centers the page on the position of this user.
+        """
+        return cls.get_leaderboard_window(goal, achievement_date, user_ids, offset, limit, around_user, scope)["leaderboard"]
+
+    @classmethod
+    def get_leaderboard_window(cls, goal, achievement_date, user_ids, offset=0, limit=None, around_user=None, scope=None):
+        """get a page of the leaderboard, see :meth:`get_leaderboard`.
+
+        returns {"total": number of entries, "user_position": position of around_user (or None), "leaderboard": [entries of the page]}
+        """
+        store = get_leaderboard_store()
+        if store is not None:
+            total, user_position, items = cls.get_leaderboard_items_from_store(store, goal, achievement_date, user_ids, offset, limit, around_user, scope)
+        else:
+            total, user_position, items = cls.get_leaderboard_items_from_db(goal, achievement_date, user_ids, offset, limit, around_user, scope)
+
+        users = User.get_users([user_id for position, user_id, value in items])
+
+        return {
+            "total": total,
+            "user_position": user_position,
+            "leaderboard": [{"user": User.basic_output(users[user_id]),
+                             "value": value,
+                             "position": position} for position, user_id, value in items if user_id in users]
+        }
+
+    @classmethod
+    def get_leaderboard_page_bounds(cls, offset, limit, user_position):
+        """return (start, stop) of the requested page, stop is None if the page is not limited"""
+        if limit is None:
+            return max(0, offset or 0), None
+        if user_position is not None:
+            start = max(0, user_position - limit // 2)
+        else:
+            start = max(0, offset or 0)
+        return start, start + limit
+
+    @classmethod
+    def get_leaderboard_items_from_db(cls, goal, achievement_date, user_ids, offset, limit, around_user, scope=None):
+        """compute the positions with a window function on the goal_evaluation_cache and select only the requested page"""
+
+        condition = and_(t_goal_evaluation_cache.c.goal_id==goal["id"],
+                         t_goal_evaluation_cache.c.achievement_date==achievement_date)
+
+        if scope is not None:
+            condition = and_(condition, cls.get_scope_condition(scope))
+
+        if user_ids is not None:
+            requested_user_ids = set(int(s) for s in user_ids)
+            values_found_for_user_ids = {int(x["user_id"]) for x in DBSession.execute(
+                select([t_goal_evaluation_cache.c.user_id]).where(and_(condition, t_goal_evaluation_cache.c.user_id.in_(requested_user_ids)))
+            ).fetchall()}
+            cls.evaluate_missing_users(goal, achievement_date, requested_user_ids - values_found_for_user_ids)
+            condition = and_(condition, t_goal_evaluation_cache.c.user_id.in_(requested_user_ids))
+
+        ranked = select([t_goal_evaluation_cache.c.user_id,
+                         t_goal_evaluation_cache.c.value,
+                         (func.row_number().over(order_by=[t_goal_evaluation_cache.c.value.desc(),
+                                                           t_goal_evaluation_cache.c.user_id.desc()]) - 1).label("position"),
+                         func.count("*").over().label("total")])\
+                    .where(condition).alias("ranked")
+
+        user_position = None
+        if around_user is not None:
+            user_position = DBSession.execute(select([ranked.c.position]).where(ranked.c.user_id==around_user)).scalar()
+
+        start, stop = cls.get_leaderboard_page_bounds(offset, limit, user_position)
+        q = select([ranked.c.user_id, ranked.c.value, ranked.c.position, ranked.c.total]).where(ranked.c.position >= start)
+        if stop is not None:
+            q = q.where(ranked.c.position < stop)
+        rows = DBSession.execute(q.order_by(ranked.c.position)).fetchall()
+
+        if len(rows) > 0:
+            total = rows[0]["total"]
+        else:
+            total = DBSession.execute(select([func.count("*")], from_obj=t_goal_evaluation_cache).where(condition)).scalar()
+
+        return total, user_position, [(x["position"], x["user_id"], x["value"]) for x in rows]
+
+    @classmethod
+    def get_leaderboard_items_from_store(cls, store, goal, achievement_date, user_ids, offset, limit, around_user, scope=None):
+        """select the requested page from the leaderboard store (see :mod:`gengine.app.leaderboard`)"""
+
+        goal_id = goal["id"]
+        if user_ids is not None:
+            scope = None
+        if not store.exists(goal_id, achievement_date, scope):
+            cls.rebuild_leaderboard(goal_id, achievement_date, scope)
+
+        if user_ids is None:
+            total = store.size(goal_id, achievement_date, scope)
+            user_position = store.rank(goal_id, achievement_date, around_user, scope) if around_user is not None else None
+            start, stop = cls.get_leaderboard_page_bounds(offset, limit, user_position)
+            items = store.get_range(goal_id, achievement_date, start, total if stop is None else stop, scope)
+        else:
+            requested_user_ids = set(int(s) for s in user_ids)
+            values = store.get_values(goal_id, achievement_date, requested_user_ids)
+            if cls.evaluate_missing_users(goal, achievement_date, requested_user_ids - set(values.keys())):
+                values = store.get_values(goal_id, achievement_date, requested_user_ids)
+            ordered = sorted(values.items(), key=lambda x: (-x[1], -x[0]))
+            total = len(ordered)
+            user_position = None
+            if around_user is not None:
+                user_position = next((i for i in range(0, total) if ordered[i][0] == int(around_user)), None)
+            start, stop = cls.get_leaderboard_page_bounds(offset, limit, user_position)
+            items = [(i, ordered[i][0], ordered[i][1]) for i in range(start, total if stop is None else min(stop, total))]
+
+        return total, user_position, items
+
+    @classmethod
+    def get_embedded_leaderboard(cls, goal, achievement_date, user_ids, user_id, scope=None):
+        """the part of the leaderboard which is embedded into the evaluation output of the user.
+
+        By default these are the first positions and the positions around the user, the full leaderboard is embedded
+        only if leaderboard.embed_full is set. Use the leaderboard API to get other pages.
+        """
+        settings = get_settings() or {}
+        if asbool(settings.get("leaderboard.embed_full", False)):
+            window = cls.get_leaderboard_window(goal, achievement_date, user_ids, around_user=user_id, scope=scope)
+            entries = window["leaderboard"]
+        else:
+            top = int(settings.get("leaderboard.embed_top", 10))
+            around = int(settings.get("leaderboard.embed_around", 5))
+            window = cls.get_leaderboard_window(goal, achievement_date, user_ids, limit=2*around+1, around_user=user_id, scope=scope)
+            entries = window["leaderboard"]
+            if top > 0 and (len(entries) == 0 or entries[0]["position"] > 0):
+                known_positions = {e["position"] for e in entries}
+                entries += [e for e in cls.get_leaderboard(goal, achievement_date, user_ids, offset=0, limit=top, scope=scope)
+                            if e["position"] not in known_positions]
+                entries.sort(key=lambda e: e["position"])
+
+        return {
+            "leaderboard": entries,
+            "leaderboard_position": window["user_position"],
+            "leaderboard_total": window["total"],
+        }
+
+    @classmethod
+    def evaluate_missing_users(cls, goal, achievement_date, missing_user_ids):
+        """evaluate the goal for users which have not been evaluated before. returns True if any user was evaluated."""
+        missing_users = User.get_users(missing_user_ids).values() if missing_user_ids else []
         if len(missing_users)>0:
             #the goal has not been evaluated for some users...
             achievement = Achievement.get_achievement(goal["achievement_id"])
@@ -1565,16 +2159,33 @@ class Goal(ABase):
                 user_has_level = Achievement.get_level_int(user["id"], achievement["id"], achievement_date)
                 user_wants_level = min((user_has_level or 0)+1, achievement["maxlevel"])
 
-                Goal.evaluate(goal, achievement, achievement_date, user, user_wants_level)
-
-            #rerun the query
-            items = DBSession.execute(q).fetchall()
+                Goal.evaluate_with_lock(goal, achievement, achievement_date, user, user_wants_level)
+            return True
+        return False
 
-        positions = [{ "user": User.basic_output(users[items[i]["user_id"]]),
-                       "value" : items[i]["value"],
-                       "position" : i} for i in range(0,len(items))]
+    @classmethod
+    def rebuild_leaderboard(cls, goal_id, achievement_date, scope=None):
+        """(re)build the leaderboard of the goal (and scope) in the leaderboard store from the goal_evaluation_cache"""
+        store = get_leaderboard_store()
+        if store is None:
+            return
+        condition = and_(t_goal_evaluation_cache.c.goal_id==goal_id,
+                         t_goal_evaluation_cache.c.achievement_date==achievement_date)
+        if scope is not None:
+            condition = and_(condition, cls.get_scope_condition(scope))
+        q = select([t_goal_evaluation_cache.c.user_id,
+                    t_goal_evaluation_cache.c.value]).where(condition)
+        store.rebuild(goal_id, achievement_date, [(x["user_id"], x["value"]) for x in DBSession.execute(q).fetchall()], scope)
 
-        return positions
+    @classmethod
+    def get_scope_condition(cls, scope):
+        """restrict the goal_evaluation_cache to the users of the scope (uses the indexes on users.city and users_groups.group_id)"""
+        kind, value = parse_scope(scope)
+        if kind == "city":
+            members = select([t_users.c.id]).where(t_users.c.city==value)
+        else:
+            members = select([t_users_groups.c.user_id]).where(t_users_groups.c.group_id==int(value))
+        return t_goal_evaluation_cache.c.user_id.in_(members)
 
     @classmethod
     @cache_general.cache_on_arguments()
@@ -1598,8 +2209,28 @@ class Goal(ABase):
 
     @classmethod
     @cache_general.cache_on_arguments()
-    def basic_goal_output(cls,goal,level):
-        goal_goal = evaluate_value_expression(goal["goal"], {"level":level})
+    def get_goal_targets(cls, goal_id, maxlevel):
+        """return the goal values of the levels 0..maxlevel+1, evaluated at once (None if the formula fails for any level)."""
+        goal = Goal.get_goal(goal_id)
+        try:
+            targets = evaluate_value_expression_array(goal["goal"], {"level": range(0, maxlevel + 2)})
+        except FormularEvaluationException:
+            return None
+        return targets.tolist() if hasattr(targets, "tolist") else targets
+
+    @classmethod
+    def get_goal_target(cls, goal, maxlevel, level):
+        """return the goal value of the level (from :meth:`get_goal_targets` if the level is in range)."""
+        targets = Goal.get_goal_targets(goal["id"], maxlevel)
+        if targets is not None and 0 <= level < len(targets):
+            return targets[level]
+        return evaluate_value_expression(goal["goal"], {"level": level})
+
+    @classmethod
+    @cache_general.cache_on_arguments()
+    def basic_goal_output(cls,goal_id,level):
+        goal = Goal.get_goal(goal_id)
+        goal_goal = Goal.get_goal_target(goal, Achievement.get_achievement(goal["achievement_id"])["maxlevel"], level)
         properties = {
             str(r["property_id"]) : {
                 "property_id" : r["property_id"],
@@ -1619,10 +2250,10 @@ class Goal(ABase):
 
     @classmethod
     @cache_general.cache_on_arguments()
-    def get_properties(cls, goal, level):
+    def get_properties(cls, goal_id, level):
         return {
             p["name"]: (p["value_translated"] if p["value_translated"] else p["value"])
-            for p in Goal.basic_goal_output(goal, level).get("properties").values()
+            for p in Goal.basic_goal_output(goal_id, level).get("properties").values()
         }
 
 class Language(ABase):
@@ -1638,29 +2269,48 @@ class Translation(ABase):
         return "%s" % (self.text,)
 
     @classmethod
-    @cache_translations.cache_on_arguments()
-    def trs(cls,translation_id,params={}):
-        """returns a map of translations for the translation_id for ALL languages"""
+    def trs(cls,translation_id,params={},language=None):
+        """returns a map of translations for the translation_id for ALL languages (or only for the given language)
+
+        The texts are cached by translation_id (see get_translation_texts), the params are rendered in memory."""
 
         if translation_id is None:
             return None
+        texts = cls.get_translation_texts(translation_id)
+        if language is not None:
+            fallback_language = get_settings().get("fallback_language","en")
+            texts = {language : texts.get(language, texts[fallback_language])}
         try:
             # TODO support params which are results of this function itself (dicts of lang -> value)
             # maybe even better: add possibility to refer to other translationvariables directly (so they can be modified later on)
-            ret = {str(x["name"]) : evaluate_string(x["text"],params) for x in cls.get_translation_variable(translation_id)}
+            # languages without translation share the text of the fallback language, it is rendered once
+            rendered = {}
+            ret = {}
+            for lang, text in texts.items():
+                if text not in rendered:
+                    rendered[text] = evaluate_string(text, params)
+                ret[lang] = rendered[text]
         except Exception as e:
-            ret = {str(x["name"]) : x["text"] for x in cls.get_translation_variable(translation_id)}
+            ret = dict(texts)
             log.exception("Evaluation of string-forumlar failed: %s" % (ret.get(get_settings().get("fallback_language","en"),translation_id),))
-            
+
+        return ret
+
+    @classmethod
+    @cache_translations.cache_on_arguments()
+    def get_translation_texts(cls,translation_id):
+        """returns the (unrendered) texts of the translation_id for ALL languages, missing languages use the fallback language"""
+        ret = {str(x["name"]) : x["text"] for x in cls.get_translation_variable(translation_id)}
+
         if not get_settings().get("fallback_language","en") in ret:
             ret[get_settings().get("fallback_language","en")] = "[not_translated]_"+str(translation_id)
-        
+
         for lang in cls.get_languages():
             if not str(lang["name"]) in ret:
                 ret[str(lang["name"])] = ret[get_settings().get("fallback_language","en")]
-        
-        return ret    
-    
+
+        return ret
+
     @classmethod
     @cache_translations.cache_on_arguments()
     def get_translation_variable(cls,translation_id):
@@ -1674,41 +2324,109 @@ class Translation(ABase):
     def get_languages(cls):
         return DBSession.execute(t_languages.select()).fetchall()
 
+    @classmethod
+    def negotiate_language(cls, requested=None, accept_language=None, user=None):
+        """return the language of a response: the requested language, the user's language,
+        the best match of the Accept-Language header (webob) or the fallback language.
+
+        Only existing languages are used."""
+        languages = {x["id"] : str(x["name"]) for x in cls.get_languages()}
+        if requested in languages.values():
+            return requested
+        if user is not None and user["language_id"] in languages:
+            return languages[user["language_id"]]
+        if accept_language is not None and languages:
+            match = accept_language.best_match(sorted(languages.values()))
+            if match:
+                return match
+        return get_settings().get("fallback_language","en")
+
+    @classmethod
+    def select_language(cls, output, language):
+        """reduce the translation maps (goal_name, value_translated) in the output to the language (modifies the output)"""
+        fallback_language = get_settings().get("fallback_language","en")
+        if isinstance(output, dict):
+            for key, value in output.items():
+                if key in ("goal_name", "value_translated") and isinstance(value, dict):
+                    output[key] = {language : value.get(language, value.get(fallback_language))}
+                else:
+                    cls.select_language(value, language)
+        elif isinstance(output, list):
+            for value in output:
+                cls.select_language(value, language)
+        return output
+
 class UserMessage(ABase):
     def __unicode__(self, *args, **kwargs):
-        return "Message: %s" % (Translation.trs(self.translation_id,self.params).get(get_settings().get("fallback_language","en")),)
+        return "Message: %s" % (self.text.get(get_settings().get("fallback_language","en")),)
+
+    @classmethod
+    def get_text(cls, row, language=None):
+        return UserMessage.select_text(row["rendered_text"], row["translation_id"], row["params"], language)
 
     @classmethod
-    def get_text(cls, row):
-        return Translation.trs(row["translation_id"],row["params"])
+    def select_text(cls, rendered_text, translation_id, params, language=None):
+        """return the stored texts (of the language), messages without stored texts are rendered"""
+        if rendered_text is None:
+            return Translation.trs(translation_id, params, language=language)
+        if language is not None:
+            return {language : rendered_text.get(language, rendered_text.get(get_settings().get("fallback_language","en")))}
+        return rendered_text
 
     @property
     def text(self):
-        return Translation.trs(self.translation_id, self.params)
+        return UserMessage.select_text(self.rendered_text, self.translation_id, self.params)
 
     @classmethod
-    def deliver(cls, message):
-        from gengine.app.push import send_push_message
-        text = UserMessage.get_text(message)
-        language = get_settings().get("fallback_language", "en")
-        j = t_users.join(t_languages)
-        user_language = DBSession.execute(select([t_languages.c.name],from_obj=j).where(t_users.c.id==message["user_id"])).fetchone()
-        if user_language:
-             language = user_language["name"]
-        translated_text = text[language]
-
-        if not message["has_been_pushed"]:
-            try:
-                send_push_message(
-                    user_id = message["user_id"],
-                    text = translated_text,
-                    custom_payload = {},
-                    title = get_settings().get("push_title","Gamification-Engine")
-                )
-            except Exception as e:
-                log.error(e, exc_info=True)
-            else:
-                DBSession.execute(t_user_messages.update().values({ "has_been_pushed" : True }).where(t_user_messages.c.id == message["id"]))
+    def archive_messages(cls, before, batch_size=10000, delete=False):
+        """move up to batch_size read and pushed messages created before the datetime to user_messages_archive
+        (or delete them) with one statement, return the number of moved messages (see gengine_archive_messages)"""
+        columns = ", ".join(c.name for c in t_user_messages_archive.columns)
+        old_messages = """
+            SELECT id FROM user_messages
+            WHERE is_read AND has_been_pushed AND created_at < :before
+            ORDER BY id LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        """
+        if delete:
+            statement = "DELETE FROM user_messages WHERE id IN (%s)" % (old_messages,)
+        else:
+            statement = """
+                WITH moved AS (DELETE FROM user_messages WHERE id IN (%s) RETURNING %s)
+                INSERT INTO user_messages_archive (%s) SELECT %s FROM moved
+            """ % (old_messages, columns, columns, columns)
+        return DBSession.execute(text(statement), {"before": before, "batch_size": batch_size}).rowcount
+
+
+def change_unread_messages(connection, user_id, difference):
+    if difference:
+        connection.execute(t_users.update().values({
+            "unread_messages": t_users.c.unread_messages + difference
+        }).where(t_users.c.id == user_id))
+
+@event.listens_for(UserMessage, "after_insert")
+def increase_unread_messages(mapper, connection, target):
+    if not target.is_read:
+        change_unread_messages(connection, target.user_id, 1)
+
+@event.listens_for(UserMessage, "after_delete")
+def decrease_unread_messages(mapper, connection, target):
+    if not target.is_read:
+        change_unread_messages(connection, target.user_id, -1)
+
+@event.listens_for(UserMessage, "after_update")
+def update_unread_messages(mapper, connection, target):
+    was_read = previous_value(target, "is_read")
+    if was_read is not None and bool(was_read) != bool(target.is_read):
+        change_unread_messages(connection, target.user_id, -1 if target.is_read else 1)
+
+PUSH_CHANNEL = "gengine_push_messages"
+
+@event.listens_for(UserMessage, "after_insert")
+def notify_push_workers(mapper, connection, target):
+    """wake up the push workers (see gengine.app.push.PushWorker), postgres sends the notification after the commit"""
+    if connection.dialect.name == "postgresql" and not target.has_been_pushed:
+        connection.execute("NOTIFY %s" % (PUSH_CHANNEL,))
 
 class GoalTrigger(ABase):
     def __unicode__(self, *args, **kwargs):
@@ -1729,14 +2447,16 @@ class GoalTriggerStep(ABase):
         }))
         if not suppress_actions:
             if trigger_step["action_type"] == "user_message":
+                params = dict({
+                    'value' : value,
+                    'goal' : goal_goal,
+                    'percentage' : current_percentage
+                },**goal_properties)
                 m = UserMessage(
                     user_id = user_id,
                     translation_id = trigger_step["action_translation_id"],
-                    params = dict({
-                        'value' : value,
-                        'goal' : goal_goal,
-                        'percentage' : current_percentage
-                    },**goal_properties),
+                    params = params,
+                    rendered_text = Translation.trs(trigger_step["action_translation_id"], params),
                     is_read = False,
                     has_been_pushed = False
                 )
@@ -1745,40 +2465,16 @@ class GoalTriggerStep(ABase):
 @event.listens_for(GoalTriggerStep, "after_insert")
 @event.listens_for(GoalTriggerStep, 'after_update')
 def insert_trigger_step_executions_after_step_upsert(mapper,connection,target):
-    """When we create a new Trigger-Step, we must ensure, that is will not be executed for the users who already met the conditions before."""
+    """When we create a new Trigger-Step, we must ensure, that is will not be executed for the users who already met the conditions before.
 
-    user_ids = [x["id"] for x in DBSession.execute(select([t_users.c.id,],from_obj=t_users)).fetchall()]
-    users = User.get_users(user_ids).values()
-    goal = target.trigger.goal
-    achievement = goal.achievement
-
-    for user in users:
-        achievement_date = Achievement.get_datetime_for_evaluation_type(evaluation_timezone=achievement["evaluation_timezone"], evaluation_type=achievement["evaluation"])
-        user_has_level = Achievement.get_level_int(user["id"], achievement["id"], achievement_date)
-        user_wants_level = min((user_has_level or 0) + 1, achievement["maxlevel"])
-        goal_eval = Goal.evaluate(goal, achievement, achievement_date, user, user_wants_level, None, execute_triggers=False)
-
-        previous_goal = Goal.basic_goal_output(goal, user_wants_level - 1).get("goal_goal", 0)
-        if previous_goal == goal_eval["goal_goal"]:
-            previous_goal = 0.0
-
-        current_percentage = float(goal_eval["value"]-previous_goal) / float(goal_eval["goal_goal"]-previous_goal)
-        operator = goal["operator"]
-        required_percentage = target["condition_percentage"]
-
-        if (operator == "geq" and current_percentage >= required_percentage) \
-                or (operator == "leq" and current_percentage <= required_percentage):
-            GoalTriggerStep.execute(
-                trigger_step=target,
-                user_id=user["id"],
-                current_percentage=current_percentage,
-                value=goal_eval["value"],
-                goal_goal=goal_eval["goal_goal"],
-                goal_level=user_wants_level,
-                goal_properties=Goal.get_properties(goal,user_wants_level),
-                achievement_date=achievement_date,
-                suppress_actions = True
-            )
+    The executions are inserted with set-based statements in the same transaction (see gengine.app.backfill)."""
+    from gengine.app.backfill import backfill_trigger_step
+    backfill_trigger_step({
+        "id": target.id,
+        "goal_trigger_id": target.goal_trigger_id,
+        "condition_type": target.condition_type,
+        "condition_percentage": target.condition_percentage,
+    }, connection)
 
 def backref(*args,**kw):
     if not "passive_deletes" in kw:
@@ -1902,3 +2598,214 @@ def insert_variable_for_property(mapper,connection,target):
             variable.name = target.name
             variable.group = "day"
             DBSession.add(variable)
+
+
+def invalidate_friend_caches(items):
+    """items are ("friends", user_id) and ("reverse_friends", user_id)"""
+    for kind, user_id in items:
+        if kind == "friends":
+            User.get_friend_ids.invalidate(User, user_id)
+        else:
+            User.get_reverse_friend_ids.invalidate(User, user_id)
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def invalidate_friends_after_transaction(session):
+    items = session.info.pop("friend_invalidations", None)
+    if items:
+        invalidate_friend_caches(items)
+
+
+# The writes to the leaderboard store (see :mod:`gengine.app.leaderboard`) are applied after the commit,
+# so that the leaderboards never contain values of a transaction which is rolled back.
+
+def queue_leaderboard_write(method, *args, **kwargs):
+    """queue a call of the leaderboard store method (e.g. set_value or remove_user) for after the commit"""
+    DBSession().info.setdefault("leaderboard_writes", []).append((method, args, kwargs))
+
+@event.listens_for(Session, "after_commit")
+def apply_leaderboard_writes_after_commit(session):
+    writes = session.info.pop("leaderboard_writes", None)
+    store = get_leaderboard_store()
+    if writes and store is not None:
+        for method, args, kwargs in writes:
+            getattr(store, method)(*args, **kwargs)
+
+@event.listens_for(Session, "after_rollback")
+def discard_leaderboard_writes(session):
+    session.info.pop("leaderboard_writes", None)
+
+def queue_scope_invalidation(user_id, scopes):
+    """invalidate the cached scopes of the user and the evaluations of the scopes after the commit or rollback"""
+    DBSession().info.setdefault("scope_invalidations", set()).update({("user", user_id)} | {("scope", scope) for scope in scopes})
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def invalidate_scopes_after_transaction(session):
+    items = session.info.pop("scope_invalidations", None)
+    if items:
+        for kind, value in items:
+            if kind == "user":
+                User.get_leaderboard_scopes.invalidate(User, value)
+        Achievement.invalidate_scope_evaluate_caches([value for kind, value in items if kind == "scope"])
+
+
+# Invalidation of the definition caches after edits (e.g. in the admin interface).
+# The mapper events collect the affected achievements and goals, the caches are invalidated after the commit.
+
+def invalidate_definition_caches(items):
+    """invalidate the caches of the edited definitions.
+
+    items are ("achievement", achievement_id, maxlevel), ("goal", goal_id, achievement_id, maxlevel),
+    ("category", achievementcategory_id), ("translation", translationvariable_id) and ("languages",).
+    Cache entries are deleted by key, so that the other processes (which share the cache backend) see the edits as well.
+    Evaluations are not deleted, the definition counters in their keys are replaced (see :meth:`Achievement.get_generation_keys`).
+    """
+    achievement_ids, goal_ids = set(), set()
+    for item in items:
+        kind = item[0]
+        if kind == "achievement":
+            achievement_id, maxlevel = item[1:]
+            achievement_ids.add(achievement_id)
+            Achievement.get_achievement.invalidate(Achievement, achievement_id)
+            for level in range(0, maxlevel + 2):
+                Achievement.get_rewards.invalidate(Achievement, achievement_id, level)
+                Achievement.get_achievement_properties.invalidate(Achievement, achievement_id, level)
+        elif kind == "goal":
+            goal_id, achievement_id, maxlevel = item[1:]
+            goal_ids.add(goal_id)
+            achievement_ids.add(achievement_id)
+            Goal.get_goal.invalidate(Goal, goal_id)
+            Goal.get_goals.invalidate(Goal, achievement_id)
+            Goal.get_goal_targets.invalidate(Goal, goal_id, maxlevel)
+            for level in range(0, maxlevel + 2):
+                Goal.get_goal_properties.invalidate(Goal, goal_id, level)
+                Goal.basic_goal_output.invalidate(Goal, goal_id, level)
+                Goal.get_properties.invalidate(Goal, goal_id, level)
+        elif kind == "category":
+            AchievementCategory.get_achievementcategory.invalidate(AchievementCategory, item[1])
+        elif kind == "translation":
+            Translation.get_translation_texts.invalidate(Translation, item[1])
+            Translation.get_translation_variable.invalidate(Translation, item[1])
+        elif kind == "languages":
+            Translation.get_languages.invalidate(Translation)
+
+    if achievement_ids or goal_ids:
+        Achievement.get_achievement_dependencies.invalidate(Achievement)
+        Variable.map_variables_to_rules.invalidate(Variable)
+        renew_generation_tokens(cache_achievements_by_user_for_today, ["generation_lists"])
+        renew_generation_tokens(cache_achievement_eval, [Achievement.get_definition_generation_key(a) for a in achievement_ids])
+        renew_generation_tokens(cache_goal_evaluation, [Goal.get_definition_generation_key(g) for g in goal_ids])
+
+
+def queue_definition_invalidation(target, items):
+    session = object_session(target)
+    if session is None:
+        invalidate_definition_caches(items)
+    else:
+        session.info.setdefault("definition_invalidations", set()).update(items)
+
+@event.listens_for(Session, "after_commit")
+def invalidate_definitions_after_commit(session):
+    items = session.info.pop("definition_invalidations", None)
+    if items:
+        invalidate_definition_caches(items)
+
+@event.listens_for(Session, "after_rollback")
+def discard_definition_invalidations(session):
+    session.info.pop("definition_invalidations", None)
+
+def achievement_items(connection, achievement_ids):
+    achievement_ids = set(achievement_ids) - {None}
+    if not achievement_ids:
+        return []
+    rows = connection.execute(select([t_achievements.c.id, t_achievements.c.maxlevel]).where(t_achievements.c.id.in_(achievement_ids))).fetchall()
+    return [("achievement", row["id"], row["maxlevel"]) for row in rows]
+
+def goal_items(connection, goal_ids):
+    goal_ids = set(goal_ids) - {None}
+    if not goal_ids:
+        return []
+    rows = connection.execute(select([t_goals.c.id, t_goals.c.achievement_id, t_achievements.c.maxlevel],
+                                     from_obj=t_goals.join(t_achievements)).where(t_goals.c.id.in_(goal_ids))).fetchall()
+    return [("goal", row["id"], row["achievement_id"], row["maxlevel"]) for row in rows]
+
+def previous_value(target, attribute):
+    """return the value of the attribute before the flush"""
+    deleted = sa_inspect(target).attrs[attribute].history.deleted
+    return deleted[0] if deleted else getattr(target, attribute)
+
+@event.listens_for(Achievement, "after_insert")
+@event.listens_for(Achievement, "after_update")
+@event.listens_for(Achievement, "after_delete")
+def invalidate_achievement_definition(mapper, connection, target):
+    maxlevel = max(target.maxlevel or 1, previous_value(target, "maxlevel") or 1)
+    queue_definition_invalidation(target, [("achievement", target.id, maxlevel)])
+
+@event.listens_for(AchievementCategory, "after_update")
+@event.listens_for(AchievementCategory, "after_delete")
+def invalidate_achievementcategory_definition(mapper, connection, target):
+    achievement_ids = [x["id"] for x in connection.execute(select([t_achievements.c.id]).where(t_achievements.c.achievementcategory_id == target.id))]
+    queue_definition_invalidation(target, [("category", target.id)] + achievement_items(connection, achievement_ids))
+
+@event.listens_for(AchievementAchievementProperty, "after_insert")
+@event.listens_for(AchievementAchievementProperty, "after_update")
+@event.listens_for(AchievementAchievementProperty, "after_delete")
+@event.listens_for(AchievementReward, "after_insert")
+@event.listens_for(AchievementReward, "after_update")
+@event.listens_for(AchievementReward, "after_delete")
+def invalidate_achievement_level_definition(mapper, connection, target):
+    achievement_ids = {target.achievement_id, previous_value(target, "achievement_id")}
+    queue_definition_invalidation(target, achievement_items(connection, achievement_ids))
+
+@event.listens_for(AchievementProperty, "after_update")
+@event.listens_for(Reward, "after_update")
+def invalidate_definitions_of_property_or_reward(mapper, connection, target):
+    if isinstance(target, Reward):
+        q = select([t_achievements_rewards.c.achievement_id]).where(t_achievements_rewards.c.reward_id == target.id)
+    else:
+        q = select([t_achievements_achievementproperties.c.achievement_id]).where(t_achievements_achievementproperties.c.property_id == target.id)
+    queue_definition_invalidation(target, achievement_items(connection, [x["achievement_id"] for x in connection.execute(q)]))
+
+@event.listens_for(Goal, "after_insert")
+@event.listens_for(Goal, "after_update")
+@event.listens_for(Goal, "after_delete")
+def invalidate_goal_definition(mapper, connection, target):
+    achievement_ids = {target.achievement_id, previous_value(target, "achievement_id")}
+    items = [("goal", target.id, achievement_id, maxlevel)
+             for kind, achievement_id, maxlevel in achievement_items(connection, achievement_ids)]
+    queue_definition_invalidation(target, items)
+
+@event.listens_for(GoalGoalProperty, "after_insert")
+@event.listens_for(GoalGoalProperty, "after_update")
+@event.listens_for(GoalGoalProperty, "after_delete")
+def invalidate_goal_property_definition(mapper, connection, target):
+    queue_definition_invalidation(target, goal_items(connection, {target.goal_id, previous_value(target, "goal_id")}))
+
+@event.listens_for(GoalProperty, "after_update")
+def invalidate_definitions_of_goal_property(mapper, connection, target):
+    q = select([t_goals_goalproperties.c.goal_id]).where(t_goals_goalproperties.c.property_id == target.id)
+    queue_definition_invalidation(target, goal_items(connection, [x["goal_id"] for x in connection.execute(q)]))
+
+@event.listens_for(Translation, "after_insert")
+@event.listens_for(Translation, "after_update")
+@event.listens_for(Translation, "after_delete")
+@event.listens_for(Language, "after_insert")
+@event.listens_for(Language, "after_update")
+@event.listens_for(Language, "after_delete")
+def invalidate_translation_definitions(mapper, connection, target):
+    """a translation is used by goal names and the values of goal properties, achievement properties and rewards"""
+    if isinstance(target, Translation):
+        tv_ids = {target.translationvariable_id, previous_value(target, "translationvariable_id")} - {None}
+        items = [("translation", tv_id) for tv_id in tv_ids]
+        goal_ids = [x["id"] for x in connection.execute(select([t_goals.c.id]).where(t_goals.c.name_translation_id.in_(tv_ids)))]
+        goal_ids += [x["goal_id"] for x in connection.execute(select([t_goals_goalproperties.c.goal_id]).where(t_goals_goalproperties.c.value_translation_id.in_(tv_ids)))]
+        achievement_ids = [x["achievement_id"] for x in connection.execute(select([t_achievements_achievementproperties.c.achievement_id]).where(t_achievements_achievementproperties.c.value_translation_id.in_(tv_ids)))]
+        achievement_ids += [x["achievement_id"] for x in connection.execute(select([t_achievements_rewards.c.achievement_id]).where(t_achievements_rewards.c.value_translation_id.in_(tv_ids)))]
+        items += goal_items(connection, goal_ids) + achievement_items(connection, achievement_ids)
+    else:
+        # all translations get an entry for a new language, so all translations and definitions are affected
+        items = [("languages",)] + [("translation", x["id"]) for x in connection.execute(select([t_translationvariables.c.id]))]
+        items += achievement_items(connection, [x["id"] for x in connection.execute(select([t_achievements.c.id]))])
+        items += goal_items(connection, [x["id"] for x in connection.execute(select([t_goals.c.id]))])
+    queue_definition_invalidation(target, items)
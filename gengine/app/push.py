@@ -1,11 +1,15 @@
+import datetime
 import random
+import select as select_module
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import os
-from sqlalchemy.sql.expression import and_, select
-from sqlalchemy.sql.functions import func
+import transaction
+from sqlalchemy.sql.expression import and_, or_, select
+from zope.sqlalchemy.datamanager import mark_changed
 
-from gengine.app.model import t_user_device, t_user_messages
+from gengine.app.model import t_user_device, t_user_messages, t_users, t_languages, UserMessage, PUSH_CHANNEL
 from gengine.base.model import update_connection
 from gengine.base.settings import get_settings
 from gengine.metadata import DBSession
@@ -157,58 +161,354 @@ def gcm_feedback(response):
 
     DBSession.flush()
 
-def send_push_message(
-        user_id,
-        text="",
-        custom_payload={},
-        title="Gamification-Engine",
-        android_text=None,
-        ios_text=None):
+class PushGateway(object):
+    """sends the notifications to the push services"""
 
-    message_count = DBSession.execute(select([func.count("*").label("c")],from_obj=t_user_messages).where(and_(
-        t_user_messages.c.user_id == user_id,
-        t_user_messages.c.is_read == False
-    ))).scalar()
+    def send_apns(self, push_id, text, badge, data):
+        raise NotImplementedError()
 
-    data = dict({"title": title,
-                 "badge": message_count}, **custom_payload)
+    def send_gcm(self, registration_ids, text, title, data):
+        """send to up to GCM_MAX_RECIPIENTS devices at once, returns the response of GCM"""
+        raise NotImplementedError()
 
-    settings = get_settings()
 
-    if not ios_text:
-        ios_text = text
+class DefaultPushGateway(PushGateway):
+    """APNS (push_ids with prefix prod_ or dev_) and GCM, the connections are kept per thread"""
 
-    if not android_text:
-        android_text = text
+    def send_apns(self, push_id, text, badge, data):
+        payload = Payload(alert=text, custom=data, badge=badge, sound="default")
+        identifier = random.getrandbits(32)
+        if push_id.startswith("prod_"):
+            get_prod_apns().gateway_server.send_notification(push_id[5:], payload, identifier=identifier)
+        elif push_id.startswith("dev_"):
+            get_dev_apns().gateway_server.send_notification(push_id[4:], payload, identifier=identifier)
 
-    rows = DBSession.execute(select([t_user_device.c.push_id, t_user_device.c.device_os], from_obj=t_user_device).distinct().where(t_user_device.c.user_id==user_id)).fetchall()
+    def send_gcm(self, registration_ids, text, title, data):
+        settings = get_settings()
+        return get_gcm().json_request(registration_ids=registration_ids,
+                                      data={"message": text, "data": data, "title": title},
+                                      restricted_package_name=os.environ.get("GCM_PACKAGE", settings.get("gcm.package","")),
+                                      priority='high',
+                                      delay_while_idle=False)
 
-    for device in rows:
 
-        if "ios" in device.device_os.lower():
-            identifier = random.getrandbits(32)
+class StubPushGateway(PushGateway):
+    """records the notifications instead of sending them (for tests), push_ids in fail_for raise an exception,
+    GCM reports the registration ids in unavailable as Unavailable"""
 
-            if custom_payload:
-                payload = Payload(alert=ios_text, custom=data, badge=message_count, sound="default")
-            else:
-                payload = Payload(alert=ios_text, custom=data, badge=message_count, sound="default")
+    def __init__(self, fail_for=(), unavailable=()):
+        self.fail_for = set(fail_for)
+        self.unavailable = set(unavailable)
+        self.apns = []
+        self.gcm = []
+        self._lock = threading.Lock()
+
+    def send_apns(self, push_id, text, badge, data):
+        if push_id in self.fail_for:
+            raise Exception("sending to %s failed" % (push_id,))
+        with self._lock:
+            self.apns.append((push_id, text, badge))
+
+    def send_gcm(self, registration_ids, text, title, data):
+        if self.fail_for.intersection(registration_ids):
+            raise Exception("sending to %s failed" % (registration_ids,))
+        with self._lock:
+            self.gcm.append((list(registration_ids), text, data["badge"]))
+        unavailable = [reg_id for reg_id in registration_ids if reg_id in self.unavailable]
+        if unavailable:
+            return {"errors": {"Unavailable": unavailable}}
+
+
+GCM_MAX_RECIPIENTS = 1000
+
+# the errors of single registration ids in a GCM response, after which the message is sent again
+GCM_RETRY_ERRORS = ("Unavailable", "InternalServerError", "DeviceMessageRateExceeded")
+
+
+def _strip_push_prefix(push_id):
+    for prefix in ("prod_", "dev_"):
+        if push_id.startswith(prefix):
+            return push_id[len(prefix):]
+    return push_id
 
-            log.debug("Sending Push message to User (ID: %s)", user_id)
 
-            if device.push_id.startswith("prod_"):
-                get_prod_apns().gateway_server.send_notification(device.push_id[5:], payload, identifier=identifier)
-            elif device.push_id.startswith("dev_"):
-                get_dev_apns().gateway_server.send_notification(device.push_id[4:], payload, identifier=identifier)
+def _gcm_retry_registration_ids(response):
+    """the registration ids of the response which failed with a retryable error"""
+    reg_ids = set()
+    for error, error_reg_ids in (response.get("errors") or {}).items():
+        if error in GCM_RETRY_ERRORS:
+            reg_ids.update(x.decode("utf8") if not isinstance(x, str) else x for x in error_reg_ids)
+    return reg_ids
 
-        if "android" in device.device_os.lower():
 
-            log.debug("Sending Push message to User (ID: %s)", user_id)
-            push_id = device.push_id.lstrip("dev_").lstrip("prod_")
+class PushDispatcher(object):
+    """sends a batch of messages.
+
+    The languages, unread counts (users.unread_messages) and devices of all users of the batch are loaded with two queries.
+    Messages with the same text and badge are sent to all their android devices with one GCM request,
+    the requests are sent concurrently by a bounded number of threads.
+
+    settings:
+        push.workers = 8            threads which send the notifications
+        push.batch_size = 500       messages per batch (see PushWorker)
+    """
+
+    def __init__(self, gateway=None, workers=None, title=None):
+        settings = get_settings() or {}
+        self.gateway = gateway if gateway is not None else DefaultPushGateway()
+        self.workers = workers or int(settings.get("push.workers", 8))
+        self.title = title or settings.get("push_title", "Gamification-Engine")
+        self.fallback_language = settings.get("fallback_language", "en")
+
+    def load_recipients(self, user_ids):
+        """return the languages, unread message counts and devices of the users"""
+        languages = {}
+        counts = {}
+        for x in DBSession.execute(select([t_users.c.id, t_users.c.unread_messages, t_languages.c.name],
+                                          from_obj=t_users.outerjoin(t_languages))
+                                   .where(t_users.c.id.in_(user_ids))).fetchall():
+            if x["name"] is not None:
+                languages[x["id"]] = x["name"]
+            counts[x["id"]] = x["unread_messages"]
+
+        devices = {}
+        for x in DBSession.execute(select([t_user_device.c.user_id, t_user_device.c.push_id, t_user_device.c.device_os])
+                                   .distinct().where(t_user_device.c.user_id.in_(user_ids))).fetchall():
+            devices.setdefault(x["user_id"], []).append((x["push_id"], x["device_os"]))
+        return languages, counts, devices
+
+    def get_jobs(self, messages):
+        """return the rendered messages' ids and the notifications to send as (function, args, deliveries),
+        deliveries are the (message_id, push_id) pairs of the notification.
+
+        Devices which have received a message in a previous attempt (pushed_devices) are skipped."""
+        languages, counts, devices = self.load_recipients(list({m["user_id"] for m in messages}))
+
+        rendered = []
+        jobs = []
+        gcm_groups = {}
+        for message in messages:
+            user_id = message["user_id"]
+            language = languages.get(user_id, self.fallback_language)
+            try:
+                text = UserMessage.get_text(message, language=language)[language]
+            except Exception as e:
+                log.exception("rendering of message %s failed" % (message["id"],))
+                continue
+            rendered.append(message["id"])
+
+            badge = counts.get(user_id, 0)
+            data = {"title": self.title, "badge": badge}
+            pushed_devices = set(message["pushed_devices"] or [])
+            for push_id, device_os in devices.get(user_id, []):
+                if push_id in pushed_devices:
+                    continue
+                if "ios" in device_os.lower():
+                    jobs.append((self.gateway.send_apns, (push_id, text, badge, data), [(message["id"], push_id)]))
+                if "android" in device_os.lower():
+                    gcm_groups.setdefault((text, badge), []).append((message["id"], push_id))
+
+        for (text, badge), deliveries in gcm_groups.items():
+            data = {"title": self.title, "badge": badge}
+            for i in range(0, len(deliveries), GCM_MAX_RECIPIENTS):
+                chunk = deliveries[i:i + GCM_MAX_RECIPIENTS]
+                jobs.append((self.gateway.send_gcm, ([_strip_push_prefix(push_id) for message_id, push_id in chunk], text, self.title, data), chunk))
+        return rendered, jobs
+
+    def send(self, jobs):
+        """send the notifications concurrently, return the GCM responses and the failed and successful deliveries.
+
+        The deliveries to registration ids which GCM reports with a retryable error (see GCM_RETRY_ERRORS) have failed."""
+        def run(job):
+            f, args, deliveries = job
+            try:
+                return f(*args), None
+            except Exception as e:
+                log.error("sending push notification failed: %s" % (e,), exc_info=True)
+                return None, deliveries
+
+        responses = []
+        failed = set()
+        succeeded = set()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            for job, (response, failed_deliveries) in zip(jobs, executor.map(run, jobs)):
+                if failed_deliveries:
+                    failed.update(failed_deliveries)
+                    continue
+                retry_reg_ids = _gcm_retry_registration_ids(response) if response else set()
+                for delivery in job[2]:
+                    if _strip_push_prefix(delivery[1]) in retry_reg_ids:
+                        failed.add(delivery)
+                    else:
+                        succeeded.add(delivery)
+                if response:
+                    responses.append(response)
+        return responses, failed, succeeded
+
+    def dispatch(self, messages):
+        """send the messages which have not been pushed, mark them as pushed and return their ids.
+
+        The devices which have received a failed message are stored, a retry is only sent to the other devices."""
+        messages = [m for m in messages if not m["has_been_pushed"]]
+        if not messages:
+            return []
+
+        rendered, jobs = self.get_jobs(messages)
+        responses, failed, succeeded = self.send(jobs)
+
+        # the feedback modifies the devices, it runs in the transaction of the calling thread
+        for response in responses:
+            gcm_feedback(response)
+
+        failed_ids = {message_id for message_id, push_id in failed}
+        sent = [message_id for message_id in rendered if message_id not in failed_ids]
+        if sent:
+            DBSession.execute(t_user_messages.update().values({"has_been_pushed": True}).where(t_user_messages.c.id.in_(sent)))
+
+        pushed_devices = {m["id"]: list(m["pushed_devices"] or []) for m in messages if m["id"] in failed_ids}
+        for message_id, push_id in succeeded:
+            if message_id in pushed_devices:
+                pushed_devices[message_id].append(push_id)
+        for message_id, devices in pushed_devices.items():
+            DBSession.execute(t_user_messages.update().values({"pushed_devices": sorted(devices)}).where(t_user_messages.c.id == message_id))
+        return sent
+
+
+class PushWorker(object):
+    """claims batches of unpushed messages and sends them with the dispatcher.
+
+    Several workers can run in parallel: the messages are claimed with SELECT ... FOR UPDATE SKIP LOCKED
+    and stay locked until their batch is committed.
+    Failed messages are retried after push.retry.delay * 2^(attempts-1) seconds and given up after push.retry.max_attempts.
+    Idle workers wait for a notification of new messages (postgres LISTEN) and poll with backoff.
+
+    settings:
+        push.batch_size = 500           messages per batch
+        push.retry.delay = 60           seconds until the first retry
+        push.retry.max_attempts = 5
+        push.poll.min = 1               seconds between the polls, doubled while idle
+        push.poll.max = 30
+    """
+
+    def __init__(self, dispatcher=None, engine=None, settings=None):
+        settings = settings if settings is not None else (get_settings() or {})
+        self.dispatcher = dispatcher if dispatcher is not None else PushDispatcher()
+        self.engine = engine
+        self.batch_size = int(settings.get("push.batch_size", 500))
+        self.retry_delay = float(settings.get("push.retry.delay", 60))
+        self.max_attempts = int(settings.get("push.retry.max_attempts", 5))
+        self.poll_min = float(settings.get("push.poll.min", 1))
+        self.poll_max = float(settings.get("push.poll.max", 30))
+        self.stopping = threading.Event()
+        self._listen_fairy = None
+        self._listen_connection = None
+
+    def claim(self):
+        now = datetime.datetime.utcnow()
+        q = t_user_messages.select()\
+            .where(and_(t_user_messages.c.has_been_pushed == False,
+                        or_(t_user_messages.c.push_retry_at == None,
+                            t_user_messages.c.push_retry_at <= now)))\
+            .order_by(t_user_messages.c.id)\
+            .limit(self.batch_size)\
+            .with_for_update(skip_locked=True)
+        return DBSession.execute(q).fetchall()
+
+    def schedule_retries(self, messages):
+        now = datetime.datetime.utcnow()
+        for message in messages:
+            attempts = message["push_attempts"] + 1
+            if attempts >= self.max_attempts:
+                log.warning("giving up push of message %s after %s attempts" % (message["id"], attempts))
+                values = {"push_attempts": attempts, "has_been_pushed": True}
+            else:
+                values = {"push_attempts": attempts,
+                          "push_retry_at": now + datetime.timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))}
+            DBSession.execute(t_user_messages.update().values(values).where(t_user_messages.c.id == message["id"]))
+
+    def process_batch(self):
+        """claim and send one batch in one transaction, return the number of claimed messages"""
+        with transaction.manager:
+            messages = self.claim()
+            if not messages:
+                return 0
+            sent = set(self.dispatcher.dispatch(messages))
+            self.schedule_retries([m for m in messages if m["id"] not in sent])
+            mark_changed(DBSession())
+        return len(messages)
+
+    def run_until_empty(self):
+        """send all messages which are due, return the number of processed messages"""
+        total = 0
+        while not self.stopping.is_set():
+            claimed = self.process_batch()
+            if not claimed:
+                break
+            total += claimed
+        return total
+
+    def listen(self):
+        """listen for new messages (postgres only), otherwise the worker polls"""
+        if self.engine is None or self.engine.dialect.name != "postgresql":
+            return
+        try:
+            # the autocommit connection is removed from the pool, the sessions must never get it
+            # (the locks of claim() would be released at the end of the statement)
+            fairy = self.engine.raw_connection()
+            fairy.detach()
+            self._listen_fairy = fairy
+            connection = fairy.connection
+            connection.autocommit = True
+            connection.cursor().execute("LISTEN %s" % (PUSH_CHANNEL,))
+            self._listen_connection = connection
+        except Exception as e:
+            log.exception("LISTEN failed, polling for new messages")
+            self.unlisten()
+
+    def unlisten(self):
+        """close the connection of listen()"""
+        self._listen_connection = None
+        if self._listen_fairy is not None:
+            self._listen_fairy.close()
+            self._listen_fairy = None
+
+    def wait(self, timeout):
+        """wait up to timeout seconds, return True if new messages have been notified"""
+        if self._listen_connection is None:
+            self.stopping.wait(timeout)
+            return False
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=timeout)
+        while not self.stopping.is_set():
+            remaining = (deadline - datetime.datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                return False
+            # wake up at least every second to notice a shutdown
+            if select_module.select([self._listen_connection], [], [], min(remaining, 1.0)) != ([], [], []):
+                self._listen_connection.poll()
+                if self._listen_connection.notifies:
+                    del self._listen_connection.notifies[:]
+                    return True
+        return False
+
+    def run(self):
+        """process batches until stop() is called, the current batch is finished before the worker stops"""
+        self.listen()
+        delay = self.poll_min
+        while not self.stopping.is_set():
+            try:
+                claimed = self.process_batch()
+            except Exception as e:
+                log.exception("push batch failed")
+                claimed = 0
+            finally:
+                DBSession.remove()
+            if claimed:
+                delay = self.poll_min
+            elif self.wait(delay):
+                delay = self.poll_min
+            else:
+                delay = min(delay * 2, self.poll_max)
+        self.unlisten()
 
-            response = get_gcm().json_request(registration_ids=[push_id, ],
-                                              data={"message": android_text, "data": data, "title": title},
-                                              restricted_package_name=os.environ.get("GCM_PACKAGE", settings.get("gcm.package","")),
-                                              priority='high',
-                                              delay_while_idle=False)
-            if response:
-                gcm_feedback(response)
\ No newline at end of file
+    def stop(self, *args):
+        self.stopping.set()
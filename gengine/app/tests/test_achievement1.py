@@ -6,7 +6,7 @@ from gengine.app.cache import clear_all_caches
 from gengine.app.tests.base import BaseDBTest
 from gengine.app.tests.helpers import create_user, create_achievement, create_variable, create_goals, create_achievement_rewards, create_achievement_user
 from gengine.metadata import DBSession
-from gengine.app.model import Achievement, User, AchievementUser, Value, AchievementReward, Reward, AchievementProperty, AchievementAchievementProperty, t_values
+from gengine.app.model import Achievement, EvaluationBatch, Goal, invalidate_definition_caches, User, AchievementUser, Value, AchievementReward, Reward, AchievementProperty, AchievementAchievementProperty, t_values
 from gengine.base.model import update_connection
 
 class TestAchievement(BaseDBTest):
@@ -401,3 +401,151 @@ class TestAchievement(BaseDBTest):
         self.assertEqual(result2["levels"]["2"]["goals"]["1"]["goal_goal"], 4)
         self.assertEqual(result2["levels"]["3"]["goals"]["2"]["goal_goal"], 3)
 
+
+    def test_achievement_dependencies(self):
+
+        user = create_user()
+
+        base = create_achievement(achievement_name="base_achievement")
+        advanced = create_achievement(achievement_name="advanced_achievement")
+        beginner = create_achievement(achievement_name="beginner_achievement")
+
+        advanced.requirements.append(base)
+        beginner.denials.append(base)
+        DBSession.flush()
+        clear_all_caches()
+
+        dependencies = Achievement.get_achievement_dependencies()
+        self.assertEqual(dependencies[advanced.id]["requirements"], [base.id])
+        self.assertEqual(dependencies[beginner.id]["denials"], [base.id])
+
+        # requirements and denials are evaluated first
+        ordered = Achievement.sort_by_dependencies([advanced, beginner, base], dependencies)
+        self.assertEqual([a.id for a in ordered], [base.id, advanced.id, beginner.id])
+
+        reached = Achievement.get_reached_achievement_ids(user["id"], {base.id, advanced.id, beginner.id})
+        self.assertEqual(reached, set())
+        self.assertTrue(Achievement.is_unlocked(base.id, dependencies, reached))
+        self.assertFalse(Achievement.is_unlocked(advanced.id, dependencies, reached))
+        self.assertTrue(Achievement.is_unlocked(beginner.id, dependencies, reached))
+
+        achievement_date = Achievement.get_datetime_for_evaluation_type(base.evaluation_timezone, base.evaluation)
+        create_achievement_user(user=user, achievement=base, achievement_date=achievement_date, level=1)
+
+        reached = Achievement.get_reached_achievement_ids(user["id"], {base.id, advanced.id, beginner.id})
+        self.assertEqual(reached, {base.id})
+        self.assertTrue(Achievement.is_unlocked(advanced.id, dependencies, reached))
+        self.assertFalse(Achievement.is_unlocked(beginner.id, dependencies, reached))
+
+        # locked achievements are returned without evaluating their goals
+        locked = Achievement.locked_output(user, Achievement.get_achievement(beginner.id), achievement_date)
+        self.assertTrue(locked["locked"])
+        self.assertEqual(locked["level"], 0)
+        self.assertEqual(locked["goals"], {})
+
+    def test_evaluate_cache_generations(self):
+
+        user1 = create_user()
+        user2 = create_user()
+        user3 = create_user(friends=[user1["id"]])
+
+        global_achievement = create_achievement(achievement_name="global_achievement", achievement_relevance="global")
+        friends_achievement = create_achievement(achievement_name="friends_achievement", achievement_relevance="friends")
+        clear_all_caches()
+
+        achievement_date = Achievement.get_datetime_for_evaluation_type(global_achievement.evaluation_timezone, global_achievement.evaluation)
+        global_row = Achievement.get_achievement(global_achievement.id)
+        friends_row = Achievement.get_achievement(friends_achievement.id)
+
+        def generations(achievement):
+            return [Achievement.get_evaluation_generation(achievement, achievement_date, u["id"]) for u in (user1, user2, user3)]
+
+        # one counter is shared by all users of a global leaderboard
+        before = generations(global_row)
+        self.assertEqual(before, generations(global_row))
+        Achievement.invalidate_evaluate_cache(user2["id"], global_row, achievement_date)
+        after = generations(global_row)
+        self.assertTrue(all(b != a for b, a in zip(before, after)))
+
+        # for friends leaderboards only the users who have the user as friend are affected
+        before = generations(friends_row)
+        Achievement.invalidate_evaluate_cache(user1["id"], friends_row, achievement_date)
+        after = generations(friends_row)
+        self.assertNotEqual(before[0], after[0])
+        self.assertEqual(before[1], after[1])
+        self.assertNotEqual(before[2], after[2])
+
+    def test_evaluation_batch(self):
+
+        user = create_user()
+        achievement = create_achievement(achievement_name="invite_users_achievement", achievement_relevance="own")
+        create_goals(achievement,
+                     goal_condition="""{"term": {"type": "literal", "variable": "invite_users"}}""",
+                     goal_goal="1*level")
+        create_variable("invite_users", variable_group="day")
+        Value.increase_value(variable_name="invite_users", user=user, value=1, key=None)
+        clear_all_caches()
+
+        achievement_date = Achievement.get_datetime_for_evaluation_type(achievement.evaluation_timezone, achievement.evaluation)
+        row = Achievement.get_achievement(achievement.id)
+
+        batch = EvaluationBatch(user, [(row, achievement_date)])
+        self.assertEqual(len(batch.outputs), 0)
+        output = Achievement.evaluate(user, achievement.id, achievement_date, batch=batch)
+        self.assertEqual(output["level"], 1)
+
+        # the stored evaluation is found by the next batch and by evaluations without batch
+        batch = EvaluationBatch(user, [(row, achievement_date)])
+        self.assertEqual(len(batch.outputs), 1)
+        self.assertEqual(Achievement.evaluate(user, achievement.id, achievement_date, batch=batch)["level"], 1)
+        self.assertEqual(Achievement.evaluate(user, achievement.id, achievement_date)["level"], 1)
+
+    def test_definition_edits_invalidate_caches(self):
+
+        user = create_user()
+        achievement = create_achievement(achievement_name="invite_users_achievement")
+        goal = create_goals(achievement)
+        DBSession.flush()
+        clear_all_caches()
+
+        achievement_date = Achievement.get_datetime_for_evaluation_type(achievement.evaluation_timezone, achievement.evaluation)
+        row = Achievement.get_achievement(achievement.id)
+        generation = Achievement.get_evaluation_generation(row, achievement_date, user.id)
+        goal_generation = Goal.get_definition_generations([goal.id])[goal.id]
+        lists_generation = Achievement.get_list_generation()
+        self.assertEqual(Goal.basic_goal_output(goal.id, 1)["goal_goal"], 5)
+
+        # the edit is collected during the flush and applied after the commit
+        goal.goal = "7*level"
+        DBSession.flush()
+        items = DBSession.info.pop("definition_invalidations")
+        self.assertIn(("goal", goal.id, achievement.id, achievement.maxlevel), items)
+        invalidate_definition_caches(items)
+
+        self.assertEqual(Goal.basic_goal_output(goal.id, 1)["goal_goal"], 7)
+        self.assertNotEqual(Achievement.get_evaluation_generation(row, achievement_date, user.id), generation)
+        self.assertNotEqual(Goal.get_definition_generations([goal.id])[goal.id], goal_generation)
+        self.assertNotEqual(Achievement.get_list_generation(), lists_generation)
+
+    def test_scoped_leaderboards(self):
+
+        user1 = create_user(city="Paderborn", groups=[1, 2])
+        user2 = create_user(city="Paderborn", groups=[2])
+        user3 = create_user(city="Berlin", groups=[1])
+
+        city_achievement = create_achievement(achievement_name="city_achievement", achievement_relevance="city")
+        groups_achievement = create_achievement(achievement_name="groups_achievement", achievement_relevance="groups")
+        clear_all_caches()
+
+        self.assertEqual(User.get_leaderboard_scopes(user1["id"]), ["city:Paderborn", "group:1", "group:2"])
+        self.assertEqual(Achievement.get_relevant_users_by_achievement_and_user(city_achievement, user1["id"]), {user1["id"], user2["id"]})
+        self.assertEqual(Achievement.get_relevant_users_by_achievement_and_user(groups_achievement, user1["id"]), {user1["id"], user3["id"]})
+        self.assertEqual(Achievement.get_relevant_users_by_achievement_and_user_reverse(groups_achievement, user1["id"]), {user1["id"], user2["id"], user3["id"]})
+        self.assertEqual(Achievement.get_leaderboard_users_and_scope(groups_achievement, user2["id"]), (None, "group:2"))
+
+        # the scopes are updated when the user moves, after the commit
+        create_user(user_id=user3["id"], city="Paderborn", groups=[2])
+        self.assertEqual(User.get_leaderboard_scopes(user3["id"]), ["city:Berlin", "group:1"])
+        DBSession.commit()
+        self.assertEqual(User.get_leaderboard_scopes(user3["id"]), ["city:Paderborn", "group:2"])
+        self.assertEqual(Achievement.get_relevant_users_by_achievement_and_user(city_achievement, user1["id"]), {user1["id"], user2["id"], user3["id"]})
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from sqlalchemy.sql.expression import select
+
+from gengine.app.tests.base import BaseDBTest
+from gengine.metadata import DBSession
+
+
+class TestBackfill(BaseDBTest):
+
+    def test_backfill_trigger_step(self):
+        from gengine.app.backfill import backfill_trigger_step
+        from gengine.app.model import Value, GoalTrigger, GoalTriggerStep, t_goal_trigger_step_executions
+        from gengine.app.tests.helpers import create_user, create_achievement, create_variable, create_goals, create_achievement_user
+
+        achievement = create_achievement(achievement_name="invite_users_achievement")
+        goal = create_goals(achievement)
+        create_variable("invite_users", variable_group="day")
+
+        # goal = 5*level
+        user1 = create_user()
+        user2 = create_user()
+        create_user()
+        user4 = create_user()
+        Value.increase_value(variable_name="invite_users", user=user1, value=4, key=None)
+        Value.increase_value(variable_name="invite_users", user=user2, value=1, key=None)
+        Value.increase_value(variable_name="invite_users", user=user4, value=8, key=None)
+        create_achievement_user(user4, achievement, None, 1)
+
+        trigger = GoalTrigger()
+        trigger.name = "half"
+        trigger.goal_id = goal.id
+        trigger.execute_when_complete = False
+        DBSession.add(trigger)
+        DBSession.flush()
+        step = GoalTriggerStep()
+        step.goal_trigger_id = trigger.id
+        step.step = 0
+        step.condition_type = "percentage"
+        step.condition_percentage = 0.5
+        step.action_type = "user_message"
+        DBSession.add(step)
+        DBSession.flush()
+
+        # the executions are inserted when the step is saved
+        executions = DBSession.execute(select([t_goal_trigger_step_executions])).fetchall()
+        # user1 has 80% of level 1, user4 has 60% of level 2
+        self.assertEqual(sorted((x["user_id"], x["execution_level"]) for x in executions), [(user1.id, 1), (user4.id, 2)])
+
+        # in batches, without duplicates when the step is saved again
+        DBSession.execute(t_goal_trigger_step_executions.delete().where(t_goal_trigger_step_executions.c.user_id == user4.id))
+        trigger_step = {"id": step.id, "goal_trigger_id": trigger.id, "condition_type": "percentage", "condition_percentage": 0.5}
+        self.assertEqual(backfill_trigger_step(trigger_step, DBSession.connection(), batch_size=1), 1)
+        self.assertEqual(backfill_trigger_step(trigger_step, DBSession.connection()), 0)
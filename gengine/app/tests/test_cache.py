@@ -0,0 +1,25 @@
+import unittest
+
+from gengine.base.cache import function_key_generator, my_key_mangler
+
+
+class TestCacheKeys(unittest.TestCase):
+
+    def test_function_keys_are_normalized(self):
+        def trs(cls, translation_id, params):
+            pass
+
+        generate = function_key_generator(None, trs)
+        # cls is skipped, dicts are sorted and ids are compared as strings
+        self.assertEqual(generate(object, 1, {"level": 1, "goal": 5}), generate(None, "1", {"goal": 5, "level": 1}))
+        self.assertNotEqual(generate(None, 1, {"level": 1}), generate(None, 1, {"level": 2}))
+        self.assertEqual(generate(None, 1, {"level": 1}), "gengine.app.tests.test_cache:trs|1 {level=1}")
+
+    def test_mangled_keys_have_fixed_length(self):
+        mangle = my_key_mangler("general", version="3")
+        short = mangle("a")
+        long = mangle("x" * 1000)
+        self.assertTrue(short.startswith("general:3:"))
+        self.assertEqual(len(short), len(long))
+        self.assertNotEqual(short, long)
+        self.assertNotEqual(short, my_key_mangler("general", version="4")("a"))
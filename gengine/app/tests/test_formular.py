@@ -0,0 +1,119 @@
+import unittest
+
+from sqlalchemy.sql import column
+from unittest.mock import patch
+
+from gengine.app import formular
+from gengine.app.formular import NumericStringParser, evaluate_value_expression, compile_value_expression, \
+    evaluate_string, render_string, evaluate_value_expression_array, compile_template, compile_string, \
+    FormularEvaluationException, evaluate_condition, validate_condition, get_term_validator
+
+
+class TestFormular(unittest.TestCase):
+
+    def test_compiled_expressions_equal_parser(self):
+        expressions = ["5*level", "3*level+2", "2^3^2", "-level", "-(level-1)*2", "10/4", "level^2-level",
+                       "abs(-3)", "trunc(2.7)", "round(2.4)", "sgn(level-1)", "PI", "E*2", "unknown(3)+1", "1.5e2", "LEVEL*2"]
+        for level in (0, 1, 5):
+            params = {"level": level}
+            for expression in expressions:
+                expected = NumericStringParser(extra_literals=params.keys()).eval(expression, key_value_map=params)
+                self.assertEqual(evaluate_value_expression(expression, params), expected, expression)
+
+    def test_compiled_once(self):
+        compile_value_expression.cache_clear()
+        for level in range(10):
+            evaluate_value_expression("7*level", {"level": level})
+        info = compile_value_expression.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 9))
+
+        # the parameter names are part of the key
+        self.assertEqual(evaluate_value_expression("7*goal", {"level": 1, "goal": 2}), 14)
+        self.assertRaises(FormularEvaluationException, evaluate_value_expression, "7*goal", {"level": 1})
+
+    def test_errors(self):
+        self.assertIsNone(evaluate_value_expression(None))
+        self.assertRaises(FormularEvaluationException, evaluate_value_expression, "5*", {"level": 1})
+        self.assertRaises(FormularEvaluationException, evaluate_value_expression, "5/level", {"level": 0})
+
+    def test_evaluate_string(self):
+        self.assertEqual(evaluate_string("${5*level}", {"level": 2}), 10)
+        self.assertEqual(evaluate_string("invite ${5*level} friends", {"level": 2}), "invite 10 friends")
+        self.assertEqual(evaluate_string("text"), "text")
+        self.assertEqual(evaluate_string("12"), 12)
+        self.assertEqual(evaluate_string("${level/2}", {"level": 1}), "0.5")
+        self.assertEqual(evaluate_string("1${level}", {"level": 2}), 12)
+        self.assertEqual(evaluate_string("-${level}", {"level": 2}), -2)
+        self.assertEqual(evaluate_string("${level} and ${level*2}", {"level": 2}), "2 and 4")
+        self.assertEqual(evaluate_string("${level}", {"level": 2, "goal": 5}), 2)
+        self.assertRaises(FormularEvaluationException, evaluate_string, "${5*}", {"level": 1})
+        self.assertRaises(FormularEvaluationException, evaluate_string, "${5/level}", {"level": 0})
+
+    def test_templates_compiled_once(self):
+        compile_string.cache_clear()
+        compile_template.cache_clear()
+        for level in range(10):
+            evaluate_string("invite ${5*level} friends", {"level": level})
+        info = compile_string.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 9))
+        self.assertEqual(compile_template.cache_info().misses, 1)
+        self.assertEqual(render_string("invite ${5*level} friends", {"level": 3}), "invite 15 friends")
+        self.assertEqual(compile_template.cache_info().misses, 1)
+
+
+class TestFormularArrays(unittest.TestCase):
+
+    expressions = ["5*level", "3*level+2", "level^2-level", "-(level-1)*2", "abs(3-level)", "trunc(level/2)", "7",
+                   "sgn(level-2)", "round(level/3)", "level"]
+
+    def check(self, evaluate):
+        levels = list(range(1, 8))
+        for expression in self.expressions:
+            expected = [evaluate_value_expression(expression, {"level": l}) for l in levels]
+            values = evaluate(expression, {"level": levels})
+            values = values.tolist() if hasattr(values, "tolist") else values
+            self.assertEqual(values, expected, expression)
+            # ints (e.g. of trunc) and floats as in the scalar evaluation
+            self.assertEqual([type(x) for x in values], [type(x) for x in expected], expression)
+
+    @unittest.skipIf(formular.numpy is None, "numpy not installed")
+    def test_numpy(self):
+        self.check(evaluate_value_expression_array)
+
+        # a cohort: levels and values of three users
+        levels = formular.numpy.array([1, 2, 3])
+        values = formular.numpy.array([5, 5, 20])
+        self.assertEqual(list(values >= evaluate_value_expression_array("5*level", {"level": levels})), [True, False, True])
+        self.assertRaises(FormularEvaluationException, evaluate_value_expression_array, "5/level", {"level": [0, 1]})
+
+    def test_without_numpy(self):
+        with patch.object(formular, "numpy", None):
+            self.check(evaluate_value_expression_array)
+            self.assertEqual(evaluate_value_expression_array("level*goal", {"level": [1, 2], "goal": 3}), [3, 6])
+            self.assertEqual(evaluate_value_expression_array("level*2", {"level": 2}), 4)
+            self.assertRaises(FormularEvaluationException, evaluate_value_expression_array, "level*goal",
+                              {"level": [1, 2], "goal": [1, 2, 3]})
+
+
+class TestConditions(unittest.TestCase):
+
+    def test_validate_condition(self):
+        validate_condition('{"term": {"type": "literal", "variable": "invite_users"}}')
+        validate_condition({"term": {"type": "disjunction", "terms": [
+            {"type": "literal", "variable": "participate", "key_operator": "ILIKE", "key": ["%blah%"]},
+            {"type": "literal", "variable": "participate", "key": ["2"]}
+        ]}})
+        self.assertRaises(FormularEvaluationException, validate_condition, '{"term": ')
+        self.assertRaises(FormularEvaluationException, validate_condition, '{"term": {"type": "literal"}}')
+        self.assertRaises(FormularEvaluationException, validate_condition,
+                          '{"term": {"type": "literal", "variable": "x", "key_operator": "LIKE", "key": ["a"]}}')
+        self.assertRaises(FormularEvaluationException, validate_condition, '{"term": {"variable": "x"}}')
+
+    def test_evaluate_condition(self):
+        variable, key = column("name"), column("key")
+        condition = '{"term": {"key": ["5","7"], "type": "literal", "key_operator": "IN", "variable": "participate"}}'
+        expected = str(evaluate_condition(condition, variable, key))
+        self.assertIn("key IN", expected)
+        self.assertEqual(str(evaluate_condition(condition, variable, key, validate=False)), expected)
+        self.assertRaises(FormularEvaluationException, evaluate_condition, '{"term": {"type": "literal"}}', variable, key)
+        self.assertIs(get_term_validator(), get_term_validator())
@@ -188,3 +188,69 @@ class TestEvaluateGoal(BaseDBTest):
 
         print(positions)
         self.assertEqual(positions[0]["value"], 15.00)
+
+    def test_translations_rendered_in_memory(self):
+        from gengine.app.cache import clear_all_caches
+        from gengine.app.model import TranslationVariable, Translation
+        from gengine.app.tests.helpers import get_or_create_language
+        from gengine.metadata import DBSession
+
+        en = get_or_create_language("en")
+        get_or_create_language("de")
+        translation_variable = TranslationVariable()
+        translation_variable.name = "invite_users_goal_name"
+        DBSession.add(translation_variable)
+        DBSession.flush()
+        translation = Translation()
+        translation.translationvariable_id = translation_variable.id
+        translation.language_id = en.id
+        translation.text = "Invite ${goal} friends"
+        DBSession.add(translation)
+        DBSession.flush()
+        clear_all_caches()
+
+        self.assertEqual(Translation.trs(translation_variable.id, {"level": 1, "goal": 5}),
+                         {"en": "Invite 5 friends", "de": "Invite 5 friends"})
+        self.assertEqual(Translation.trs(translation_variable.id, {"level": 2, "goal": 10})["de"], "Invite 10 friends")
+        # the unrendered texts are cached by id
+        self.assertEqual(Translation.get_translation_texts(translation_variable.id),
+                         {"en": "Invite ${goal} friends", "de": "Invite ${goal} friends"})
+        self.assertIsNone(Translation.trs(None))
+
+        # an edit deletes the entries of this translation only
+        other = TranslationVariable()
+        other.name = "other"
+        DBSession.add(other)
+        DBSession.flush()
+        Translation.get_translation_texts(other.id)
+        translation.text = "Invite ${goal} users"
+        DBSession.flush()
+        items = DBSession.info.pop("definition_invalidations")
+        self.assertIn(("translation", translation_variable.id), items)
+        self.assertNotIn(("translation", other.id), items)
+        from gengine.app.model import invalidate_definition_caches
+        invalidate_definition_caches(items)
+        self.assertEqual(Translation.get_translation_texts(translation_variable.id)["en"], "Invite ${goal} users")
+
+    def test_negotiate_language(self):
+        from webob import Request
+        from gengine.app.model import Translation
+        from gengine.app.tests.helpers import get_or_create_language
+
+        get_or_create_language("en")
+        de = get_or_create_language("de")
+        user = create_user(language="de")
+        accept_language = lambda header: Request.blank("/", headers={"Accept-Language": header}).accept_language
+
+        self.assertEqual(Translation.negotiate_language("de"), "de")
+        self.assertEqual(Translation.negotiate_language("fr"), "en")
+        self.assertEqual(Translation.negotiate_language(accept_language=accept_language("de-DE,en;q=0.5")), "de")
+        self.assertEqual(Translation.negotiate_language(accept_language=accept_language("fr")), "en")
+        self.assertEqual(Translation.negotiate_language(user=User.get_user(user.id)), "de")
+        self.assertEqual(Translation.negotiate_language("en", user=User.get_user(user.id)), "en")
+
+        output = {"levels": {"1": {"goals": {"1": {"goal_name": {"en": "Invite", "de": "Einladen"}}},
+                                   "rewards": {"1": {"value_translated": {"en": "Badge"}}}}}}
+        Translation.select_language(output, de.name)
+        self.assertEqual(output["levels"]["1"]["goals"]["1"]["goal_name"], {"de": "Einladen"})
+        self.assertEqual(output["levels"]["1"]["rewards"]["1"]["value_translated"], {"de": "Badge"})
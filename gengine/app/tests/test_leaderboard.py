@@ -0,0 +1,64 @@
+import unittest
+
+from gengine.app.leaderboard import MemoryLeaderboardStore, city_scope, group_scope
+
+
+class TestMemoryLeaderboardStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryLeaderboardStore()
+        self.store.rebuild(1, None, [(1, 12.0), (2, 2.0), (3, 11.0), (4, 6.0)])
+
+    def test_rank_and_top(self):
+        self.assertTrue(self.store.exists(1, None))
+        self.assertFalse(self.store.exists(2, None))
+        self.assertEqual(self.store.size(1, None), 4)
+
+        self.assertEqual(self.store.rank(1, None, 1), 0)
+        self.assertEqual(self.store.rank(1, None, 2), 3)
+        self.assertIsNone(self.store.rank(1, None, 5))
+
+        self.assertEqual(self.store.top(1, None, 2), [(0, 1, 12.0), (1, 3, 11.0)])
+        self.assertEqual(self.store.top(1, None, 2, offset=2), [(2, 4, 6.0), (3, 2, 2.0)])
+
+    def test_update_and_ties(self):
+        self.store.set_value(1, None, 2, 11.0)
+        # equal values are ordered by user_id (descending)
+        self.assertEqual(self.store.top(1, None, 4), [(0, 1, 12.0), (1, 3, 11.0), (2, 2, 11.0), (3, 4, 6.0)])
+
+        self.store.set_value(1, None, 5, 20.0)
+        self.assertEqual(self.store.rank(1, None, 5), 0)
+
+        # boards which have not been built are not touched
+        self.store.set_value(2, None, 5, 20.0)
+        self.assertFalse(self.store.exists(2, None))
+
+    def test_around_and_values(self):
+        self.assertEqual(self.store.around(1, None, 3, 1), [(0, 1, 12.0), (1, 3, 11.0), (2, 4, 6.0)])
+        self.assertEqual(self.store.around(1, None, 1, 1), [(0, 1, 12.0), (1, 3, 11.0)])
+        self.assertEqual(self.store.around(1, None, 5, 1), [])
+        self.assertEqual(self.store.get_values(1, None, [1, 2, 5]), {1: 12.0, 2: 2.0})
+
+    def test_remove_user(self):
+        self.store.remove_user(3)
+        self.assertEqual(self.store.top(1, None, 4), [(0, 1, 12.0), (1, 4, 6.0), (2, 2, 2.0)])
+
+    def test_scopes(self):
+        scope = group_scope(7)
+        self.store.rebuild(1, None, [(1, 12.0), (4, 6.0)], scope=scope)
+        self.assertTrue(self.store.exists(1, None, scope))
+        self.assertFalse(self.store.exists(1, None, city_scope("Paderborn")))
+        self.assertEqual(self.store.rank(1, None, 4, scope=scope), 1)
+
+        # values are written to the scoped boards of the user
+        self.store.set_value(1, None, 4, 13.0, scopes=[scope])
+        self.assertEqual(self.store.top(1, None, 2, scope=scope), [(0, 4, 13.0), (1, 1, 12.0)])
+        self.assertEqual(self.store.rank(1, None, 4), 0)
+
+        # joining and leaving the scope
+        self.store.update_scopes(3, [], [scope])
+        self.store.update_scopes(1, [scope], [])
+        self.assertEqual(self.store.top(1, None, 3, scope=scope), [(0, 4, 13.0), (1, 3, 11.0)])
+
+        self.store.remove_user(4)
+        self.assertEqual(self.store.size(1, None, scope), 1)
@@ -0,0 +1,46 @@
+import unittest
+
+from dogpile.cache import make_region
+
+from gengine.base.localcache import LocalCacheProxy, LocalInvalidationChannel
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        # two processes sharing one backend
+        shared = make_region().configure("dogpile.cache.memory")
+        self.channel = LocalInvalidationChannel()
+        self.proxy1 = LocalCacheProxy("general", max_size=2, ttl=60, channel=self.channel)
+        self.proxy2 = LocalCacheProxy("general", max_size=2, ttl=60, channel=self.channel)
+        self.region1 = make_region().configure("dogpile.cache.memory", wrap=[self.proxy1])
+        self.region2 = make_region().configure("dogpile.cache.memory", wrap=[self.proxy2])
+        self.region2.backend.proxied = self.region1.backend.proxied = shared.backend
+
+    def test_hits_and_lru(self):
+        self.region1.set("a", 1)
+        self.assertEqual(self.region2.get("a"), 1)
+        self.assertEqual(self.region2.get("a"), 1)
+        self.assertEqual(self.proxy2.stats, {"local_hits": 1, "hits": 1, "misses": 0})
+
+        self.region2.get("b")
+        self.assertEqual(self.proxy2.stats["misses"], 1)
+
+        self.region1.set("b", 2)
+        self.region1.set("c", 3)
+        self.assertEqual(self.proxy1.size(), 2)
+
+    def test_invalidation(self):
+        self.region1.set("a", 1)
+        self.assertEqual(self.region2.get("a"), 1)
+
+        # the write of the first process drops the local copy of the second
+        self.region1.set("a", 2)
+        self.assertEqual(self.region2.get("a"), 2)
+
+        self.region1.delete("a")
+        self.assertEqual(self.proxy2.size(), 0)
+
+        self.region2.get("a")
+        self.proxy1.clear_local()
+        self.assertEqual(self.proxy2.size(), 0)
@@ -0,0 +1,71 @@
+import threading
+import unittest
+
+from dogpile.cache import make_region
+
+from gengine.base.locks import LocalLockBackend, setup_lock_backend, locked_get_or_create, cache_lock
+
+
+class TestLocks(unittest.TestCase):
+
+    def setUp(self):
+        setup_lock_backend(LocalLockBackend())
+        self.region = make_region().configure("dogpile.cache.memory")
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.calls = []
+
+    def tearDown(self):
+        setup_lock_backend(None)
+
+    def slow_creator(self):
+        self.calls.append(1)
+        self.started.set()
+        self.proceed.wait(5)
+        return "new"
+
+    def start_creation(self):
+        thread = threading.Thread(target=lambda: locked_get_or_create(self.region, "key_2", self.slow_creator, stale_key="latest"))
+        thread.start()
+        self.started.wait(5)
+        return thread
+
+    def test_waits_for_the_creating_thread(self):
+        thread = self.start_creation()
+        results = []
+        waiting = threading.Thread(target=lambda: results.append(locked_get_or_create(self.region, "key_2", self.slow_creator, stale_key="latest")))
+        waiting.start()
+        self.proceed.set()
+        thread.join(5)
+        waiting.join(5)
+
+        self.assertEqual(results, ["new"])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.region.get("latest"), "new")
+
+    def test_serves_stale_value(self):
+        self.region.set("latest", "old")
+        thread = self.start_creation()
+
+        self.assertEqual(locked_get_or_create(self.region, "key_2", self.slow_creator, stale_key="latest", serve_stale=True), "old")
+        self.proceed.set()
+        thread.join(5)
+        self.assertEqual(locked_get_or_create(self.region, "key_2", self.slow_creator, stale_key="latest"), "new")
+        self.assertEqual(len(self.calls), 1)
+
+    def test_no_stale_value_by_default(self):
+        self.region.set("latest", "old")
+        thread = self.start_creation()
+        results = []
+        waiting = threading.Thread(target=lambda: results.append(locked_get_or_create(self.region, "key_2", self.slow_creator, stale_key="latest")))
+        waiting.start()
+        self.proceed.set()
+        thread.join(5)
+        waiting.join(5)
+
+        self.assertEqual(results, ["new"])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_reentrant(self):
+        with cache_lock(self.region, "key"):
+            self.assertEqual(locked_get_or_create(self.region, "key", lambda: "value"), "value")
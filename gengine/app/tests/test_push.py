@@ -0,0 +1,214 @@
+import unittest
+
+from sqlalchemy.sql.expression import select
+
+from gengine.app.model import TranslationVariable, Translation, UserMessage, t_user_messages
+from gengine.app.push import PushDispatcher, StubPushGateway
+from gengine.app.tests.base import BaseDBTest
+from gengine.app.tests.helpers import create_user, create_device, get_or_create_language
+from gengine.metadata import DBSession
+
+
+class TestPushDispatcher(BaseDBTest):
+
+    def create_message(self, user, translation_id):
+        DBSession.add(UserMessage(user_id=user.id, translation_id=translation_id, params={"level": 2},
+                                  is_read=False, has_been_pushed=False))
+        DBSession.flush()
+        return DBSession.execute(select([t_user_messages]).where(t_user_messages.c.user_id == user.id)).fetchone()
+
+    def test_dispatch(self):
+        en = get_or_create_language("en")
+        translation_variable = TranslationVariable()
+        translation_variable.name = "level_reached"
+        DBSession.add(translation_variable)
+        DBSession.flush()
+        translation = Translation()
+        translation.translationvariable_id = translation_variable.id
+        translation.language_id = en.id
+        translation.text = "Level ${level} reached"
+        DBSession.add(translation)
+        DBSession.flush()
+
+        user1 = create_user(language="en")
+        user2 = create_user(language="en")
+        user3 = create_user(language="en")
+        create_device(user_id=user1.id, device_id="1", device_os="Android", push_id="prod_a1")
+        create_device(user_id=user2.id, device_id="2", device_os="Android", push_id="dev_a2")
+        create_device(user_id=user3.id, device_id="3", device_os="iOS 10", push_id="prod_i3")
+        messages = [self.create_message(user, translation_variable.id) for user in (user1, user2, user3)]
+
+        gateway = StubPushGateway(fail_for=["prod_i3"])
+        sent = PushDispatcher(gateway=gateway, workers=2).dispatch(messages)
+
+        # one GCM request for both android devices, the failed message stays unpushed
+        self.assertEqual(gateway.gcm, [(["a1", "a2"], "Level 2 reached", 1)])
+        self.assertEqual(sorted(sent), sorted([messages[0]["id"], messages[1]["id"]]))
+        pushed = {x["user_id"]: x["has_been_pushed"] for x in DBSession.execute(select([t_user_messages])).fetchall()}
+        self.assertEqual(pushed, {user1.id: True, user2.id: True, user3.id: False})
+
+        gateway = StubPushGateway()
+        PushDispatcher(gateway=gateway).dispatch([DBSession.execute(select([t_user_messages]).where(t_user_messages.c.user_id == user3.id)).fetchone()])
+        self.assertEqual(gateway.apns, [("prod_i3", "Level 2 reached", 1)])
+
+
+    def test_failed_deliveries(self):
+        from unittest.mock import patch
+
+        user1 = create_user()
+        user2 = create_user()
+        create_device(user_id=user1.id, device_id="1", device_os="Android", push_id="prod_a1")
+        create_device(user_id=user1.id, device_id="2", device_os="iOS 10", push_id="prod_i1")
+        create_device(user_id=user2.id, device_id="3", device_os="Android", push_id="prod_a2")
+        for user in (user1, user2):
+            DBSession.add(UserMessage(user_id=user.id, params={}, rendered_text={"en": "Hello"},
+                                      is_read=False, has_been_pushed=False))
+        DBSession.flush()
+        messages = lambda: {x["user_id"]: x for x in DBSession.execute(select([t_user_messages])).fetchall()}
+
+        # a failed GCM request only fails the messages of its recipients
+        with patch("gengine.app.push.GCM_MAX_RECIPIENTS", 1):
+            sent = PushDispatcher(gateway=StubPushGateway(fail_for=["a1"])).dispatch(list(messages().values()))
+        self.assertEqual(sent, [messages()[user2.id]["id"]])
+        self.assertFalse(messages()[user1.id]["has_been_pushed"])
+        self.assertEqual(messages()[user1.id]["pushed_devices"], ["prod_i1"])
+
+        # the retry is only sent to the failed device
+        gateway = StubPushGateway()
+        PushDispatcher(gateway=gateway).dispatch([messages()[user1.id]])
+        self.assertEqual(gateway.apns, [])
+        self.assertEqual([x[0] for x in gateway.gcm], [["a1"]])
+        self.assertTrue(messages()[user1.id]["has_been_pushed"])
+
+    def test_gcm_errors(self):
+        user1 = create_user()
+        user2 = create_user()
+        create_device(user_id=user1.id, device_id="1", device_os="Android", push_id="prod_a1")
+        create_device(user_id=user1.id, device_id="2", device_os="Android", push_id="prod_a2")
+        create_device(user_id=user2.id, device_id="3", device_os="Android", push_id="prod_a3")
+        for user in (user1, user2):
+            DBSession.add(UserMessage(user_id=user.id, params={}, rendered_text={"en": "Hello"},
+                                      is_read=False, has_been_pushed=False))
+        DBSession.flush()
+        messages = lambda: {x["user_id"]: x for x in DBSession.execute(select([t_user_messages])).fetchall()}
+
+        # one request to all devices, the registration id which is unavailable fails its message
+        gateway = StubPushGateway(unavailable=["a2"])
+        sent = PushDispatcher(gateway=gateway).dispatch(list(messages().values()))
+        self.assertEqual(len(gateway.gcm), 1)
+        self.assertEqual(sent, [messages()[user2.id]["id"]])
+        self.assertFalse(messages()[user1.id]["has_been_pushed"])
+        self.assertEqual(messages()[user1.id]["pushed_devices"], ["prod_a1"])
+
+
+class TestPushWorker(BaseDBTest):
+
+    def test_retries(self):
+        from gengine.app.push import PushWorker
+
+        user = create_user()
+        create_device(user_id=user.id, device_id="1", device_os="iOS 10", push_id="prod_i1")
+        DBSession.execute(t_user_messages.insert().values({
+            "user_id": user.id, "translation_id": None, "params": {}, "is_read": False, "has_been_pushed": False
+        }))
+        message = lambda: DBSession.execute(select([t_user_messages])).fetchone()
+
+        gateway = StubPushGateway(fail_for=["prod_i1"])
+        worker = PushWorker(dispatcher=PushDispatcher(gateway=gateway), settings={"push.retry.max_attempts": 2})
+        self.assertEqual(worker.process_batch(), 1)
+        self.assertEqual(message()["push_attempts"], 1)
+        self.assertFalse(message()["has_been_pushed"])
+
+        # the message is not claimed again before the retry time
+        self.assertEqual(worker.process_batch(), 0)
+        DBSession.execute(t_user_messages.update().values({"push_retry_at": None}))
+        self.assertEqual(worker.run_until_empty(), 1)
+        # given up after max_attempts
+        self.assertEqual(message()["push_attempts"], 2)
+        self.assertTrue(message()["has_been_pushed"])
+
+
+class TestPushWorkerListen(unittest.TestCase):
+
+    def test_listen_connection_is_detached(self):
+        from unittest.mock import MagicMock
+        from gengine.app.push import PushWorker
+
+        engine = MagicMock()
+        engine.dialect.name = "postgresql"
+        fairy = engine.raw_connection.return_value
+        worker = PushWorker(dispatcher=PushDispatcher(gateway=StubPushGateway()), engine=engine, settings={})
+        worker.listen()
+
+        # the autocommit connection is never returned to the pool
+        fairy.detach.assert_called_once_with()
+        self.assertTrue(fairy.connection.autocommit)
+        fairy.connection.cursor.return_value.execute.assert_called_once_with("LISTEN gengine_push_messages")
+
+        worker.unlisten()
+        fairy.close.assert_called_once_with()
+        self.assertIsNone(worker._listen_connection)
+
+
+class TestUnreadMessages(BaseDBTest):
+
+    def test_counter(self):
+        from gengine.app.model import User
+
+        user = create_user()
+        messages = [UserMessage(user_id=user.id, params={}, is_read=False, has_been_pushed=True) for i in range(3)]
+        for message in messages:
+            DBSession.add(message)
+        DBSession.flush()
+        self.assertEqual(User.get_user(user.id)["unread_messages"], 3)
+
+        messages[0].is_read = True
+        DBSession.flush()
+        self.assertEqual(User.get_user(user.id)["unread_messages"], 2)
+
+        DBSession.delete(messages[1])
+        DBSession.delete(messages[0])
+        DBSession.flush()
+        self.assertEqual(User.get_user(user.id)["unread_messages"], 1)
+
+
+class TestMessageTexts(BaseDBTest):
+
+    def test_stored_text(self):
+        user = create_user()
+        DBSession.add(UserMessage(user_id=user.id, params={}, rendered_text={"en": "Level 2", "de": "Stufe 2"},
+                                  is_read=False, has_been_pushed=True))
+        DBSession.flush()
+        row = DBSession.execute(select([t_user_messages])).fetchone()
+
+        self.assertEqual(UserMessage.get_text(row), {"en": "Level 2", "de": "Stufe 2"})
+        self.assertEqual(UserMessage.get_text(row, language="de"), {"de": "Stufe 2"})
+        # missing languages use the fallback language
+        self.assertEqual(UserMessage.get_text(row, language="fr"), {"fr": "Level 2"})
+
+
+class TestArchiveMessages(BaseDBTest):
+
+    def test_archive(self):
+        import datetime
+        from gengine.app.model import t_user_messages_archive
+
+        user = create_user()
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=100)
+        for is_read, has_been_pushed, created_at in [(True, True, old), (True, True, old), (False, True, old),
+                                                     (True, False, old), (True, True, datetime.datetime.utcnow())]:
+            DBSession.execute(t_user_messages.insert().values({
+                "user_id": user.id, "params": {}, "is_read": is_read, "has_been_pushed": has_been_pushed, "created_at": created_at
+            }))
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+
+        # only old messages which have been read and pushed are moved
+        self.assertEqual(UserMessage.archive_messages(before, batch_size=1), 1)
+        self.assertEqual(UserMessage.archive_messages(before, batch_size=10), 1)
+        self.assertEqual(UserMessage.archive_messages(before, batch_size=10), 0)
+        self.assertEqual(len(DBSession.execute(select([t_user_messages])).fetchall()), 3)
+        self.assertEqual(len(DBSession.execute(select([t_user_messages_archive])).fetchall()), 2)
+
+        DBSession.execute(t_user_messages.update().values({"is_read": True, "has_been_pushed": True}))
+        self.assertEqual(UserMessage.archive_messages(before, delete=True), 2)
+        self.assertEqual(len(DBSession.execute(select([t_user_messages_archive])).fetchall()), 2)
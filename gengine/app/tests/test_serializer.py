@@ -0,0 +1,57 @@
+import datetime
+import unittest
+
+import pytz
+from sqlalchemy import create_engine
+
+from gengine.base.serializer import CompactSerializer, CompactRow, msgpack
+
+
+class TestCompactSerializer(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        self.rows = engine.execute("SELECT 1 AS id, 'invite' AS name UNION ALL SELECT 2, 'share'").fetchall()
+        self.value = {
+            "rows": self.rows,
+            "row": self.rows[0],
+            "friends": {1, 2},
+            "achievement_date": datetime.datetime(2017, 3, 8, 17, 44, 2, 214248, tzinfo=pytz.utc),
+            "leaderboard": [{"user": {"id": 1}, "value": 12.0, "position": 0}],
+            "key": (1, "a"),
+        }
+
+    def check(self, serializer):
+        value = serializer.loads(serializer.dumps(self.value))
+        self.assertEqual([r["name"] for r in value["rows"]], ["invite", "share"])
+        self.assertEqual(value["rows"][1].id, 2)
+        self.assertEqual(value["row"], (1, "invite"))
+        self.assertIsInstance(value["row"], CompactRow)
+        self.assertEqual(value["friends"], {1, 2})
+        self.assertEqual(value["achievement_date"], self.value["achievement_date"])
+        self.assertEqual(value["leaderboard"], self.value["leaderboard"])
+        self.assertEqual(value["key"], (1, "a"))
+        # decoded rows can be stored again
+        self.assertEqual(serializer.loads(serializer.dumps(value))["rows"], value["rows"])
+
+    @unittest.skipIf(msgpack is None, "msgpack not installed")
+    def test_msgpack(self):
+        serializer = CompactSerializer(use_msgpack=True)
+        self.check(serializer)
+        self.assertEqual(serializer.dumps(self.value)[:1], b"m")
+
+    def test_pickle(self):
+        self.check(CompactSerializer())
+
+    def test_compression(self):
+        serializer = CompactSerializer(compress_threshold=10)
+        self.assertEqual(serializer.dumps(self.value)[:1], b"P")
+        self.check(serializer)
+
+    @unittest.skipIf(msgpack is None, "msgpack not installed")
+    def test_pickle_fallback(self):
+        # msgpack can't encode complex numbers
+        serializer = CompactSerializer(use_msgpack=True)
+        data = serializer.dumps({"x": complex(1, 2)})
+        self.assertEqual(data[:1], b"p")
+        self.assertEqual(serializer.loads(data), {"x": complex(1, 2)})
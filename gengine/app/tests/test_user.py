@@ -0,0 +1,59 @@
+from gengine.app.cache import clear_all_caches
+from gengine.app.tests.base import BaseDBTest
+from gengine.app.tests.helpers import create_user
+from gengine.app.model import User
+
+
+class TestUserFriends(BaseDBTest):
+
+    def test_friend_caches(self):
+        user1 = create_user()
+        user2 = create_user()
+        user3 = create_user(friends=[user1["id"], user2["id"]])
+
+        clear_all_caches()
+
+        self.assertEqual({user1["id"], user2["id"]}, User.get_friend_ids(user3["id"]))
+        self.assertEqual({user3["id"]}, User.get_reverse_friend_ids(user1["id"]))
+        self.assertEqual(set(), User.get_reverse_friend_ids(user3["id"]))
+
+        # the cached entries are updated by the friend diff
+        create_user(user_id=user3["id"], friends=[user2["id"]])
+        self.assertEqual({user2["id"]}, User.get_friend_ids(user3["id"]))
+        self.assertEqual(set(), User.get_reverse_friend_ids(user1["id"]))
+        self.assertEqual({user3["id"]}, User.get_reverse_friend_ids(user2["id"]))
+
+        User.delete_user(user3["id"])
+        self.assertEqual(set(), User.get_reverse_friend_ids(user2["id"]))
+        self.assertEqual(set(), User.get_friend_ids(user3["id"]))
+
+    def test_friend_caches_after_rollback(self):
+        from gengine.metadata import DBSession
+
+        user1 = create_user()
+        user2 = create_user(friends=[user1["id"]])
+        DBSession.commit()
+
+        create_user(user_id=user2["id"], friends=[])
+        # cached with the uncommitted rows
+        self.assertEqual(set(), User.get_friend_ids(user2["id"]))
+        DBSession.rollback()
+        self.assertEqual({user1["id"]}, User.get_friend_ids(user2["id"]))
+
+    def test_leaderboard_writes_after_commit(self):
+        from unittest.mock import patch
+        from gengine.metadata import DBSession
+        from gengine.app.leaderboard import MemoryLeaderboardStore
+        from gengine.app.model import queue_leaderboard_write
+
+        store = MemoryLeaderboardStore()
+        store.rebuild(1, None, [(5, 1.0)])
+        with patch("gengine.app.model.get_leaderboard_store", return_value=store):
+            queue_leaderboard_write("set_value", 1, None, 5, 10.0)
+            self.assertEqual({5: 1.0}, store.get_values(1, None, {5}))
+            DBSession.rollback()
+            self.assertEqual({5: 1.0}, store.get_values(1, None, {5}))
+
+            queue_leaderboard_write("set_value", 1, None, 5, 10.0)
+            DBSession.commit()
+            self.assertEqual({5: 10.0}, store.get_values(1, None, {5}))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+import unittest
+
+from gengine.app.tests.base import BaseDBTest
+from gengine.app.warming import RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(50)
+        started = time.time()
+        for i in range(6):
+            limiter.wait()
+        # the first call passes immediately, the others are spaced by 1/50 seconds
+        self.assertGreaterEqual(time.time() - started, 0.09)
+
+    def test_unlimited(self):
+        limiter = RateLimiter(0)
+        started = time.time()
+        for i in range(100):
+            limiter.wait()
+        self.assertLess(time.time() - started, 0.05)
+
+
+class TestWarming(BaseDBTest):
+
+    def test_warm_definitions_and_active_users(self):
+        from gengine.app.cache import clear_all_caches
+        from gengine.app.model import Value, Goal
+        from gengine.app.tests.helpers import create_user, create_achievement, create_variable, create_goals
+        from gengine.app.warming import warm_definition_caches, get_recently_active_user_ids
+
+        user1 = create_user()
+        user2 = create_user()
+        create_user()
+        achievement = create_achievement(achievement_name="invite_users_achievement")
+        create_goals(achievement)
+        create_variable("invite_users", variable_group="day")
+
+        Value.increase_value(variable_name="invite_users", user=user1, value=1, key=None,
+                             at_datetime=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+        Value.increase_value(variable_name="invite_users", user=user2, value=1, key=None)
+        clear_all_caches()
+
+        self.assertEqual(warm_definition_caches(), 1)
+        self.assertEqual(len(Goal.get_goals(achievement.id)), 1)
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+        self.assertEqual(get_recently_active_user_ids(since), [user2.id, user1.id])
+        self.assertEqual(get_recently_active_user_ids(since, limit=1), [user2.id])
+
+    def test_warming_has_no_side_effects(self):
+        from sqlalchemy.sql.expression import select
+        from gengine.app.cache import clear_all_caches
+        from gengine.app.model import Achievement, Value, Goal, t_achievements_users
+        from gengine.app.tests.helpers import create_user, create_achievement, create_variable, create_goals
+        from gengine.app.warming import warm_evaluations
+        from gengine.metadata import DBSession
+
+        user1 = create_user()
+        user2 = create_user()
+        achievement = create_achievement(achievement_name="invite_users_achievement")
+        goal = create_goals(achievement)
+        create_variable("invite_users", variable_group="day")
+        Value.increase_value(variable_name="invite_users", user=user1, value=20, key=None)
+        Value.increase_value(variable_name="invite_users", user=user2, value=2, key=None)
+        clear_all_caches()
+
+        # user1 reaches a level: the goal is warmed, the achievement is left to the next request
+        self.assertEqual(warm_evaluations(user1), 0)
+        self.assertTrue(Goal.get_goal_eval_cache(goal.id, None, user1.id)["achieved"])
+        self.assertEqual(DBSession.execute(select([t_achievements_users])).fetchall(), [])
+
+        # the read-only evaluation of user2 is cached
+        self.assertEqual(warm_evaluations(user2), 1)
+        output = Achievement.evaluate(user2, achievement.id, None, read_only=True)
+        self.assertEqual(output["level"], 0)
+        self.assertEqual(output["goals"][goal.id]["value"], 2)
+        self.assertEqual(DBSession.execute(select([t_achievements_users])).fetchall(), [])
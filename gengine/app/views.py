@@ -14,7 +14,7 @@ import pytz
 from pyramid.request import Request
 from pyramid.response import Response
 from pyramid.settings import asbool
-from sqlalchemy.sql.expression import select, and_
+from sqlalchemy.sql.expression import select, and_, or_
 
 from gengine.app.permissions import perm_own_update_user_infos, perm_global_update_user_infos, perm_global_delete_user, perm_own_delete_user, \
     perm_global_access_admin_ui, perm_global_register_device, perm_own_register_device, perm_global_read_messages, \
@@ -29,13 +29,17 @@ from werkzeug import DebuggedApplication
 
 from gengine.app.admin import adminapp
 from gengine.app.formular import FormularEvaluationException
+from gengine.app.leaderboard import group_scope
 from gengine.app.model import (
     User,
     Achievement,
+    EvaluationBatch,
+    Goal,
     Value,
     Variable,
+    Translation,
     AuthUser, AuthToken, t_users, t_auth_users, t_auth_users_roles, t_auth_roles, t_auth_roles_permissions, UserDevice,
-    t_user_device, t_user_messages, UserMessage)
+    t_user_device, t_user_messages, UserMessage, change_unread_messages)
 from gengine.base.settings import get_settings
 from gengine.metadata import DBSession
 from gengine.wsgiutil import HTTPSProxied
@@ -130,13 +134,15 @@ def delete_user(request):
     User.delete_user(user_id)
     return {"status": "OK"}
 
-def _get_progress(achievements_for_user, requesting_user):
+def _get_progress(achievements_for_user, requesting_user, serve_stale=None):
+    """serve_stale=False for the write paths, which must not get the evaluation of before the increase"""
 
     achievements = Achievement.get_achievements_by_user_for_today(achievements_for_user)
 
-    def ea(achievement, achievement_date, execute_triggers):
+    def ea(achievement, achievement_date, execute_triggers, batch):
         try:
-            return Achievement.evaluate(achievements_for_user, achievement["id"], achievement_date, execute_triggers=execute_triggers)
+            return Achievement.evaluate(achievements_for_user, achievement["id"], achievement_date, execute_triggers=execute_triggers,
+                                        batch=batch, serve_stale=serve_stale)
         except FormularEvaluationException as e:
             return { "error": "Cannot evaluate formular: " + e.message, "id" : achievement["id"] }
         except Exception as e:
@@ -155,48 +161,74 @@ def _get_progress(achievements_for_user, requesting_user):
             return True
         return False
 
-    evaluatelist = []
+    # achievements are evaluated in dependency order and skipped while they are locked by requirements or denials
+    dependencies = Achievement.get_achievement_dependencies()
+    dependency_ids = set(dependencies.keys())
+    for deps in dependencies.values():
+        dependency_ids.update(deps["requirements"] + deps["denials"])
+    reached_achievement_ids = Achievement.get_reached_achievement_ids(achievements_for_user["id"], dependency_ids)
+
     now = datetime.datetime.now(pytz.timezone(achievements_for_user["timezone"]))
-    for achievement in achievements:
-        if may_view(achievement, requesting_user):
-            achievement_dates = set()
-            d = max(achievement["created_at"], achievements_for_user["created_at"]).replace(tzinfo=pytz.utc)
-            dr = Achievement.get_datetime_for_evaluation_type(
-                achievement["evaluation_timezone"],
-                achievement["evaluation"],
-                dt=d
-            )
-
-            achievement_dates.add(dr)
-            if dr != None:
-                while d <= now:
-                    if achievement["evaluation"] == "yearly":
-                        d += datetime.timedelta(days=364)
-                    elif achievement["evaluation"] == "monthly":
-                        d += datetime.timedelta(days=28)
-                    elif achievement["evaluation"] == "weekly":
-                        d += datetime.timedelta(days=6)
-                    elif achievement["evaluation"] == "daily":
-                        d += datetime.timedelta(hours=23)
-                    else:
-                        break # should not happen
-
-                    dr = Achievement.get_datetime_for_evaluation_type(
-                        achievement["evaluation_timezone"],
-                        achievement["evaluation"],
-                        dt=d
-                    )
-
-                    if dr <= now:
-                        achievement_dates.add(dr)
-
-            i=0
-            for achievement_date in reversed(sorted(achievement_dates)):
-                # We execute the goal triggers only for the newest and previous period, not for any periods longer ago
-                # (To not send messages for very old things....)
-                evaluatelist.append(ea(achievement, achievement_date, execute_triggers=(i == 0 or i == 1 or achievement_date == None)))
-                i += 1
 
+    def get_achievement_dates(achievement):
+        achievement_dates = set()
+        d = max(achievement["created_at"], achievements_for_user["created_at"]).replace(tzinfo=pytz.utc)
+        dr = Achievement.get_datetime_for_evaluation_type(
+            achievement["evaluation_timezone"],
+            achievement["evaluation"],
+            dt=d
+        )
+
+        achievement_dates.add(dr)
+        if dr != None:
+            while d <= now:
+                if achievement["evaluation"] == "yearly":
+                    d += datetime.timedelta(days=364)
+                elif achievement["evaluation"] == "monthly":
+                    d += datetime.timedelta(days=28)
+                elif achievement["evaluation"] == "weekly":
+                    d += datetime.timedelta(days=6)
+                elif achievement["evaluation"] == "daily":
+                    d += datetime.timedelta(hours=23)
+                else:
+                    break # should not happen
+
+                dr = Achievement.get_datetime_for_evaluation_type(
+                    achievement["evaluation_timezone"],
+                    achievement["evaluation"],
+                    dt=d
+                )
+
+                if dr <= now:
+                    achievement_dates.add(dr)
+        return list(reversed(sorted(achievement_dates)))
+
+    # collect all cache keys first, so that they are fetched with a constant number of cache round trips
+    viewable = [(achievement, get_achievement_dates(achievement))
+                for achievement in Achievement.sort_by_dependencies(achievements, dependencies)
+                if may_view(achievement, requesting_user)]
+    # achievements which are unlocked during the evaluation are evaluated without the batch
+    batch = EvaluationBatch(achievements_for_user, [(achievement, achievement_date)
+                                                    for achievement, achievement_dates in viewable
+                                                    if Achievement.is_unlocked(achievement["id"], dependencies, reached_achievement_ids)
+                                                    for achievement_date in achievement_dates])
+
+    evaluatelist = []
+    for achievement, achievement_dates in viewable:
+        if not Achievement.is_unlocked(achievement["id"], dependencies, reached_achievement_ids):
+            evaluatelist += [Achievement.locked_output(achievements_for_user, achievement, achievement_date)
+                             for achievement_date in achievement_dates]
+            continue
+
+        i=0
+        for achievement_date in achievement_dates:
+            # We execute the goal triggers only for the newest and previous period, not for any periods longer ago
+            # (To not send messages for very old things....)
+            result = ea(achievement, achievement_date, execute_triggers=(i == 0 or i == 1 or achievement_date == None), batch=batch)
+            if result is not None and not "error" in result and result["level"] > 0:
+                reached_achievement_ids.add(achievement["id"])
+            evaluatelist.append(result)
+            i += 1
 
     ret = {
         "achievements" : [
@@ -210,6 +242,17 @@ def _get_progress(achievements_for_user, requesting_user):
     return ret
 
 
+def _get_language(request, user=None):
+    """the language of the response (GET parameter language, the user's language or Accept-Language).
+
+    returns None for language=all, i.e. all languages are returned."""
+    requested = request.GET.get("language")
+    if requested == "all":
+        return None
+    accept_language = request.accept_language if "Accept-Language" in request.headers else None
+    return Translation.negotiate_language(requested, accept_language, user)
+
+
 @view_config(route_name='get_progress', renderer='json', request_method="GET")
 def get_progress(request):
     """get all relevant data concerning the user's progress"""
@@ -229,6 +272,10 @@ def get_progress(request):
         if "new_levels" in output["achievements"][i]:
             del output["achievements"][i]["new_levels"]
 
+    language = _get_language(request, user)
+    if language is not None:
+        Translation.select_language(output, language)
+
     return output
 
 @view_config(route_name='increase_value', renderer='json', request_method="POST")
@@ -263,7 +310,7 @@ def increase_value(request):
     
     Value.increase_value(variable_name, user, value, key) 
     
-    output = _get_progress(achievements_for_user=user, requesting_user=request.user)
+    output = _get_progress(achievements_for_user=user, requesting_user=request.user, serve_stale=False)
     output = copy.deepcopy(output)
     to_delete = list()
     for i in range(len(output["achievements"])):
@@ -280,6 +327,10 @@ def increase_value(request):
     for i in sorted(to_delete,reverse=True):
         del output["achievements"][i]
 
+    language = _get_language(request, user)
+    if language is not None:
+        Translation.select_language(output, language)
+
     return output
 
 @view_config(route_name="increase_multi_values", renderer="json", request_method="POST")
@@ -313,7 +364,7 @@ def increase_multi_values(request):
                 
                 Value.increase_value(variable_name, user, value, key)
 
-        output = _get_progress(achievements_for_user=user, requesting_user=request.user)
+        output = _get_progress(achievements_for_user=user, requesting_user=request.user, serve_stale=False)
         output = copy.deepcopy(output)
         to_delete = list()
         for i in range(len(output["achievements"])):
@@ -330,11 +381,68 @@ def increase_multi_values(request):
         for i in sorted(to_delete, reverse=True):
             del output["achievements"][i]
 
+        language = _get_language(request, user)
+        if language is not None:
+            Translation.select_language(output, language)
+
         if len(output["achievements"])>0 :
             ret[user_id]=output
     
     return ret
 
+@view_config(route_name='get_leaderboard', renderer='json', request_method="GET")
+def get_leaderboard(request):
+    """get a page of the leaderboard of a goal from the view of a user (the user defines friends, city etc.)"""
+    try:
+        goal_id = int(request.matchdict["goal_id"])
+        user_id = int(request.matchdict["user_id"])
+    except:
+        raise APIError(400, "invalid_input", "invalid input")
+
+    try:
+        offset = max(0, int(request.GET.get("offset", 0)))
+        limit = min(max(1, int(request.GET.get("limit", 100))), 1000)
+        around_user = int(request.GET["around_user"]) if len(request.GET.get("around_user", "")) > 0 else None
+        group_id = int(request.GET["group_id"]) if len(request.GET.get("group_id", "")) > 0 else None
+    except:
+        raise APIError(400, "invalid_input", "offset, limit, around_user and group_id need to be integers")
+
+    user = User.get_user(user_id)
+    if not user:
+        raise APIError(404, "user_not_found", "user not found")
+
+    goal = Goal.get_goal(goal_id)
+    if not goal:
+        raise APIError(404, "goal_not_found", "goal not found")
+
+    achievement = Achievement.get_achievement(goal["achievement_id"])
+
+    if asbool(get_settings().get("enable_user_authentication", False)):
+        may_view = achievement["view_permission"] == "everyone" or (request.user and request.user.id == user_id)
+        if not may_view:
+            raise APIError(403, "forbidden", "You may not view this leaderboard.")
+
+    achievement_date = Achievement.get_datetime_for_evaluation_type(achievement["evaluation_timezone"], achievement["evaluation"])
+
+    scope = None
+    if group_id is not None:
+        scope = group_scope(group_id)
+        if achievement["relevance"] != "groups" or scope not in User.get_leaderboard_scopes(user_id):
+            raise APIError(400, "invalid_group", "the leaderboard is not available for this group")
+
+    user_ids, scope = Achievement.get_leaderboard_users_and_scope(achievement, user_id, scope)
+
+    window = Goal.get_leaderboard_window(goal, achievement_date, user_ids, offset=offset, limit=limit, around_user=around_user, scope=scope)
+    window.update({
+        "goal_id": goal_id,
+        "achievement_id": achievement["id"],
+        "achievement_date": achievement_date,
+        "scope": scope,
+        "offset": offset,
+        "limit": limit,
+    })
+    return window
+
 @view_config(route_name='get_achievement_level', renderer='json', request_method="GET")
 def get_achievement_level(request):
     """get all information about an achievement for a specific level""" 
@@ -355,6 +463,10 @@ def get_achievement_level(request):
     if "level" in level_output:
         del level_output["level"]
 
+    language = _get_language(request)
+    if language is not None:
+        Translation.select_language(level_output, language)
+
     return level_output
 
 
@@ -447,6 +559,14 @@ def get_messages(request):
     except:
         offset = 0
 
+    cursor = None
+    if len(request.GET.get("cursor", "")) > 0:
+        try:
+            created_at, message_id = request.GET["cursor"].rsplit("_", 1)
+            cursor = (datetime.datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%f"), int(message_id))
+        except:
+            raise APIError(400, "get_messages.invalid_cursor", "The cursor is invalid.")
+
     limit = 100
 
     if asbool(get_settings().get("enable_user_authentication", False)):
@@ -459,16 +579,28 @@ def get_messages(request):
         raise APIError(404, "get_messages.user_not_found",
                        "There is no user with this id.")
 
-    q = t_user_messages.select().where(t_user_messages.c.user_id==user_id).order_by(t_user_messages.c.created_at.desc()).limit(limit).offset(offset)
+    # keyset pagination on (created_at, id), uses the index ix_user_messages_user_id_created_at_id
+    q = t_user_messages.select().where(t_user_messages.c.user_id==user_id)\
+        .order_by(t_user_messages.c.created_at.desc(), t_user_messages.c.id.desc())\
+        .limit(limit)
+    if cursor is not None:
+        q = q.where(or_(t_user_messages.c.created_at < cursor[0],
+                        and_(t_user_messages.c.created_at == cursor[0], t_user_messages.c.id < cursor[1])))
+    else:
+        q = q.offset(offset)
     rows = DBSession.execute(q).fetchall()
+    user = User.get_user(user_id)
+    language = _get_language(request, user)
 
     return {
         "messages" : [{
             "id" : message["id"],
-            "text" : UserMessage.get_text(message),
+            "text" : UserMessage.get_text(message, language=language),
             "is_read" : message["is_read"],
             "created_at" : message["created_at"]
-        } for message in rows]
+        } for message in rows],
+        "next_cursor" : "%s_%s" % (rows[-1]["created_at"].strftime("%Y-%m-%dT%H:%M:%S.%f"), rows[-1]["id"]) if len(rows) == limit else None,
+        "unread_count" : user["unread_messages"]
     }
 
 
@@ -499,12 +631,14 @@ def set_messages_read(request):
         raise APIError(404, "set_messages_read.message_not_found", "There is no message with this id.")
 
     uS = update_connection()
-    uS.execute(t_user_messages.update().values({
+    result = uS.execute(t_user_messages.update().values({
         "is_read" : True
     }).where(and_(
         t_user_messages.c.user_id == user_id,
-        t_user_messages.c.created_at <= msg["created_at"]
+        t_user_messages.c.created_at <= msg["created_at"],
+        t_user_messages.c.is_read == False
     )))
+    change_unread_messages(uS, user_id, -result.rowcount)
 
     return {
         "status" : "ok"
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Warming of the caches after a deploy or after the caches have been cleared.
+
+First the definition caches (achievements, goals, properties, rewards, translations, the variable to goal mapping)
+are filled, then the achievements of the recently active users are evaluated in parallel batches.
+
+Warming has no visible effects for the users: the achievements are evaluated read-only (see :meth:`Achievement.evaluate`),
+goal triggers are not executed and no levels are inserted, i.e. no rewards are given. Achievements in which the user
+reaches a new level are not cached, they are evaluated with the warmed goal evaluations at the user's next request.
+Achievements which are locked by requirements or denials are skipped.
+
+settings:
+    cache.warm.active_days = 7      users with values in the last days are warmed
+    cache.warm.max_users = 1000     at most this number of users (the most recently active first)
+    cache.warm.workers = 4          number of threads
+    cache.warm.batch_size = 50      users per transaction
+    cache.warm.rate = 20            users per second (0 = unlimited)
+    cache.warm.on_startup = false   warm in a background thread when the application starts (for process local backends)
+"""
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+from sqlalchemy.sql.expression import select, desc
+from sqlalchemy.sql.functions import func
+
+from gengine.base.settings import get_settings
+from gengine.metadata import DBSession
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """allows at most rate calls of wait() per second, shared by all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+def warm_definition_caches():
+    """fill the caches of the achievement and goal definitions, return the number of warmed achievements"""
+    from gengine.app.model import Achievement, AchievementCategory, Goal, Translation, Variable, t_achievements
+
+    with transaction.manager:
+        Translation.get_languages()
+        Variable.map_variables_to_rules()
+        Achievement.get_achievement_dependencies()
+        Achievement.get_achievements_by_date(datetime.date.today(), Achievement.get_list_generation())
+
+        achievement_ids = [x["id"] for x in DBSession.execute(select([t_achievements.c.id])).fetchall()]
+        for achievement_id in achievement_ids:
+            achievement = Achievement.get_achievement(achievement_id)
+            if achievement["achievementcategory_id"] is not None:
+                AchievementCategory.get_achievementcategory(achievement["achievementcategory_id"])
+            goals = Goal.get_goals(achievement_id)
+            for level in range(0, achievement["maxlevel"] + 1):
+                Achievement.get_achievement_properties(achievement_id, level)
+                Achievement.get_rewards(achievement_id, level)
+                for goal in goals:
+                    Goal.get_goal(goal["id"])
+                    Goal.get_properties(goal["id"], level)
+    return len(achievement_ids)
+
+
+def get_recently_active_user_ids(since, limit=None):
+    """return the ids of the users who have values since the given datetime, the most recently active first"""
+    from gengine.app.model import t_values
+
+    last_active = func.max(t_values.c.datetime).label("last_active")
+    q = select([t_values.c.user_id, last_active])\
+        .where(t_values.c.datetime >= since)\
+        .group_by(t_values.c.user_id)\
+        .order_by(desc(last_active))
+    if limit:
+        q = q.limit(limit)
+    with transaction.manager:
+        return [x["user_id"] for x in DBSession.execute(q).fetchall()]
+
+
+def warm_evaluations(user):
+    """evaluate the unlocked achievements of the user's current periods read-only, return the number of cached evaluations"""
+    from gengine.app.model import Achievement
+
+    dependencies = Achievement.get_achievement_dependencies()
+    dependency_ids = set(dependencies.keys())
+    for deps in dependencies.values():
+        dependency_ids.update(deps["requirements"] + deps["denials"])
+    reached_achievement_ids = Achievement.get_reached_achievement_ids(user["id"], dependency_ids)
+
+    warmed = 0
+    for achievement in Achievement.get_achievements_by_user_for_today(user):
+        if not Achievement.is_unlocked(achievement["id"], dependencies, reached_achievement_ids):
+            continue
+        achievement = Achievement.get_achievement(achievement["id"])
+        achievement_date = Achievement.get_datetime_for_evaluation_type(achievement["evaluation_timezone"], achievement["evaluation"])
+        if Achievement.evaluate(user, achievement["id"], achievement_date, read_only=True) is not None:
+            warmed += 1
+    return warmed
+
+
+def warm_progress(user_ids, workers=4, batch_size=50, rate=None):
+    """evaluate the achievements of the users in parallel batches, return the number of warmed users"""
+    from gengine.app.model import User
+
+    limiter = RateLimiter(rate)
+    batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+
+    def warm_batch(batch):
+        warmed = 0
+        try:
+            with transaction.manager:
+                for user_id in batch:
+                    limiter.wait()
+                    user = User.get_user(user_id)
+                    if user is None:
+                        continue
+                    warm_evaluations(user)
+                    warmed += 1
+        except Exception as e:
+            log.exception("warming of users %s failed" % (batch,))
+        finally:
+            DBSession.remove()
+        return warmed
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return sum(executor.map(warm_batch, batches))
+
+
+def warm_caches(settings=None):
+    """warm the definition caches and the progress of the recently active users (see module documentation for the settings)"""
+    settings = settings if settings is not None else (get_settings() or {})
+    started = time.time()
+
+    achievements = warm_definition_caches()
+
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=int(settings.get("cache.warm.active_days", 7)))
+    user_ids = get_recently_active_user_ids(since, limit=int(settings.get("cache.warm.max_users", 1000)))
+    users = warm_progress(user_ids,
+                          workers=int(settings.get("cache.warm.workers", 4)),
+                          batch_size=int(settings.get("cache.warm.batch_size", 50)),
+                          rate=float(settings.get("cache.warm.rate", 20)))
+
+    result = {"achievements": achievements, "users": users, "seconds": round(time.time() - started, 2)}
+    log.info("caches warmed: %s" % (result,))
+    return result
+
+
+def warm_caches_in_background(settings=None):
+    """start warm_caches in a daemon thread (e.g. from the admin interface or at startup)"""
+    def run():
+        try:
+            warm_caches(settings)
+        except Exception as e:
+            log.exception("warming of the caches failed")
+        finally:
+            DBSession.remove()
+    thread = threading.Thread(target=run, name="gengine-cache-warming")
+    thread.daemon = True
+    thread.start()
+    return thread
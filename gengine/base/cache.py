@@ -1,9 +1,18 @@
+import hashlib
+import inspect
 import warnings
 from dogpile.cache import make_region
 from pyramid_dogpile_cache import get_region
 
+from gengine.base.locks import LockingProxy
+from gengine.base.localcache import LocalCacheProxy, get_invalidation_channel
+from gengine.base.serializer import CompactSerializer, SerializingProxy
+from gengine.base.settings import get_settings
+
 force_redis = None
 
+cache_proxies = {}
+
 def setup_redis_cache(host,port,db):
     """ This is used to override all caching settings in the ini file. Needed for Testing. """
     global force_redis
@@ -12,25 +21,56 @@ def setup_redis_cache(host,port,db):
         'port': port,
         'db': db,
         'redis_expiration_time': 60 * 60 * 2,  # 2 hours
-        'distributed_lock': True
     }
 
 
-def my_key_mangler(prefix):
-    def s(o):
-        if type(o) == dict:
-            return "_".join(["%s=%s" % (str(k), str(v)) for k, v in o.items()])
-        if type(o) == tuple:
-            return "_".join([str(v) for v in o])
-        if type(o) == list:
-            return "_".join([str(v) for v in o])
-        else:
-            return str(o)
+def normalize_key_argument(o):
+    """return a stable string for a cache key argument. dicts and sets are sorted, scalars are converted with str()."""
+    if isinstance(o, dict):
+        return "{%s}" % (",".join(sorted("%s=%s" % (str(k), normalize_key_argument(v)) for k, v in o.items())),)
+    if isinstance(o, (set, frozenset)):
+        return "{%s}" % (",".join(sorted(normalize_key_argument(v) for v in o)),)
+    if isinstance(o, (list, tuple)):
+        return "[%s]" % (",".join(normalize_key_argument(v) for v in o),)
+    return str(o)
+
+
+def function_key_generator(namespace, fn, to_str=str):
+    """like dogpile's default key generator, but arguments (including keyword arguments) are normalized.
+
+    Cached functions should take ids, not rows: the key of a row would contain the whole row."""
+    if namespace is None:
+        namespace = "%s:%s" % (fn.__module__, fn.__name__)
+    else:
+        namespace = "%s:%s|%s" % (fn.__module__, fn.__name__, namespace)
+
+    argnames = inspect.getfullargspec(fn).args
+    has_self = argnames and argnames[0] in ("self", "cls")
+
+    def generate_key(*args, **kw):
+        if has_self:
+            args = args[1:]
+        key = namespace + "|" + " ".join(normalize_key_argument(a) for a in args)
+        if kw:
+            key += "|" + normalize_key_argument(kw)
+        return key
+
+    return generate_key
+
+
+def my_key_mangler(prefix, version=None):
+    """keys are "<region>:<version>:<sha1 of the key>".
+
+    They have a fixed length (memcached accepts at most 250 bytes), the version (setting cache.key_version)
+    allows to start with fresh keys after the structure of cached values has changed."""
+    if version is None:
+        version = (get_settings() or {}).get("cache.key_version", "1")
+    key_prefix = "%s:%s:" % (prefix, version)
 
     def generate_key(key):
-        ret = ""
-        ret += prefix + s(key).replace(" ", "")
-        return ret
+        if not isinstance(key, str):
+            key = normalize_key_argument(key)
+        return key_prefix + hashlib.sha1(key.encode("utf-8")).hexdigest()
 
     return generate_key
 
@@ -51,5 +91,51 @@ def create_cache(name):
             warnings.warn("Warning: cache objects are in memory, are you creating docs?")
 
     ch.key_mangler = my_key_mangler(name)
-    
+    ch.function_key_generator = function_key_generator
+
+    # the mutex of dogpile's get_or_create comes from the lock backend (see gengine.base.locks)
+    ch.wrap(LockingProxy())
+    # the serializer is wrapped first, so the in-process tier keeps the decoded values
+    serializer = (get_settings() or {}).get("cache.serializer", "pickle")
+    if serializer in ("compact", "msgpack"):
+        ch.wrap(SerializingProxy(CompactSerializer(use_msgpack=(serializer == "msgpack"))))
+    ch.wrap(create_local_cache_proxy(name))
+
     return ch
+
+
+def create_local_cache_proxy(name):
+    """the in-process tier (see :mod:`gengine.base.localcache`), enabled for the regions listed in cache.local.regions
+
+    settings:
+        cache.local.regions = general translations
+        cache.local.size = 1000
+        cache.local.ttl = 30
+    """
+    settings = get_settings() or {}
+    max_size, channel = 0, None
+    if name in settings.get("cache.local.regions", "").split():
+        max_size = int(settings.get("cache.local.size", 1000))
+        channel = get_invalidation_channel(settings)
+    proxy = LocalCacheProxy(name, max_size=max_size, ttl=float(settings.get("cache.local.ttl", 30)), channel=channel)
+    cache_proxies[name] = proxy
+    return proxy
+
+
+def clear_local_caches():
+    """drop the in-process tiers of all regions in all processes"""
+    for proxy in cache_proxies.values():
+        proxy.clear_local()
+
+
+def get_cache_stats():
+    """return {region: {"local_hits", "hits", "misses", "hit_ratio", "local_hit_ratio", "local_size"}}"""
+    stats = {}
+    for name, proxy in cache_proxies.items():
+        s = dict(proxy.stats)
+        total = s["local_hits"] + s["hits"] + s["misses"]
+        s["hit_ratio"] = float(s["local_hits"] + s["hits"]) / total if total else None
+        s["local_hit_ratio"] = float(s["local_hits"]) / total if total else None
+        s["local_size"] = proxy.size()
+        stats[name] = s
+    return stats
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""An optional in-process tier in front of the shared dogpile backends.
+
+:class:`LocalCacheProxy` keeps a size-bounded LRU with a TTL per region. Writes and deletes are announced on an
+invalidation channel, so other processes drop their local copies:
+
+    - :class:`LocalInvalidationChannel`: delivers messages inside the process (tests, single process deployments)
+    - :class:`RedisInvalidationChannel`: uses redis pub/sub between all processes
+
+The proxy also counts hits and misses of the region, see :func:`gengine.base.cache.get_cache_stats`.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+
+log = logging.getLogger(__name__)
+
+try:
+    import redis
+except ImportError as e:
+    log.info("redis not installed")
+
+
+class InvalidationChannel(object):
+    """Broadcasts invalidated keys. keys=None invalidates the whole region."""
+
+    def publish(self, sender, region, keys):
+        raise NotImplementedError()
+
+    def subscribe(self, callback):
+        """callback(sender, region, keys) is called for every message"""
+        raise NotImplementedError()
+
+    def ensure_listening(self):
+        pass
+
+
+class LocalInvalidationChannel(InvalidationChannel):
+
+    def __init__(self):
+        self._callbacks = []
+
+    def publish(self, sender, region, keys):
+        for callback in list(self._callbacks):
+            callback(sender, region, keys)
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+
+class RedisInvalidationChannel(InvalidationChannel):
+    """The listener thread is started lazily in every process (e.g. after the workers have been forked)."""
+
+    def __init__(self, client, channel="gengine_cache_invalidation"):
+        self.client = client
+        self.channel = channel
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def publish(self, sender, region, keys):
+        self.client.publish(self.channel, json.dumps({"sender": sender, "region": region, "keys": keys}))
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def ensure_listening(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid != os.getpid():
+                thread = threading.Thread(target=self._listen, name="gengine-cache-invalidation")
+                thread.daemon = True
+                thread.start()
+                self._listener_pid = os.getpid()
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            try:
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode("utf-8")
+                data = json.loads(data)
+                for callback in list(self._callbacks):
+                    callback(data["sender"], data["region"], data["keys"])
+            except Exception as e:
+                log.exception("invalid cache invalidation message")
+
+
+class LocalCacheProxy(ProxyBackend):
+    """LRU (max_size entries, each valid for ttl seconds) in front of the proxied backend.
+
+    With max_size=0 only the statistics are recorded."""
+
+    def __init__(self, region_name, max_size=0, ttl=30, channel=None):
+        super(LocalCacheProxy, self).__init__()
+        self.region_name = region_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = channel
+        self.sender = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.stats = {"local_hits": 0, "hits": 0, "misses": 0}
+        if channel is not None and max_size > 0:
+            channel.subscribe(self._on_invalidation)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _get_local(self, key):
+        if self.max_size <= 0:
+            return NO_VALUE
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return NO_VALUE
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._items[key]
+                return NO_VALUE
+            self._items.move_to_end(key)
+            self.stats["local_hits"] += 1
+            return value
+
+    def _set_local(self, key, value):
+        if self.max_size <= 0 or value is NO_VALUE:
+            return
+        with self._lock:
+            self._items[key] = (value, time.time() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def _drop_local(self, keys):
+        with self._lock:
+            if keys is None:
+                self._items.clear()
+            else:
+                for key in keys:
+                    self._items.pop(key, None)
+
+    def _publish(self, keys):
+        self._drop_local(keys)
+        if self.channel is not None and self.max_size > 0:
+            self.channel.publish(self.sender, self.region_name, keys)
+
+    def _on_invalidation(self, sender, region_name, keys):
+        if sender != self.sender and region_name == self.region_name:
+            self._drop_local(keys)
+
+    def clear_local(self, publish=True):
+        """drop all local entries (of all processes, if publish is set)"""
+        if publish:
+            self._publish(None)
+        else:
+            self._drop_local(None)
+
+    def size(self):
+        return len(self._items)
+
+    def _ensure_listening(self):
+        if self.channel is not None and self.max_size > 0:
+            self.channel.ensure_listening()
+
+    def get(self, key):
+        self._ensure_listening()
+        value = self._get_local(key)
+        if value is not NO_VALUE:
+            return value
+        value = self.proxied.get(key)
+        self._count("misses" if value is NO_VALUE else "hits")
+        self._set_local(key, value)
+        return value
+
+    def get_multi(self, keys):
+        self._ensure_listening()
+        values = [self._get_local(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is NO_VALUE]
+        if missing:
+            for i, value in zip(missing, self.proxied.get_multi([keys[i] for i in missing])):
+                values[i] = value
+                self._count("misses" if value is NO_VALUE else "hits")
+                self._set_local(keys[i], value)
+        return values
+
+    def set(self, key, value):
+        self.proxied.set(key, value)
+        self._publish([key])
+        self._set_local(key, value)
+
+    def set_multi(self, mapping):
+        self.proxied.set_multi(mapping)
+        self._publish(list(mapping.keys()))
+        for key, value in mapping.items():
+            self._set_local(key, value)
+
+    def delete(self, key):
+        self.proxied.delete(key)
+        self._publish([key])
+
+    def delete_multi(self, keys):
+        self.proxied.delete_multi(keys)
+        self._publish(list(keys))
+
+
+_channel = None
+_channel_configured = False
+
+
+def setup_invalidation_channel(channel):
+    """ This is used to override the channel settings in the ini file. Needed for Testing. """
+    global _channel, _channel_configured
+    _channel = channel
+    _channel_configured = True
+
+
+def get_invalidation_channel(settings):
+    """settings:
+        cache.local.invalidation = local | redis
+        cache.local.redis_url = redis://127.0.0.1:6379/0
+    """
+    global _channel, _channel_configured
+    if not _channel_configured:
+        backend = settings.get("cache.local.invalidation", "local")
+        if backend == "redis":
+            client = redis.StrictRedis.from_url(settings.get("cache.local.redis_url", "redis://127.0.0.1:6379/0"))
+            _channel = RedisInvalidationChannel(client)
+        else:
+            _channel = LocalInvalidationChannel()
+        _channel_configured = True
+    return _channel
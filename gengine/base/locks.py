@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Locks against cache stampedes.
+
+When an expensive cache entry is missing, only the process which holds the entry's lock recomputes it.
+The others wait for the result or, if a previous value is known (stale_key), return the previous value.
+
+    - :class:`LocalLockBackend`: locks of this process (tests, single process deployments)
+    - :class:`RedisLockBackend`: redis locks shared by all processes
+
+Distributed backends are used for dogpile's mutex of all regions as well (see :class:`LockingProxy`).
+"""
+import contextlib
+import logging
+import threading
+import weakref
+
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+from pyramid.settings import asbool
+
+from gengine.base.settings import get_settings
+
+log = logging.getLogger(__name__)
+
+try:
+    import redis
+    from redis.exceptions import LockError
+except ImportError as e:
+    log.info("redis not installed")
+
+
+class LockBackend(object):
+
+    def lock(self, name):
+        """return a lock object with acquire(blocking=True) and release()"""
+        raise NotImplementedError()
+
+
+class LocalLock(object):
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def acquire(self, blocking=True):
+        return self._lock.acquire(blocking)
+
+    def release(self):
+        self._lock.release()
+
+
+class LocalLockBackend(LockBackend):
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = weakref.WeakValueDictionary()
+
+    def lock(self, name):
+        with self._mutex:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = LocalLock()
+            return lock
+
+
+class RedisLock(object):
+
+    def __init__(self, lock):
+        self._lock = lock
+
+    def acquire(self, blocking=True):
+        return self._lock.acquire(blocking=blocking)
+
+    def release(self):
+        try:
+            self._lock.release()
+        except LockError as e:
+            # the lock has timed out, another process may already hold it
+            log.warning("cache lock %s expired before it was released" % (self._lock.name,))
+
+
+class RedisLockBackend(LockBackend):
+    """locks expire after timeout seconds (if the process dies), waiting is limited to timeout seconds as well"""
+
+    def __init__(self, client, timeout=30, prefix="gengine_lock:"):
+        self.client = client
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def lock(self, name):
+        return RedisLock(self.client.lock(self.prefix + name, timeout=self.timeout, sleep=0.05, blocking_timeout=self.timeout))
+
+
+class LockingProxy(ProxyBackend):
+    """dogpile uses this mutex when a value of the region is created.
+
+    With local locks the backend's own mutex is kept (e.g. the file lock of the dbm backend)."""
+
+    def get_mutex(self, key):
+        backend = get_lock_backend()
+        if isinstance(backend, LocalLockBackend):
+            return self.proxied.get_mutex(key)
+        return backend.lock(key)
+
+
+_backend = None
+_held = threading.local()
+
+
+def setup_lock_backend(backend):
+    """ This is used to override the lock settings in the ini file. Needed for Testing. """
+    global _backend
+    _backend = backend
+
+
+def get_lock_backend(settings=None):
+    """settings:
+        cache.lock.backend = local | redis
+        cache.lock.redis_url = redis://127.0.0.1:6379/0
+        cache.lock.timeout = 30
+    """
+    global _backend
+    if _backend is None:
+        settings = settings if settings is not None else (get_settings() or {})
+        if settings.get("cache.lock.backend", "local") == "redis":
+            client = redis.StrictRedis.from_url(settings.get("cache.lock.redis_url", "redis://127.0.0.1:6379/0"))
+            _backend = RedisLockBackend(client, timeout=int(settings.get("cache.lock.timeout", 30)))
+        else:
+            _backend = LocalLockBackend()
+    return _backend
+
+
+def _lock_name(region, key):
+    return region.key_mangler(key) if region.key_mangler else key
+
+
+def _held_names():
+    if not hasattr(_held, "names"):
+        _held.names = set()
+    return _held.names
+
+
+@contextlib.contextmanager
+def cache_lock(region, key, stale_key=None, serve_stale=None):
+    """hold the lock of the key in the region.
+
+    yields NO_VALUE when the lock is held, or the previous value stored under stale_key if another process holds the lock
+    and serve_stale is true (default: cache.lock.serve_stale, which is disabled). Locks are reentrant within a thread."""
+    name = _lock_name(region, key)
+    held = _held_names()
+    if name in held:
+        yield NO_VALUE
+        return
+
+    if serve_stale is None:
+        serve_stale = asbool((get_settings() or {}).get("cache.lock.serve_stale", False))
+
+    lock = get_lock_backend().lock(name)
+    acquired = lock.acquire(False)
+    if not acquired and stale_key is not None and serve_stale:
+        stale = region.get(stale_key)
+        if stale is not NO_VALUE:
+            yield stale
+            return
+    if not acquired:
+        acquired = lock.acquire()
+        if not acquired:
+            log.warning("timeout while waiting for cache lock %s" % (name,))
+
+    held.add(name)
+    try:
+        yield NO_VALUE
+    finally:
+        held.discard(name)
+        if acquired:
+            lock.release()
+
+
+def locked_get_or_create(region, key, creator, stale_key=None, known_missing=False, serve_stale=None):
+    """like region.get_or_create, but only one process creates the value (see :func:`cache_lock`).
+
+    The created value is stored under key and stale_key, so it can be served while the next version is created.
+    The lock is taken on stale_key if given, so that all versions of an entry share one lock."""
+    if not known_missing:
+        value = region.get(key)
+        if value is not NO_VALUE:
+            return value
+
+    with cache_lock(region, stale_key if stale_key is not None else key, stale_key, serve_stale) as stale:
+        if stale is not NO_VALUE:
+            return stale
+        # another process may have created the value while we were waiting
+        value = region.get(key)
+        if value is NO_VALUE:
+            value = creator()
+            mapping = {key: value}
+            if stale_key is not None:
+                mapping[stale_key] = value
+            region.set_multi(mapping)
+        return value
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Compact serialisation of cached values.
+
+SQLAlchemy rows are stored as plain tuples plus their column names, which are shared by all rows of a value.
+Values are encoded with pickle or msgpack (if installed); values which msgpack can't encode fall back to pickle.
+Large payloads are compressed with zlib. The first byte of the payload tells which encoding was used.
+
+Enabled with the setting cache.serializer = compact | msgpack (see :class:`SerializingProxy`).
+"""
+import copyreg
+import datetime
+import decimal
+import functools
+import io
+import logging
+import pickle
+import zlib
+
+from dogpile.cache.api import NO_VALUE, CachedValue
+from dogpile.cache.proxy import ProxyBackend
+
+log = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError as e:
+    msgpack = None
+    log.info("msgpack not installed")
+
+try:
+    from sqlalchemy.engine import RowProxy
+except ImportError as e:
+    from sqlalchemy.engine import Row as RowProxy
+
+ROW_TYPES = (RowProxy, ) + tuple(RowProxy.__subclasses__())
+
+
+class CompactRow(object):
+    """a read-only row, which behaves like a RowProxy (access by index, by column name and as attribute)"""
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = tuple(values)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self._values[key]
+        return self._values[self._index[key]]
+
+    def __getattr__(self, name):
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values)
+
+    def __repr__(self):
+        return repr(self._values)
+
+    def __reduce__(self):
+        return (make_row, (self.keys(), self._values))
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self.keys(), self._values))
+
+    def has_key(self, key):
+        return key in self._index
+
+
+@functools.lru_cache(maxsize=1024)
+def _row_index(headers):
+    return {name: i for i, name in enumerate(headers)}
+
+
+def make_row(headers, values):
+    """create a CompactRow, rows with the same headers share their index"""
+    return CompactRow(_row_index(tuple(headers)), values)
+
+
+def is_row(o):
+    return isinstance(o, ROW_TYPES + (CompactRow, ))
+
+
+def row_headers(row, headers_cache):
+    """return the column names of the row, equal headers are the same tuple object"""
+    headers = tuple(row.keys())
+    return headers_cache.setdefault(headers, headers)
+
+
+EXT_ROW = 1
+EXT_TUPLE = 2
+EXT_SET = 3
+EXT_FROZENSET = 4
+EXT_DATETIME = 5
+EXT_DATE = 6
+EXT_DECIMAL = 7
+
+
+class PickleCodec(object):
+    """pickle, rows are reduced to their values and shared column names"""
+
+    def dumps(self, o):
+        headers_cache = {}
+
+        def reduce_row(row):
+            return (make_row, (row_headers(row, headers_cache), tuple(row)))
+
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        pickler.dispatch_table = copyreg.dispatch_table.copy()
+        for t in ROW_TYPES + (CompactRow, ):
+            pickler.dispatch_table[t] = reduce_row
+        pickler.dump(o)
+        return buf.getvalue()
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(object):
+    """msgpack with extension types for rows, tuples, sets, dates and decimals.
+
+    The column names of a row are written once per value, later rows refer to them by number."""
+
+    def __init__(self):
+        self.unpack_kwargs = {"raw": False}
+        if msgpack.version >= (0, 6, 1):
+            self.unpack_kwargs["strict_map_key"] = False
+
+    def dumps(self, o):
+        headers_ids = {}
+
+        def packb(value):
+            return msgpack.packb(value, default=default, use_bin_type=True, strict_types=True)
+
+        def default(value):
+            t = type(value)
+            if is_row(value):
+                headers = tuple(value.keys())
+                if headers in headers_ids:
+                    ref = headers_ids[headers]
+                else:
+                    ref = headers_ids[headers] = len(headers_ids)
+                    ref = [ref, list(headers)]
+                return msgpack.ExtType(EXT_ROW, packb(ref) + packb(list(value)))
+            if t is tuple:
+                return msgpack.ExtType(EXT_TUPLE, packb(list(value)))
+            if t is set:
+                return msgpack.ExtType(EXT_SET, packb(list(value)))
+            if t is frozenset:
+                return msgpack.ExtType(EXT_FROZENSET, packb(list(value)))
+            if t is datetime.datetime:
+                offset = value.utcoffset().total_seconds() if value.tzinfo is not None else None
+                return msgpack.ExtType(EXT_DATETIME, packb([value.replace(tzinfo=None).isoformat(), offset]))
+            if t is datetime.date:
+                return msgpack.ExtType(EXT_DATE, packb(value.isoformat()))
+            if t is decimal.Decimal:
+                return msgpack.ExtType(EXT_DECIMAL, packb(str(value)))
+            if isinstance(value, dict):
+                return dict(value)
+            if isinstance(value, list):
+                return list(value)
+            raise TypeError("can't encode %s" % (t, ))
+
+        return packb(o)
+
+    def loads(self, data):
+        headers_by_id = []
+
+        def unpackb(value):
+            return msgpack.unpackb(value, ext_hook=ext_hook, **self.unpack_kwargs)
+
+        def ext_hook(code, value):
+            if code == EXT_ROW:
+                # the headers are registered before the values are decoded, just like they have been encoded
+                unpacker = msgpack.Unpacker(ext_hook=ext_hook, **self.unpack_kwargs)
+                unpacker.feed(value)
+                ref = next(unpacker)
+                if isinstance(ref, list):
+                    headers_by_id.append(tuple(ref[1]))
+                    ref = ref[0]
+                return make_row(headers_by_id[ref], next(unpacker))
+            o = unpackb(value)
+            if code == EXT_TUPLE:
+                return tuple(o)
+            if code == EXT_SET:
+                return set(o)
+            if code == EXT_FROZENSET:
+                return frozenset(o)
+            if code == EXT_DATETIME:
+                dt = datetime.datetime.strptime(o[0], "%Y-%m-%dT%H:%M:%S.%f" if "." in o[0] else "%Y-%m-%dT%H:%M:%S")
+                if o[1] is not None:
+                    dt = dt.replace(tzinfo=datetime.timezone(datetime.timedelta(seconds=o[1])))
+                return dt
+            if code == EXT_DATE:
+                return datetime.datetime.strptime(o, "%Y-%m-%d").date()
+            if code == EXT_DECIMAL:
+                return decimal.Decimal(o)
+            return msgpack.ExtType(code, value)
+
+        return unpackb(data)
+
+
+class CompactSerializer(object):
+    """dumps/loads for cached values, see the module documentation.
+
+    Payloads larger than compress_threshold bytes are compressed."""
+
+    def __init__(self, use_msgpack=False, compress_threshold=1024):
+        self.pickle = PickleCodec()
+        self.msgpack = MsgpackCodec() if (use_msgpack and msgpack is not None) else None
+        self.compress_threshold = compress_threshold
+
+    def dumps(self, o):
+        data = None
+        if self.msgpack is not None:
+            try:
+                data, marker = self.msgpack.dumps(o), b"m"
+            except TypeError as e:
+                pass
+        if data is None:
+            data, marker = self.pickle.dumps(o), b"p"
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            data, marker = zlib.compress(data, 1), marker.upper()
+        return marker + data
+
+    def loads(self, data):
+        marker, data = data[:1], data[1:]
+        if marker.isupper():
+            data, marker = zlib.decompress(data), marker.lower()
+        if marker == b"m":
+            return self.msgpack.loads(data)
+        return self.pickle.loads(data)
+
+
+class SerializingProxy(ProxyBackend):
+    """stores the payloads of the region as bytes encoded by the serializer"""
+
+    def __init__(self, serializer):
+        super(SerializingProxy, self).__init__()
+        self.serializer = serializer
+
+    def _dumps(self, value):
+        return CachedValue(self.serializer.dumps(value.payload), value.metadata)
+
+    def _loads(self, value):
+        if value is NO_VALUE:
+            return value
+        return CachedValue(self.serializer.loads(value.payload), value.metadata)
+
+    def get(self, key):
+        return self._loads(self.proxied.get(key))
+
+    def get_multi(self, keys):
+        return [self._loads(v) for v in self.proxied.get_multi(keys)]
+
+    def set(self, key, value):
+        self.proxied.set(key, self._dumps(value))
+
+    def set_multi(self, mapping):
+        self.proxied.set_multi({k: self._dumps(v) for k, v in mapping.items()})
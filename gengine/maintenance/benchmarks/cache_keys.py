@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the cache key generation and the memory used by the keys in the backend.
+
+Compares the previous scheme (str() of all arguments, e.g. of a whole goal row) with the hashed keys of
+:func:`gengine.base.cache.my_key_mangler` for functions taking ids.
+
+usage: python -m gengine.maintenance.benchmarks.cache_keys [number_of_keys]
+"""
+import sys
+import timeit
+import tracemalloc
+
+from dogpile.cache.util import function_key_generator as dogpile_function_key_generator
+
+from gengine.base.cache import function_key_generator, my_key_mangler
+
+GOAL_CONDITION = '{"term": {"type": "literal", "variable": "invite_users"}, "key": ["5", "7"], "key_operator": "IN"}'
+
+
+def legacy_key_mangler(prefix):
+    def generate_key(key):
+        return prefix + str(key).replace(" ", "")
+    return generate_key
+
+
+def goal_row(goal_id):
+    """a tuple which renders like a goal RowProxy"""
+    return (goal_id, "sum", GOAL_CONDITION, "5*level", "geq", False, None, 10, 1, goal_id * 3, 0, "2017-03-08 17:44:02.214248")
+
+
+def basic_goal_output_by_row(cls, goal, level):
+    pass
+
+
+def basic_goal_output(cls, goal_id, level):
+    pass
+
+
+def legacy_keys(n):
+    generate = dogpile_function_key_generator(None, basic_goal_output_by_row)
+    mangle = legacy_key_mangler("general")
+    return [mangle(generate(None, goal_row(i), i % 10)) for i in range(n)]
+
+
+def hashed_keys(n):
+    generate = function_key_generator(None, basic_goal_output)
+    mangle = my_key_mangler("general", version="1")
+    return [mangle(generate(None, i, i % 10)) for i in range(n)]
+
+
+def measure_memory(make_keys, n):
+    """bytes allocated for a memory backend (a dict) holding n small values under the keys"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    backend = {key: 1 for key in make_keys(n)}
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, backend
+
+
+def main(argv=sys.argv):
+    n = int(argv[1]) if len(argv) > 1 else 10000
+    print("%-8s %12s %14s %16s" % ("scheme", "key bytes", "us per key", "backend bytes"))
+    for name, make_keys in (("legacy", legacy_keys), ("hashed", hashed_keys)):
+        key_length = max(len(k) for k in make_keys(100))
+        seconds = min(timeit.repeat(lambda: make_keys(1000), number=1, repeat=5))
+        memory, backend = measure_memory(make_keys, n)
+        print("%-8s %12d %14.2f %16d" % (name, key_length, seconds * 1000, memory))
+
+
+if __name__ == "__main__":
+    main()
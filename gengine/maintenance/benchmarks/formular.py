@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the formula evaluation: a new parser for every call (as before) against the cached compiled formulas,
+the goal values of all levels evaluated per level against one evaluation with arrays,
+and the texts of rewards and properties rendered with a regular expression against the compiled templates.
+
+usage: python -m gengine.maintenance.benchmarks.formular [number_of_calls]
+"""
+import re
+import sys
+import timeit
+
+from gengine.app.formular import NumericStringParser, evaluate_value_expression, evaluate_string, \
+    evaluate_value_expression_array
+
+EXPRESSIONS = (
+    ("goal", "5*level", {"level": 3}),
+    ("goal with power", "10*level^2-5", {"level": 3}),
+    ("goal name", "Invite ${5*level} friends", {"level": 3, "goal": 15}),
+)
+
+TEXTS = ("${100*level}", "Badge level ${level}", "You earned ${10*level^2} points and ${level} stars", "badge.png", "42")
+
+
+def parse_every_call(expression, params):
+    return NumericStringParser(extra_literals=params.keys()).eval(expression, key_value_map=params)
+
+
+def render_with_regex(text, params):
+    """the rendering before the templates were compiled"""
+    def repl(m):
+        value = parse_every_call(m.group(1), params)
+        if int(value) == value:
+            value = int(value)
+        return str(value)
+    formatted = re.compile('\\${(.+?)}').sub(repl, text)
+    try:
+        if str(int(formatted)) == str(formatted):
+            return int(formatted)
+    except:
+        pass
+    return formatted
+
+
+def main(argv=sys.argv):
+    n = int(argv[1]) if len(argv) > 1 else 1000
+    print("%-16s %14s %17s %8s" % ("formula", "parse us/call", "compiled us/call", "speedup"))
+    for name, expression, params in EXPRESSIONS:
+        if "${" in expression:
+            formula = expression[expression.index("${") + 2:expression.index("}")]
+            compiled = lambda: evaluate_string(expression, params)
+        else:
+            formula = expression
+            compiled = lambda: evaluate_value_expression(expression, params)
+        parse = min(timeit.repeat(lambda: parse_every_call(formula, params), number=n, repeat=3)) / n
+        cached = min(timeit.repeat(compiled, number=n, repeat=3)) / n
+        print("%-16s %14.1f %17.1f %7.0fx" % (name, parse * 1e6, cached * 1e6, parse / cached))
+
+    print("")
+    print("%-16s %14s %17s %8s" % ("levels", "loop us/call", "array us/call", "speedup"))
+    for maxlevel in (10, 100, 1000):
+        levels = range(0, maxlevel + 2)
+        loop = min(timeit.repeat(lambda: [evaluate_value_expression("10*level^2-5", {"level": l}) for l in levels],
+                                 number=max(1, n // 10), repeat=3)) / max(1, n // 10)
+        array = min(timeit.repeat(lambda: evaluate_value_expression_array("10*level^2-5", {"level": levels}),
+                                  number=max(1, n // 10), repeat=3)) / max(1, n // 10)
+        print("%-16s %14.1f %17.1f %7.0fx" % (maxlevel, loop * 1e6, array * 1e6, loop / array))
+
+    print("")
+    print("%-16s %14s %17s %8s" % ("texts", "before us/call", "template us/call", "speedup"))
+    for levels in (1, 10):
+        params = [{"level": l} for l in range(1, levels + 1)]
+        regex = min(timeit.repeat(lambda: [render_with_regex(t, p) for t in TEXTS for p in params],
+                                  number=max(1, n // 10), repeat=3)) / max(1, n // 10)
+        template = min(timeit.repeat(lambda: [evaluate_string(t, p) for t in TEXTS for p in params],
+                                     number=n, repeat=3)) / n
+        print("%-16s %14.1f %17.1f %7.0fx" % ("%s levels" % levels, regex * 1e6, template * 1e6, regex / template))
+
+
+if __name__ == "__main__":
+    main()
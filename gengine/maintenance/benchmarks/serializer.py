@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the compact cache serializer against pickle.
+
+The payloads resemble the cached values of the engine: a progress output with leaderboards and translated
+properties, and a list of goal rows.
+
+usage: python -m gengine.maintenance.benchmarks.serializer [number_of_achievements]
+"""
+import datetime
+import pickle
+import random
+import sys
+import timeit
+
+import pytz
+from sqlalchemy import create_engine
+
+from gengine.base.serializer import CompactSerializer, msgpack
+
+LANGUAGES = ("en", "de", "fr")
+
+
+def translated(text):
+    return {lang: "%s [%s]" % (text, lang) for lang in LANGUAGES}
+
+
+def progress_payload(number_of_achievements):
+    rnd = random.Random(42)
+    achievement_date = datetime.datetime(2017, 3, 6, tzinfo=pytz.utc)
+    achievements = {}
+    for a in range(number_of_achievements):
+        goals = {}
+        for g in range(2):
+            goal_id = a * 10 + g
+            goals[str(goal_id)] = {
+                "goal_id": goal_id,
+                "goal_name": translated("Invite %s friends" % (goal_id,)),
+                "goal_goal": 5.0,
+                "priority": 0,
+                "properties": {str(p): {"property_id": p, "name": "image", "value": "img/%s.png" % (p,),
+                                        "value_translated": translated("image")} for p in range(3)},
+                "value": 3.0,
+                "achieved": False,
+                "leaderboard": [{"user": {"id": uid, "additional_public_data": {"first_name": "first%s" % (uid,), "last_name": "last%s" % (uid,)}},
+                                 "value": rnd.uniform(0, 1000), "position": position}
+                                for position, uid in enumerate(rnd.sample(range(100000), 21))],
+                "leaderboard_position": 10,
+                "leaderboard_total": 5000,
+            }
+        achievements[str(a)] = {
+            "id": a,
+            "internal_name": "achievement_%s" % (a,),
+            "priority": 0,
+            "hidden": False,
+            "achievementcategory": None,
+            "maxlevel": 5,
+            "levels": {str(l): {"level": l,
+                                "goals": {},
+                                "rewards": {},
+                                "properties": {"1": {"property_id": 1, "name": "xp", "value": str(l * 10),
+                                                     "value_translated": translated("%s XP" % (l * 10,))}}} for l in range(1, 6)},
+            "level": 1,
+            "levels_achieved": {"1": achievement_date},
+            "new_levels": {},
+            "goals": goals,
+            "achievement_date": achievement_date,
+            "evaluation": "weekly",
+        }
+    return {"achievements": achievements}
+
+
+def goal_rows(number_of_rows):
+    engine = create_engine("sqlite://")
+    engine.execute("CREATE TABLE goals (id INTEGER, name_translation_id INTEGER, condition TEXT, timespan INTEGER, "
+                   "group_by_key BOOLEAN, group_by_dateformat TEXT, goal TEXT, operator TEXT, maxmin TEXT, "
+                   "achievement_id INTEGER, priority INTEGER)")
+    for i in range(number_of_rows):
+        engine.execute("INSERT INTO goals VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                       (i, i, '{"term": {"type": "literal", "variable": "invite_users"}}', None, False, None,
+                        "5*level", "geq", "max", i // 2, 0))
+    return engine.execute("SELECT * FROM goals").fetchall()
+
+
+def measure(dumps, loads, payload):
+    data = dumps(payload)
+    encode = min(timeit.repeat(lambda: dumps(payload), number=10, repeat=3)) / 10
+    decode = min(timeit.repeat(lambda: loads(data), number=10, repeat=3)) / 10
+    return len(data), encode, decode
+
+
+def main(argv=sys.argv):
+    n = int(argv[1]) if len(argv) > 1 else 20
+    payloads = (("progress", progress_payload(n)), ("goal rows", goal_rows(n * 10)))
+    serializers = [("pickle", lambda o: pickle.dumps(o, pickle.HIGHEST_PROTOCOL), pickle.loads)]
+    compact = CompactSerializer()
+    serializers.append(("compact", compact.dumps, compact.loads))
+    if msgpack is not None:
+        compact_msgpack = CompactSerializer(use_msgpack=True)
+        serializers.append(("msgpack", compact_msgpack.dumps, compact_msgpack.loads))
+
+    print("%-10s %-10s %10s %12s %12s" % ("payload", "serializer", "bytes", "encode ms", "decode ms"))
+    for payload_name, payload in payloads:
+        for name, dumps, loads in serializers:
+            size, encode, decode = measure(dumps, loads, payload)
+            print("%-10s %-10s %10d %12.3f %12.3f" % (payload_name, name, size, encode * 1000, decode * 1000))
+
+
+if __name__ == "__main__":
+    main()
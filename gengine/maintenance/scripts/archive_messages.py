@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.StreamHandler())
+
+import datetime
+import os
+import pyramid_dogpile_cache
+import transaction
+from gengine.app.cache import init_caches
+from pyramid.config import Configurator
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy.datamanager import mark_changed
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s production.ini messages.retention_days=30")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+
+    from gengine.base.settings import set_settings
+    set_settings(settings)
+
+    durl = os.environ.get("DATABASE_URL")  # heroku
+    if durl:
+        settings['sqlalchemy.url'] = durl
+
+    murl = os.environ.get("MEMCACHED_URL")
+    if murl:
+        settings['urlcache_url'] = murl
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+
+    config = Configurator(settings=settings)
+    pyramid_dogpile_cache.includeme(config)
+
+    from gengine.metadata import (
+        init_session,
+        init_declarative_base,
+        init_db,
+        DBSession
+    )
+    init_session()
+    init_declarative_base()
+    init_db(engine)
+    init_caches()
+
+    from gengine.app.model import UserMessage
+
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=int(settings.get("messages.retention_days", 90)))
+    batch_size = int(settings.get("messages.archive_batch_size", 10000))
+    delete = not asbool(settings.get("messages.archive", True))
+
+    # one transaction per batch keeps the locks short, the inbox and the push workers are not blocked
+    total = 0
+    while True:
+        with transaction.manager:
+            count = UserMessage.archive_messages(before, batch_size=batch_size, delete=delete)
+            mark_changed(DBSession())
+        total += count
+        if count < batch_size:
+            break
+    log.info("%s %s messages created before %s" % ("deleted" if delete else "archived", total, before))
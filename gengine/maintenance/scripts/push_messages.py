@@ -2,16 +2,11 @@
 import sys
 import logging
 
-from zope.sqlalchemy.datamanager import mark_changed
-
-from gengine.metadata import MySession
-
 log = logging.getLogger(__name__)
 log.addHandler(logging.StreamHandler())
 
 import os
 import pyramid_dogpile_cache
-import transaction
 from gengine.app.cache import init_caches
 from pyramid.config import Configurator
 from pyramid.paster import (
@@ -62,18 +57,8 @@ def main(argv=sys.argv):
     init_db(engine)
     init_caches()
 
-    from gengine.metadata import (
-        DBSession
-    )
-    sess = DBSession()
-    init_session(override_session=sess, replace=True)
-
-    import gengine.app.model as m
-    with transaction.manager:
-        mark_changed(sess, transaction.manager, True)
+    from gengine.app.push import PushWorker
 
-        messages = sess.execute(m.t_user_messages.select().where(m.t_user_messages.c.has_been_pushed == False))
-        for msg in messages:
-            m.UserMessage.deliver(msg)
-        sess.flush()
-        sess.commit()
+    # messages which are claimed by a running gengine_push_worker are skipped
+    count = PushWorker(engine=engine, settings=settings).run_until_empty()
+    log.info("processed %s messages" % (count,))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.StreamHandler())
+
+import os
+import pyramid_dogpile_cache
+from gengine.app.cache import init_caches
+from pyramid.config import Configurator
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import engine_from_config
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s production.ini cache.warm.max_users=500")\n'
+          'Note: caches with a process local backend (e.g. memory) have to be warmed inside the application '
+          '(admin interface or cache.warm.on_startup)' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+
+    from gengine.base.settings import set_settings
+    set_settings(settings)
+
+    durl = os.environ.get("DATABASE_URL")  # heroku
+    if durl:
+        settings['sqlalchemy.url'] = durl
+
+    murl = os.environ.get("MEMCACHED_URL")
+    if murl:
+        settings['urlcache_url'] = murl
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+
+    config = Configurator(settings=settings)
+    pyramid_dogpile_cache.includeme(config)
+
+    from gengine.metadata import (
+        init_session,
+        init_declarative_base,
+        init_db
+    )
+    init_session()
+    init_declarative_base()
+    init_db(engine)
+    init_caches()
+
+    from gengine.app.warming import warm_caches
+    result = warm_caches(settings)
+    print("warmed %(achievements)s achievements and %(users)s users in %(seconds)s seconds" % result)
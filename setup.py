@@ -73,6 +73,9 @@ setup(name='gamification-engine',
             'tapns3',
             'python-gcm',
         ],
+        "numpy": [
+            'numpy'
+        ],
         "testing": [
             'testing.postgresql',
             'testing.redis',
@@ -88,6 +91,9 @@ setup(name='gamification-engine',
       generate_gengine_erd = gengine.maintenance.scripts.generate_erd:main
       generate_gengine_revision = gengine.maintenance.scripts.generate_revision:main
       gengine_push_messages = gengine.maintenance.scripts.push_messages:main
+      gengine_archive_messages = gengine.maintenance.scripts.archive_messages:main
+      gengine_push_worker = gengine.maintenance.scripts.push_worker:main
+      gengine_warm_caches = gengine.maintenance.scripts.warm_caches:main
       [redgalaxy.plugins]
       gengine = gengine:redgalaxy
       """,